@@ -1,5 +1,14 @@
 import cv2
 import numpy as np
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import metrics
+import logs
+import scheduling
+from pipeline import Pipeline
 
 def chroma_key(frame, lower_bound, upper_bound):
     # Convert the frame to HSV color space
@@ -24,52 +33,99 @@ def add_dithering_effect(frame, pixel_size=10):
     
     return pixelated_frame
 
+# Pipeline stages, top level functions so they can run in worker processes too (--pipeline-config)
+def key_stage(item):
+    frame, lower_bound, upper_bound = item
+    return chroma_key(frame, lower_bound, upper_bound)
+
+def dither_stage(frame):
+    return add_dithering_effect(frame, pixel_size=10)  # Adjust pixel_size for different levels of pixelation
+
 # Callback function for trackbars (does nothing but is required by OpenCV)
 def nothing(x):
     pass
 
-# Initialize webcam
-cap = cv2.VideoCapture(0)
-
-# Create a window with trackbars to adjust HSV range
-cv2.namedWindow('Chroma Keyed Video')
-cv2.createTrackbar('Lower Hue Threshold', 'Chroma Keyed Video', 0, 180, nothing)
-cv2.createTrackbar('Upper Hue Threshold', 'Chroma Keyed Video', 180, 180, nothing)
-cv2.createTrackbar('Lower Saturation Threshold', 'Chroma Keyed Video', 0, 255, nothing)
-cv2.createTrackbar('Upper Saturation Threshold', 'Chroma Keyed Video', 255, 255, nothing)
-cv2.createTrackbar('Lower Brightness Threshold', 'Chroma Keyed Video', 0, 255, nothing)
-cv2.createTrackbar('Upper Brightness Threshold', 'Chroma Keyed Video', 115, 255, nothing)  # Start at 115 for your setup
-
-while cap.isOpened():
-    ret, frame = cap.read()
-    if not ret:
-        break
-
-    # Get current positions of trackbars
-    lower_h = cv2.getTrackbarPos('Lower Hue Threshold', 'Chroma Keyed Video')
-    upper_h = cv2.getTrackbarPos('Upper Hue Threshold', 'Chroma Keyed Video')
-    lower_s = cv2.getTrackbarPos('Lower Saturation Threshold', 'Chroma Keyed Video')
-    upper_s = cv2.getTrackbarPos('Upper Saturation Threshold', 'Chroma Keyed Video')
-    lower_v = cv2.getTrackbarPos('Lower Brightness Threshold', 'Chroma Keyed Video')
-    upper_v = cv2.getTrackbarPos('Upper Brightness Threshold', 'Chroma Keyed Video')
-
-    # Set HSV range based on slider positions
-    lower_black = np.array([lower_h, lower_s, lower_v])
-    upper_black = np.array([upper_h, upper_s, upper_v])
-
-    # Apply chroma keying with adjusted values
-    chroma_frame = chroma_key(frame, lower_black, upper_black)
-
-    # Add dithering/pixelation effect
-    pixelated_frame = add_dithering_effect(chroma_frame, pixel_size=10)  # Adjust pixel_size for different levels of pixelation
-
-    # Display the resulting frame
-    cv2.imshow('Chroma Keyed Video', pixelated_frame)
-
-    # Exit on 'q' key press
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-# Release the capture and close windows
-cap.release()
-cv2.destroyAllWindows()
+def main():
+    parser = argparse.ArgumentParser(description="Chroma keys and pixelates the webcam, with sliders for the HSV range.")
+    parser.add_argument("--pipeline-config", default=None, metavar="PIPELINE.json",
+                        help="queue sizes, drop policies, executors and workers of the stages (read, key, dither, show), "
+                             "e.g. {\"chroma\": {\"key\": {\"executor\": \"process\", \"workers\": 2}}}")
+    metrics.add_arguments(parser)
+    logs.add_arguments(parser)
+    scheduling.add_arguments(parser)
+    args = parser.parse_args()
+    logs.setup_from_args(args)
+    scheduler = scheduling.from_args(args)
+
+    # What --metrics-port / --metrics-socket show, the per stage times are in pipeline_stage_seconds{pipeline="chroma"}
+    frames = metrics.counter("chroma_frames_total", "Frames shown")
+    metrics.gauge("chroma_fps", "Frames per second since the last scrape").set_function(metrics.rate_of(frames.get))
+    metrics.serve_from_args(args)
+
+    # Initialize webcam
+    cap = cv2.VideoCapture(0)
+
+    # Create a window with trackbars to adjust HSV range
+    cv2.namedWindow('Chroma Keyed Video')
+    cv2.createTrackbar('Lower Hue Threshold', 'Chroma Keyed Video', 0, 180, nothing)
+    cv2.createTrackbar('Upper Hue Threshold', 'Chroma Keyed Video', 180, 180, nothing)
+    cv2.createTrackbar('Lower Saturation Threshold', 'Chroma Keyed Video', 0, 255, nothing)
+    cv2.createTrackbar('Upper Saturation Threshold', 'Chroma Keyed Video', 255, 255, nothing)
+    cv2.createTrackbar('Lower Brightness Threshold', 'Chroma Keyed Video', 0, 255, nothing)
+    cv2.createTrackbar('Upper Brightness Threshold', 'Chroma Keyed Video', 115, 255, nothing)  # Start at 115 for your setup
+
+    # The slider positions, read by the window thread and sent along with every frame
+    bounds = [np.array([0, 0, 0]), np.array([180, 255, 115])]
+    chroma = Pipeline("chroma")
+
+    def read():
+        ret, frame = cap.read()
+        if not ret:
+            chroma.stop_event.set()  # end of the camera (or file), everything winds down
+            return None
+        return frame, bounds[0], bounds[1]
+
+    def show(pixelated_frame):
+        # Get current positions of trackbars
+        lower_h = cv2.getTrackbarPos('Lower Hue Threshold', 'Chroma Keyed Video')
+        upper_h = cv2.getTrackbarPos('Upper Hue Threshold', 'Chroma Keyed Video')
+        lower_s = cv2.getTrackbarPos('Lower Saturation Threshold', 'Chroma Keyed Video')
+        upper_s = cv2.getTrackbarPos('Upper Saturation Threshold', 'Chroma Keyed Video')
+        lower_v = cv2.getTrackbarPos('Lower Brightness Threshold', 'Chroma Keyed Video')
+        upper_v = cv2.getTrackbarPos('Upper Brightness Threshold', 'Chroma Keyed Video')
+
+        # Set HSV range based on slider positions, the next frames get keyed with it
+        bounds[:] = [np.array([lower_h, lower_s, lower_v]), np.array([upper_h, upper_s, upper_v])]
+
+        # Display the resulting frame
+        cv2.imshow('Chroma Keyed Video', pixelated_frame)
+        frames.inc()
+
+        # Exit on 'q' key press
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            chroma.stop_event.set()
+
+    # Camera -> chroma key -> pixelate -> window, only the newest frame waits in front of each step.
+    # The window has to stay on this thread (OpenCV GUI), so show runs here
+    chroma.source("read", read)
+    chroma.transform("key", key_stage, queue=1, policy="latest")
+    chroma.transform("dither", dither_stage, queue=1, policy="latest")
+    chroma.sink("show", show, queue=1, policy="latest", executor="main")
+    if args.pipeline_config:
+        chroma.configure_from_file(args.pipeline_config)
+    chroma.start()
+    scheduler.apply()
+    try:
+        chroma.run()
+    except KeyboardInterrupt:
+        pass
+    chroma.stop()
+    print(chroma.report())
+    print(scheduler.report())
+
+    # Release the capture and close windows
+    cap.release()
+    cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    main()
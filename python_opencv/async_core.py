@@ -0,0 +1,156 @@
+# asyncio based core for the streamer.
+# The udp channels become DatagramProtocols on one event loop instead of a thread blocked in recvfrom each,
+# the blocking OpenCV and PyAudio work goes to small executors with a cap on queued jobs, and shutdown is
+# one event that every loop watches instead of daemon threads getting killed when the script ends.
+import asyncio
+import concurrent.futures
+import logging
+import signal
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class DatagramChannel(asyncio.DatagramProtocol):
+    """Hands every datagram received on a socket to on_datagram(data), on the event loop thread."""
+
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+        self.errors = 0
+
+    def datagram_received(self, data, addr):
+        try:
+            self.on_datagram(data)
+        except Exception as e:
+            log.warning("Error handling channel packet: %s", e)
+
+    def error_received(self, exc):
+        # ICMP port unreachable and friends while the other device is down, nothing to do about it
+        self.errors += 1
+
+
+class BoundedExecutor:
+    """Thread pool that only accepts max_pending jobs at a time, so a slow stage can't pile up work."""
+
+    def __init__(self, name, workers=1, max_pending=1, initializer=None):
+        self.name = name
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name,
+                                                           initializer=initializer)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.dropped = 0
+
+    async def run(self, fn, *args):
+        """Runs fn(*args) in the pool and waits for the result, waits for a free slot first (backpressure)."""
+        while not self._slots.acquire(blocking=False):
+            await asyncio.sleep(0.001)
+        future = self._pool.submit(self._call, fn, args)
+        return await asyncio.wrap_future(future)
+
+    def submit_nowait(self, fn, *args):
+        """Fire and forget, the job is dropped if the pool is already busy. Returns whether it was taken."""
+        if not self._slots.acquire(blocking=False):
+            self.dropped += 1
+            return False
+        self._pool.submit(self._call, fn, args)
+        return True
+
+    def _call(self, fn, args):
+        try:
+            return fn(*args)
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+class AsyncCore:
+    """Owns the event loop, the channels, the executors and the coordinated shutdown."""
+
+    def __init__(self, stop_event):
+        # threading.Event shared with the blocking loops, they check it to know when to return
+        self.stop_event = stop_event
+        self.loop = None
+        self.executors = []
+        self.transports = []
+        self.tasks = []
+        self.threads = []
+        self._stopped = None
+
+    def executor(self, name, workers=1, max_pending=1, initializer=None):
+        """initializer runs first thing on every worker thread (threads are started lazily, on the first jobs)."""
+        executor = BoundedExecutor(name, workers, max_pending, initializer)
+        self.executors.append(executor)
+        return executor
+
+    async def open_channel(self, sock, on_datagram):
+        """Wraps an already bound udp socket, the socket stays usable for sendto from any thread."""
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: DatagramChannel(on_datagram), sock=sock)
+        self.transports.append(transport)
+        return transport
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.append(task)
+        return task
+
+    def run_blocking(self, name, fn, *args):
+        """Runs a long blocking loop (display, playback, command prompt) in its own thread.
+        fn should return once stop_event is set, the core stops when any of them returns.
+        The thread is a daemon only so a prompt stuck in input() can't hold up the exit."""
+        def wrapper():
+            try:
+                fn(*args)
+            finally:
+                self.stop()
+        thread = threading.Thread(target=wrapper, name=name, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+        return thread
+
+    def every(self, interval, fn, *args):
+        """Calls fn(*args) on the event loop every interval seconds until shutdown."""
+        async def timer():
+            while not self.stop_event.is_set():
+                fn(*args)
+                await asyncio.sleep(interval)
+        return self.spawn(timer())
+
+    def stop(self):
+        """Thread safe, asks everything to wind down."""
+        self.stop_event.set()
+        if self.loop is not None and self._stopped is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                pass  # loop already closed, we are done anyway
+
+    def run(self, setup):
+        """Runs the event loop until stop(), setup(core) is awaited first to open channels and spawn loops."""
+        asyncio.run(self._main(setup))
+
+    async def _main(self, setup):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # no signal handlers on windows, ctrl+c still ends the prompt
+        if self.stop_event.is_set():
+            self._stopped.set()
+
+        await setup(self)
+        await self._stopped.wait()
+
+        # Loops see stop_event and return, transports stop reading, then the executors drain
+        for transport in self.transports:
+            transport.abort()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for executor in self.executors:
+            await asyncio.to_thread(executor.shutdown)
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                await asyncio.to_thread(thread.join, 1.0)
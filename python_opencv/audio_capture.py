@@ -0,0 +1,127 @@
+# Keeps every configured microphone open at the same time so we can switch the outgoing source
+# instantly instead of closing and reopening a PyAudio stream (which takes a noticeable while).
+# Each device fills its own small queue from a PyAudio callback, read() hands out chunks from the
+# selected one and cross-fades the first chunk after a switch so there is no click.
+import logging
+import queue
+import threading
+
+import numpy as np
+import pyaudio
+
+import packets
+
+log = logging.getLogger(__name__)
+
+
+class AudioCaptureManager:
+    """Owns one input stream per device and serves chunks from whichever device is selected."""
+
+    def __init__(self, audio, device_indices, format, channels, rate, chunk,
+                 crossfade_samples=256, queue_chunks=4, on_thread=None):
+        self.chunk = chunk
+        self.rate = rate
+        self.channels = channels
+        self.crossfade_samples = min(crossfade_samples, chunk * channels)
+        self.queue_chunks = queue_chunks
+        self.on_thread = on_thread  # called once from each PyAudio callback thread, to set its priority
+        self._audio = audio
+        self._stream_args = dict(format=format, channels=channels, rate=rate, input=True,
+                                 frames_per_buffer=chunk)
+        self._lock = threading.Lock()
+        self.streams = {}
+        self.queues = {}
+        self.active = None
+        self._previous = None
+
+        for index in device_indices:
+            self.open_device(index)
+        if self.streams:
+            self.active = next(iter(self.streams))
+
+    def open_device(self, index):
+        """Opens device index if it isn't already, returns False if PyAudio refuses it."""
+        if index in self.streams:
+            return True
+        chunks = queue.Queue(maxsize=self.queue_chunks)
+        first_call = [True]
+
+        def callback(in_data, frame_count, time_info, status):
+            if first_call[0] and self.on_thread is not None:
+                first_call[0] = False
+                self.on_thread()
+            # The chunk started being recorded frame_count samples ago
+            timestamp = packets.capture_timestamp(-frame_count / self.rate)
+            # Inactive devices keep running, we just throw away their oldest audio
+            if chunks.full():
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    pass
+            chunks.put_nowait((in_data, timestamp))
+            return (None, pyaudio.paContinue)
+
+        try:
+            stream = self._audio.open(input_device_index=index, stream_callback=callback, **self._stream_args)
+        except (OSError, ValueError) as e:
+            log.warning("Could not open microphone %s: %s", index, e)
+            return False
+        with self._lock:
+            self.queues[index] = chunks
+            self.streams[index] = stream
+        return True
+
+    def select(self, index):
+        """Makes index the outgoing source, the next read() cross-fades into it."""
+        with self._lock:
+            if index == self.active or index not in self.streams:
+                return index == self.active
+            self._previous = self.active
+            self.active = index
+            # Only the newest audio of the new device is relevant
+            new_queue = self.queues[index]
+            while new_queue.qsize() > 1:
+                try:
+                    new_queue.get_nowait()
+                except queue.Empty:
+                    break
+        return True
+
+    def read(self, timeout=1.0):
+        """Blocks until the selected device has a chunk, returns (bytes, capture timestamp), silence on timeout."""
+        with self._lock:
+            active = self.active
+            previous = self._previous
+            self._previous = None
+        if active is None:
+            raise RuntimeError("No microphone could be opened")
+
+        data, timestamp = self._get(active, timeout)
+        if previous is not None:
+            old, _ = self._get(previous, 0)
+            data = self._crossfade(old, data)
+        return data, timestamp
+
+    def _get(self, index, timeout):
+        try:
+            return self.queues[index].get(timeout=timeout) if timeout else self.queues[index].get_nowait()
+        except queue.Empty:
+            return bytes(self.chunk * self.channels * 2), packets.capture_timestamp(-self.chunk / self.rate)
+
+    def _crossfade(self, old, new):
+        old_samples = np.frombuffer(old, dtype=np.int16).astype(np.float32)
+        new_samples = np.frombuffer(new, dtype=np.int16).astype(np.float32)
+        n = min(self.crossfade_samples, len(old_samples), len(new_samples))
+        ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+        new_samples[:n] = old_samples[:n] * (1.0 - ramp) + new_samples[:n] * ramp
+        return np.clip(new_samples, -32768, 32767).astype(np.int16).tobytes()
+
+    def close(self):
+        with self._lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+            self.queues.clear()
+            self.active = None
+        for stream in streams:
+            stream.stop_stream()
+            stream.close()
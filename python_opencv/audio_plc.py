@@ -0,0 +1,116 @@
+# Packet loss concealment for the udp audio stream.
+# When chunks go missing we keep playing by repeating the last pitch period of what we heard,
+# fading it out, and then cross-fade back into the real audio once packets show up again.
+# Everything happens on the chunk we just received, so no extra buffering (and latency) is added.
+import numpy as np
+
+import packets
+
+
+class PacketLossConcealer:
+    """Turns (sequence number, int16 chunk) pairs into a gap free list of chunks to play."""
+
+    def __init__(self, chunk_size, rate, max_conceal_chunks=4, min_pitch_hz=70, max_pitch_hz=500,
+                 crossfade_samples=128, resync_threshold=64):
+        self.chunk_size = chunk_size
+        self.max_conceal_chunks = max_conceal_chunks
+        self.min_period = int(rate / max_pitch_hz)
+        self.max_period = int(rate / min_pitch_hz)
+        self.crossfade_samples = min(crossfade_samples, chunk_size)
+        # A jump bigger than this (either way) means the sender restarted, not that packets were lost
+        self.resync_threshold = resync_threshold
+
+        # Last samples we played, long enough to find a pitch period in
+        self.history = np.zeros(2 * self.max_period, dtype=np.float32)
+        self.expected_seq = None
+        self.period = None
+        self.phase = 0
+        self.gain = 1.0
+        self.concealing = False
+
+        self.received = 0
+        self.lost = 0
+        self.concealed = 0
+        self.late = 0
+        self.malformed = 0  # not a whole number of samples, empty or longer than a chunk, ignored
+
+    def process(self, seq, payload):
+        """Feed one received chunk, returns the list of int16 byte chunks that should be played now."""
+        if not payload or len(payload) % 2 or len(payload) > 2 * self.chunk_size:
+            # A stray datagram on the audio port, not ours to play (and not a lost chunk either)
+            self.malformed += 1
+            return []
+        samples = np.frombuffer(payload, dtype=np.int16).astype(np.float32)
+        out = []
+
+        if self.expected_seq is not None:
+            delta = packets.seq_delta(seq, self.expected_seq)
+            if delta < 0 and delta > -self.resync_threshold:
+                # We already concealed this one, playing it now would shift the audio
+                self.late += 1
+                return out
+            if 0 < delta < self.resync_threshold:
+                self.lost += delta
+                for _ in range(min(delta, self.max_conceal_chunks)):
+                    out.append(self._conceal_chunk())
+
+        self.received += 1
+        self.expected_seq = packets.next_seq(seq)
+
+        if self.concealing:
+            samples = self._crossfade_in(samples)
+            self.concealing = False
+        self._remember(samples)
+        out.append(_to_int16_bytes(samples))
+        return out
+
+    def _conceal_chunk(self):
+        if not self.concealing:
+            self.period = self._estimate_period()
+            self.phase = 0
+            self.gain = 1.0
+            self.concealing = True
+
+        step = 1.0 / self.max_conceal_chunks
+        fade = np.linspace(self.gain, max(self.gain - step, 0.0), self.chunk_size, endpoint=False, dtype=np.float32)
+        self.gain = max(self.gain - step, 0.0)
+        chunk = self._extend(self.chunk_size) * fade
+        self.concealed += 1
+        return _to_int16_bytes(chunk)
+
+    def _crossfade_in(self, samples):
+        n = min(self.crossfade_samples, len(samples))  # a short chunk fades in over all of it
+        tail = self._extend(n) * self.gain
+        ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+        samples = samples.copy()
+        samples[:n] = tail * (1.0 - ramp) + samples[:n] * ramp
+        return samples
+
+    def _extend(self, n):
+        # Continue the signal by tiling the last pitch period, picking up where the previous call stopped
+        template = self.history[-self.period:]
+        idx = (self.phase + np.arange(n)) % self.period
+        self.phase = (self.phase + n) % self.period
+        return template[idx]
+
+    def _estimate_period(self):
+        # Autocorrelation of the recent history, computed with an fft, strongest lag in the pitch range wins
+        x = self.history - self.history.mean()
+        n = len(x)
+        spectrum = np.fft.rfft(x, 2 * n)
+        corr = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+        if corr[0] <= 0:
+            return self.max_period
+        lags = corr[self.min_period:self.max_period + 1]
+        return self.min_period + int(np.argmax(lags))
+
+    def _remember(self, samples):
+        if len(samples) >= len(self.history):
+            self.history[:] = samples[-len(self.history):]
+        else:
+            self.history = np.roll(self.history, -len(samples))
+            self.history[-len(samples):] = samples
+
+
+def _to_int16_bytes(samples):
+    return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
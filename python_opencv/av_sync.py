@@ -0,0 +1,144 @@
+# Lines video presentation up with the audio we are playing on the receiver.
+# Both streams carry the sender's capture timestamp, the audio thread tells us which capture time is
+# coming out of the speaker right now and the display loop asks for the frame that belongs to that moment.
+# Frames that are too old get dropped, if the next frame is still in the future the current one is repeated.
+import collections
+import threading
+import time
+
+import packets
+
+
+class AVSyncScheduler:
+    """Holds decoded frames until the audio clock reaches their capture time."""
+
+    def __init__(self, tolerance=0.045, max_frames=8, audio_timeout=0.5, max_skew=1.0):
+        self.tolerance_ms = tolerance * 1000
+        # Further apart than this the audio and video can't be from the same clock (another machine's audio),
+        # following it would hold every frame forever, so we show the newest frame as if there were no audio
+        self.skew_limit_ms = max_skew * 1000
+        # Without fresh audio for this long we stop waiting on it and just show the newest frame
+        self.audio_timeout = audio_timeout
+        self._frames = collections.deque(maxlen=max_frames)
+        self._cond = threading.Condition()
+        self._audio_ts = None
+        self._audio_local = 0.0
+        self._current = None
+        self._current_wait_ms = None
+        self._current_repeated = False
+
+        self.shown = 0
+        self.dropped = 0
+        self.repeated = 0  # frames held on screen longer because the next one wasn't due yet
+        self.unsynced = 0  # frames shown free running because audio and video were more than max_skew apart
+        self.skew_ms = 0.0  # smoothed skew of shown frames, positive means video is ahead of audio
+        self.max_skew_ms = 0.0
+
+    def audio_played(self, capture_ts, chunk_duration, output_latency):
+        """Called after each chunk is written to the speaker with that chunk's capture timestamp."""
+        # What is audible now started chunk_duration ago minus whatever is still sitting in the output buffer
+        position = capture_ts + int((chunk_duration - output_latency) * 1000)
+        with self._cond:
+            self._audio_ts = position % packets.TIMESTAMP_MODULO
+            self._audio_local = time.monotonic()
+
+    def audio_clock(self):
+        """Sender capture time (ms) of the audio being heard right now, None if audio isn't flowing."""
+        with self._cond:
+            return self._audio_clock_locked()
+
+    def _audio_clock_locked(self):
+        if self._audio_ts is None:
+            return None
+        elapsed = time.monotonic() - self._audio_local
+        if elapsed > self.audio_timeout:
+            return None
+        return (self._audio_ts + int(elapsed * 1000)) % packets.TIMESTAMP_MODULO
+
+    def push_frame(self, capture_ts, frame):
+        with self._cond:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped += 1
+            self._frames.append((capture_ts, frame, time.monotonic()))
+            self._cond.notify()
+
+    def next_frame(self, timeout=0.01):
+        """Returns (frame, is_new) for the frame that should be on screen now, frame is None before the first one."""
+        with self._cond:
+            if not self._frames:
+                self._cond.wait(timeout)
+            clock = self._audio_clock_locked()
+            if clock is not None and self._frames:
+                if abs(packets.timestamp_delta(self._frames[-1][0], clock)) > self.skew_limit_ms:
+                    self.unsynced += 1
+                    clock = None
+
+            if clock is None:
+                # No audio to follow (or none that belongs to this video), show the newest frame we have
+                if self._frames:
+                    self.dropped += len(self._frames) - 1
+                    self._show(self._frames.pop(), None)
+                    self._frames.clear()
+                    return self._current[1], True
+                return self._frame_again()
+
+            chosen = None
+            skew = None
+            while self._frames:
+                ts = self._frames[0][0]
+                skew = packets.timestamp_delta(ts, clock)
+                if skew > self.tolerance_ms:
+                    break  # still in the future, keep it for later
+                if chosen is not None:
+                    self.dropped += 1
+                chosen = self._frames.popleft()
+
+            if chosen is None:
+                # Video is ahead of the audio, hold the current frame a little longer
+                if self._frames and self._current is not None and not self._current_repeated:
+                    self._current_repeated = True  # once per frame, not per poll while it waits
+                    self.repeated += 1
+                if self._frames:
+                    # Nothing to do until the next frame is due, don't let the display loop spin meanwhile
+                    self._cond.wait(min(timeout, (skew - self.tolerance_ms) / 1000))
+                return self._frame_again()
+            self._show(chosen, clock)
+            return self._current[1], True
+
+    def queued(self):
+        """Frames waiting for their turn."""
+        with self._cond:
+            return len(self._frames)
+
+    def current_timestamp(self):
+        """Capture time of the frame on screen, None before the first one."""
+        with self._cond:
+            return self._current[0] if self._current is not None else None
+
+    def current_wait_ms(self):
+        """How long the frame on screen waited here between arriving and being shown, on our own clock
+        (unlike the capture timestamp, which is the sender's). None before the first frame."""
+        with self._cond:
+            return self._current_wait_ms
+
+    def _frame_again(self):
+        return (self._current[1] if self._current is not None else None), False
+
+    def _show(self, item, clock):
+        self._current = item
+        self._current_repeated = False
+        self._current_wait_ms = 1000 * (time.monotonic() - item[2])
+        self.shown += 1
+        if clock is not None:
+            skew = packets.timestamp_delta(item[0], clock)
+            self.skew_ms = 0.9 * self.skew_ms + 0.1 * skew
+            if abs(skew) > abs(self.max_skew_ms):
+                self.max_skew_ms = skew
+
+    def report(self):
+        """One line summary of the measured A/V skew and what we did about it."""
+        clock = self.audio_clock()
+        state = "following audio" if clock is not None else "no audio clock, free running"
+        return (f"A/V skew {self.skew_ms:+.1f} ms (worst {self.max_skew_ms:+.1f} ms, tolerance "
+                f"{self.tolerance_ms:.0f} ms), frames shown {self.shown}, dropped {self.dropped}, "
+                f"repeated {self.repeated}, unsynced {self.unsynced}, {state}")
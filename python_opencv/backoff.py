@@ -0,0 +1,28 @@
+# Exponential backoff for loops that retry something that keeps failing (a camera that fell off the usb,
+# a socket that keeps reporting errors), so a broken device costs a wakeup now and then instead of a core.
+import time
+
+
+class Backoff:
+    """Delays that double on every failure up to maximum, back to the start after reset()."""
+
+    def __init__(self, initial=0.01, maximum=1.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+
+    def next_delay(self):
+        delay = min(self.initial * 2 ** self.failures, self.maximum)
+        self.failures += 1
+        return delay
+
+    def wait(self, stop_event=None):
+        """Sleeps the next delay, returns True if stop_event got set meanwhile."""
+        delay = self.next_delay()
+        if stop_event is not None:
+            return stop_event.wait(delay)
+        time.sleep(delay)
+        return False
+
+    def reset(self):
+        self.failures = 0
@@ -0,0 +1,242 @@
+# End to end benchmark: runs two streamer12.py instances against each other over loopback with fake
+# cameras/microphones and no window or speaker, optionally through netem_proxy.py, for every combination
+# of the parameters given, and writes what came out to a json report.
+#
+#   python bench_streamer.py run --duration 20 --sizes 320x180,640x360 --qualities 30,60 \
+#       --detection haar,off --profiles clean,wifi --output today.json
+#   python bench_streamer.py compare yesterday.json today.json
+#
+# Compare matches the runs of both reports by their parameters and exits with 1 if any got worse by more
+# than --threshold (fps down, or drops, latency, bandwidth or cpu up).
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# netem_proxy.py options of each impairment profile, None means the peers talk directly
+PROFILES = {
+    "clean": None,
+    "lan": ["--delay", "2", "--jitter", "1"],
+    "wifi": ["--loss", "0.01", "--delay", "15", "--jitter", "8", "--reorder", "0.01"],
+    "bursty": ["--ge-p", "0.01", "--ge-r", "0.3", "--delay", "20", "--jitter", "5"],
+    "congested": ["--rate", "1500", "--queue", "150", "--delay", "30", "--jitter", "10"],
+}
+
+# Ports of the streamer (video is --base-port), every one of them gets a proxy link in both directions
+OTHER_PORTS = (10003, 9999, 10004)
+OFFSET_A, OFFSET_B, OFFSET_TO_B, OFFSET_TO_A = 0, 100, 200, 300
+
+# metric -> (1 if higher is better else -1, smallest absolute change worth flagging)
+METRICS = {
+    "fps": (1, 0.5),
+    "frame_drop_rate": (-1, 0.01),
+    "latency_p50_ms": (-1, 2.0),
+    "latency_p99_ms": (-1, 5.0),
+    "kbit_per_s": (-1, 10.0),
+    "sender_cpu_percent": (-1, 2.0),
+    "receiver_cpu_percent": (-1, 2.0),
+}
+
+
+def streamer_command(args, port, offset, remote_offset, size, quality, detection, stats_file):
+    command = [sys.executable, os.path.join(HERE, "streamer12.py"), "127.0.0.1", str(port),
+               "--bind", "127.0.0.1", "--port-offset", str(offset), "--remote-port-offset", str(remote_offset),
+               "--audio-source", "tone", "--video-sink", "null", "--audio-sink", "null",
+               "--fps", str(args.fps), "--video-size", size, "--jpeg-quality", str(quality),
+               "--detection", detection, "--duration", str(args.duration), "--stats-file", stats_file]
+    for source in args.video_source:
+        command += ["--video-source", source]
+    return command + args.streamer_args
+
+
+def proxy_command(args, profile):
+    command = [sys.executable, os.path.join(HERE, "netem_proxy.py"), "--summary", "0", "--seed", str(args.seed)]
+    for port in (args.base_port,) + OTHER_PORTS:
+        command += ["--link", f"{port + OFFSET_TO_B}:127.0.0.1:{port + OFFSET_B}",
+                    "--link", f"{port + OFFSET_TO_A}:127.0.0.1:{port + OFFSET_A}"]
+    return command + PROFILES[profile]
+
+
+def run_one(args, size, quality, detection, profile, workdir):
+    """Runs one pair, returns the metrics of the A -> B direction plus both raw stats files."""
+    name = f"{size}-q{quality}-{detection}-{profile}"
+    stats_a = os.path.join(workdir, f"{name}-a.json")
+    stats_b = os.path.join(workdir, f"{name}-b.json")
+    proxied = PROFILES[profile] is not None
+    to_b = OFFSET_TO_B if proxied else OFFSET_B
+    to_a = OFFSET_TO_A if proxied else OFFSET_A
+
+    processes = []
+    logs = []
+    try:
+        if proxied:
+            log = open(os.path.join(workdir, f"{name}-proxy.log"), "w")
+            logs.append(log)
+            processes.append(subprocess.Popen(proxy_command(args, profile), stdout=log, stderr=subprocess.STDOUT))
+            time.sleep(0.5)  # proxy sockets must be bound before the peers start sending
+        peers = []
+        for label, offset, remote, stats in (("a", OFFSET_A, to_b, stats_a), ("b", OFFSET_B, to_a, stats_b)):
+            log = open(os.path.join(workdir, f"{name}-{label}.log"), "w")
+            logs.append(log)
+            command = streamer_command(args, args.base_port, offset, remote, size, quality, detection, stats)
+            peers.append(subprocess.Popen(command, cwd=HERE, stdin=subprocess.DEVNULL, stdout=log,
+                                          stderr=subprocess.STDOUT))
+        processes.extend(peers)
+        for peer in peers:
+            peer.wait(timeout=args.duration + 60)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait(timeout=10)
+        for log in logs:
+            log.close()
+
+    try:
+        with open(stats_a) as f:
+            a = json.load(f)
+        with open(stats_b) as f:
+            b = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"{name}: no stats ({e}), see the logs in {workdir}")
+        return dict(params=dict(size=size, quality=quality, detection=detection, profile=profile), error=str(e))
+    return dict(params=dict(size=size, quality=quality, detection=detection, profile=profile),
+                metrics=metrics(a, b), sender=a, receiver=b)
+
+
+def metrics(a, b):
+    """What the report and compare care about, for frames going from a to b."""
+    frames_sent = a["sent"].get("video", {}).get("datagrams", 0)
+    shown = b["counters"].get("frames_shown", 0)
+    latency = b["frame_latency_ms"]
+    return dict(
+        fps=shown / b["elapsed_s"] if b["elapsed_s"] else 0.0,
+        frames_sent=frames_sent,
+        frames_received=b["received"].get("video", {}).get("datagrams", 0),
+        frames_shown=shown,
+        frame_drop_rate=max(0.0, 1 - shown / frames_sent) if frames_sent else 1.0,
+        latency_p50_ms=latency["p50"],
+        latency_p90_ms=latency["p90"],
+        latency_p99_ms=latency["p99"],
+        kbit_per_s=a["bytes_sent"] * 8 / 1000 / a["elapsed_s"] if a["elapsed_s"] else 0.0,
+        audio_loss_rate=b["audio"]["lost"] / max(b["audio"]["received"] + b["audio"]["lost"], 1),
+        sender_cpu_percent=100 * a["process_cpu_s"] / a["elapsed_s"] if a["elapsed_s"] else 0.0,
+        receiver_cpu_percent=100 * b["process_cpu_s"] / b["elapsed_s"] if b["elapsed_s"] else 0.0,
+        sender_thread_cpu_percent={thread: 100 * cpu / a["elapsed_s"] for thread, cpu in a["thread_cpu_s"].items()},
+        receiver_thread_cpu_percent={thread: 100 * cpu / b["elapsed_s"] for thread, cpu in b["thread_cpu_s"].items()},
+    )
+
+
+def format_metrics(m):
+    def ms(value):
+        return f"{value:6.1f}" if value is not None else "     -"
+    return (f"{m['fps']:5.1f} fps  drop {100 * m['frame_drop_rate']:5.1f}%  latency p50 {ms(m['latency_p50_ms'])} "
+            f"p99 {ms(m['latency_p99_ms'])} ms  {m['kbit_per_s']:7.0f} kbit/s  cpu {m['sender_cpu_percent']:5.1f}% / "
+            f"{m['receiver_cpu_percent']:5.1f}%")
+
+
+def run(args):
+    combinations = list(itertools.product(args.sizes.split(","), [int(q) for q in args.qualities.split(",")],
+                                          args.detection.split(","), args.profiles.split(",")))
+    for profile in {c[3] for c in combinations}:
+        if profile not in PROFILES:
+            sys.exit(f"unknown profile {profile!r}, known ones: {', '.join(PROFILES)}")
+    print(f"{len(combinations)} runs of {args.duration:.0f} s each")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_streamer-")
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    for size, quality, detection, profile in combinations:
+        result = run_one(args, size, quality, detection, profile, workdir)
+        results.append(result)
+        if "metrics" in result:
+            print(f"{size:>9} q{quality:<3} {detection:<4} {profile:<10} {format_metrics(result['metrics'])}")
+
+    report = dict(
+        created=time.strftime("%Y-%m-%d %H:%M:%S"),
+        host=dict(node=platform.node(), machine=platform.machine(), python=platform.python_version(),
+                  cpus=os.cpu_count()),
+        settings=dict(duration=args.duration, fps=args.fps, video_source=args.video_source,
+                      streamer_args=args.streamer_args),
+        runs=results,
+    )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}, logs in {workdir}")
+
+
+def run_key(result):
+    p = result["params"]
+    return (p["size"], p["quality"], p["detection"], p["profile"])
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = {run_key(r): r for r in json.load(f)["runs"] if "metrics" in r}
+    with open(args.candidate) as f:
+        candidate = {run_key(r): r for r in json.load(f)["runs"] if "metrics" in r}
+
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key]["metrics"], candidate[key]["metrics"]
+        print(" ".join(str(k) for k in key))
+        for metric, (direction, min_change) in METRICS.items():
+            before, after = old.get(metric), new.get(metric)
+            if before is None or after is None:
+                continue
+            change = after - before
+            relative = change / abs(before) if before else float("inf") if change else 0.0
+            worse = direction * change < 0 and abs(change) >= min_change and abs(relative) > args.threshold
+            regressions += worse
+            print(f"  {metric:<22} {before:10.2f} -> {after:10.2f}  ({100 * relative:+6.1f}%)"
+                  f"{'  REGRESSION' if worse else ''}")
+    for key in sorted(baseline.keys() - candidate.keys()):
+        print(f"{' '.join(str(k) for k in key)}: missing from {args.candidate}")
+    print(f"{regressions} regression(s)")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a pair of streamers over loopback and compare reports.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark and write a json report")
+    run_parser.add_argument("--duration", type=float, default=15.0, help="seconds each pair streams")
+    run_parser.add_argument("--sizes", default="320x180", help="comma separated WIDTHxHEIGHT to send at")
+    run_parser.add_argument("--qualities", default="30", help="comma separated jpeg qualities")
+    run_parser.add_argument("--detection", default="haar", help="comma separated detection modes (haar, off)")
+    run_parser.add_argument("--profiles", default="clean",
+                            help=f"comma separated impairment profiles: {', '.join(PROFILES)}")
+    run_parser.add_argument("--video-source", action="append", default=None,
+                            help="video source spec for both peers (default synthetic), e.g. file:clip.mp4")
+    run_parser.add_argument("--fps", type=float, default=30.0, help="frame rate of the video source")
+    run_parser.add_argument("--base-port", type=int, default=5000, help="video port, the others are the streamer defaults")
+    run_parser.add_argument("--seed", type=int, default=1, help="random seed of the impairment proxy")
+    run_parser.add_argument("--workdir", default=None, help="where stats files and logs go (default a temp dir)")
+    run_parser.add_argument("--output", default="bench_streamer.json", help="report file")
+    run_parser.add_argument("streamer_args", nargs=argparse.REMAINDER,
+                            help="after --, passed to both streamers as is (e.g. -- --mux --asyncio)")
+
+    compare_parser = commands.add_parser("compare", help="compare two reports, exit 1 on regressions")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="relative change that counts")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        sys.exit(compare(args))
+    args.video_source = args.video_source or ["synthetic"]
+    if args.streamer_args[:1] == ["--"]:
+        args.streamer_args = args.streamer_args[1:]
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Loopback benchmark for udp_batch: datagrams per second with and without GSO/GRO.
+# python bench_udp_batch.py --size 1200 --batch 16 --seconds 3
+import argparse
+import socket
+import threading
+import time
+
+from udp_batch import BatchReceiver, BatchSender
+
+
+def run(size, batch, seconds, fast):
+    receiver_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver_sock.bind(("127.0.0.1", 0))
+    receiver_sock.settimeout(0.5)
+    sender_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+
+    sender = BatchSender(sender_sock, enabled=fast)
+    receiver = BatchReceiver(receiver_sock, enabled=fast)
+    done = threading.Event()
+
+    def receive():
+        while not done.is_set():
+            try:
+                receiver.receive()
+            except socket.timeout:
+                pass
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    datagrams = [bytes([i % 256]) * size for i in range(batch)]
+    address = receiver_sock.getsockname()
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        sender.send(datagrams, address)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.2)  # let the receiver drain what's in flight
+    done.set()
+    thread.join()
+    receiver_sock.close()
+    sender_sock.close()
+    return dict(
+        mode="gso/gro" if fast else "plain",
+        gso=sender.gso,
+        gro=receiver.gro,
+        sent_per_s=sender.datagrams / elapsed,
+        received_per_s=receiver.datagrams / elapsed,
+        send_syscalls_per_s=sender.syscalls / elapsed,
+        receive_syscalls_per_s=receiver.syscalls / elapsed,
+        loss=1 - receiver.datagrams / max(sender.datagrams, 1),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare plain udp sends/receives with the GSO/GRO fast path over loopback.")
+    parser.add_argument("--size", type=int, default=1200, help="datagram size in bytes")
+    parser.add_argument("--batch", type=int, default=16, help="datagrams handed to the sender at once")
+    parser.add_argument("--seconds", type=float, default=3.0, help="how long each mode runs")
+    args = parser.parse_args()
+
+    print(f"{args.size} byte datagrams, batches of {args.batch}, {args.seconds:.1f} s per mode")
+    results = [run(args.size, args.batch, args.seconds, fast) for fast in (False, True)]
+    for r in results:
+        print(f"{r['mode']:>8}: sent {r['sent_per_s']:>10.0f}/s  received {r['received_per_s']:>10.0f}/s  "
+              f"send syscalls {r['send_syscalls_per_s']:>9.0f}/s  receive syscalls {r['receive_syscalls_per_s']:>9.0f}/s  "
+              f"loss {100 * r['loss']:.1f}%  (gso {r['gso']}, gro {r['gro']})")
+    plain, fast = results
+    if plain["received_per_s"] > 0:
+        print(f"speedup (received datagrams/s): {fast['received_per_s'] / plain['received_per_s']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
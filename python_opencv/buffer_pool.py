@@ -0,0 +1,74 @@
+# Pool of preallocated receive buffers.
+# recvfrom() makes a fresh 64 KB bytes object for every datagram. Instead we recvfrom_into() a bytearray
+# from this pool and pass memoryviews of it to the handlers, the buffer goes back into the pool once
+# every handler is done with it. A handler that keeps the payload past its return (the audio playout
+# queue does) calls retain(payload) and release(payload) when it's finished.
+import threading
+
+
+class BufferPool:
+    """Fixed set of equally sized bytearrays with reference counts, plus hit/miss statistics."""
+
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self._free = [bytearray(size) for _ in range(count)]
+        self._in_use = {}  # id(buffer) -> [buffer, references]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.high_water = 0
+
+    def acquire(self):
+        """Hands out a buffer with one reference, allocates a new one if the pool ran dry (a miss)."""
+        with self._lock:
+            if self._free:
+                buffer = self._free.pop()
+                self.hits += 1
+            else:
+                buffer = bytearray(self.size)
+                self.misses += 1
+            self._in_use[id(buffer)] = [buffer, 1]
+            self.high_water = max(self.high_water, len(self._in_use))
+        return buffer
+
+    def retain(self, view):
+        """Adds a reference to the pooled buffer behind view, does nothing for buffers that aren't ours."""
+        with self._lock:
+            entry = self._entry(view)
+            if entry is not None:
+                entry[1] += 1
+
+    def release(self, view):
+        """Drops a reference, the buffer goes back to the pool when the last one is gone."""
+        with self._lock:
+            entry = self._entry(view)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            buffer = entry[0]
+            del self._in_use[id(buffer)]
+            # Buffers allocated on a miss are only kept if the pool is short
+            if len(self._free) < self.count:
+                self._free.append(buffer)
+
+    def _entry(self, view):
+        owner = view.obj if isinstance(view, memoryview) else view
+        entry = self._in_use.get(id(owner))
+        if entry is None or entry[0] is not owner:
+            return None
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, in_use=len(self._in_use), free=len(self._free),
+                        high_water=self.high_water)
+
+    def report(self):
+        stats = self.stats()
+        total = stats["hits"] + stats["misses"]
+        rate = 100 * stats["hits"] / total if total else 100.0
+        return (f"Receive buffers: {stats['hits']} hits, {stats['misses']} misses ({rate:.1f}% from the pool), "
+                f"{stats['in_use']} in use, {stats['free']} free, at most {stats['high_water']} in use at once")
@@ -0,0 +1,86 @@
+# Cameras that come back by themselves. A camera that stops delivering frames (usb hiccup, someone pulled
+# the cable) is released after a few failed reads and reopened by a background thread, waiting longer
+# after every failed attempt. Meanwhile read() returns (False, None) straight away, so the loops reading
+# it keep their pace (see sources.Pacer) and nothing else waits for the camera.
+import logging
+import threading
+
+from backoff import Backoff
+
+log = logging.getLogger(__name__)
+
+
+class ManagedCapture:
+    """Reads like a cv2.VideoCapture, opener() gives a fresh one whenever the current one has failed."""
+
+    def __init__(self, name, opener, stop_event, capture=None, failures_before_reopen=5, min_backoff=0.5,
+                 max_backoff=30.0):
+        self.name = name
+        self.opener = opener
+        self.stop_event = stop_event
+        self.failures_before_reopen = failures_before_reopen
+        self.backoff = Backoff(min_backoff, max_backoff)
+        self._lock = threading.Lock()
+        self._capture = capture if capture is not None else opener()
+        self._failed_reads = 0
+        self._reopening = False
+        self.failures = 0  # reads that came back empty
+        self.reopens = 0   # times the camera came back
+
+    def isOpened(self):
+        with self._lock:
+            return self._capture is not None and self._capture.isOpened()
+
+    @property
+    def down(self):
+        return self._reopening
+
+    def read(self):
+        with self._lock:
+            capture = self._capture
+        if capture is None:
+            return False, None
+        ret, frame = capture.read()
+        if ret and frame is not None:
+            self._failed_reads = 0
+            return ret, frame
+        self.failures += 1
+        self._failed_reads += 1
+        if self._failed_reads >= self.failures_before_reopen:
+            self._start_reopen(capture)
+        return False, None
+
+    def _start_reopen(self, failed):
+        with self._lock:
+            if self._reopening or self._capture is not failed:
+                return
+            self._reopening = True
+            self._capture = None
+        log.warning("Camera %s stopped delivering frames, reopening it in the background", self.name)
+        failed.release()
+        threading.Thread(target=self._reopen, name=f"reopen-{self.name}", daemon=True).start()
+
+    def _reopen(self):
+        self.backoff.reset()
+        while not self.backoff.wait(self.stop_event):
+            try:
+                capture = self.opener()
+                ok = capture.isOpened() and capture.read()[0]
+            except Exception as e:
+                log.debug("Camera %s: %s", self.name, e)
+                continue
+            if ok:
+                with self._lock:
+                    self._capture = capture
+                    self._failed_reads = 0
+                    self._reopening = False
+                self.reopens += 1
+                log.warning("Camera %s is back after %d attempt(s)", self.name, self.backoff.failures)
+                return
+            capture.release()
+
+    def release(self):
+        with self._lock:
+            capture, self._capture = self._capture, None
+        if capture is not None:
+            capture.release()
@@ -0,0 +1,128 @@
+# Local control of a running streamer, for show control systems and scripts instead of the input() menu.
+# A unix socket, one json object per line each way:
+#   -> {"id": 1, "command": "set_overlay", "on": true}
+#   <- {"id": 1, "ok": true, "result": {"overlay": true}}
+# Errors come back as {"id": 1, "ok": false, "error": "..."}. A connection can send as many commands as it
+# likes, they are answered in order. Commands run straight on the connection's thread, what they do
+# (flip a flag, queue a heartbeat) takes microseconds.
+#
+#   python control.py /tmp/streamer.ctl set_overlay on=true
+#   python control.py /tmp/streamer.ctl stats
+#   python control.py /tmp/streamer.ctl ping --repeat 1000      (shows the round trip times)
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = self.server.control.execute(line)
+            self.wfile.write(reply)
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer:
+    """Answers json commands on a unix socket, commands maps a name to a function taking the request's fields."""
+
+    def __init__(self, path, commands):
+        self.path = path
+        self.commands = dict(commands)
+        self.commands.setdefault("ping", lambda: "pong")
+        self.commands.setdefault("help", lambda: sorted(self.commands))
+        self.handled = 0
+        self.errors = 0
+        self._server = None
+
+    def execute(self, line):
+        """One request line in, one reply line out (both bytes)."""
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.pop("id", None)
+            name = request.pop("command")
+            command = self.commands.get(name)
+            if command is None:
+                raise ValueError(f"unknown command {name!r}, try help")
+            reply = dict(ok=True, result=command(**request))
+        except Exception as e:
+            self.errors += 1
+            reply = dict(ok=False, error=f"{type(e).__name__}: {e}")
+        self.handled += 1
+        if request_id is not None:
+            reply["id"] = request_id
+        return (json.dumps(reply, default=str) + "\n").encode()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over from a run that didn't clean up
+        self._server = _UnixServer(self.path, _Handler)
+        self._server.control = self
+        threading.Thread(target=self._server.serve_forever, name="control", daemon=True).start()
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def parse_value(text):
+    """Command line values: json if it parses (true, 3, [1,2], "x"), the plain string otherwise."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends one command to a running streamer's --control-socket.")
+    parser.add_argument("socket", help="the streamer's --control-socket path")
+    parser.add_argument("command", help="e.g. toggle_overlay, set_overlay, get_params, set_params, stats, help")
+    parser.add_argument("fields", nargs="*", metavar="KEY=VALUE", help="arguments of the command, e.g. on=true")
+    parser.add_argument("--repeat", type=int, default=1, help="send it this many times and print round trip times")
+    args = parser.parse_args()
+
+    request = dict(command=args.command)
+    for field in args.fields:
+        key, _, value = field.partition("=")
+        request[key] = parse_value(value)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.socket)
+    stream = sock.makefile("rwb")
+    times = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        stream.write((json.dumps(dict(request, id=i)) + "\n").encode())
+        stream.flush()
+        reply = json.loads(stream.readline())
+        times.append(time.perf_counter() - start)
+    sock.close()
+
+    print(json.dumps(reply, indent=2))
+    if args.repeat > 1:
+        times.sort()
+        print(f"round trip: p50 {1e6 * times[len(times) // 2]:.0f} us, p99 {1e6 * times[int(len(times) * 0.99)]:.0f} us, "
+              f"max {1e6 * times[-1]:.0f} us")
+    sys.exit(0 if reply.get("ok") else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Remembers which cameras and microphones worked last time, so a restart (a watchdog bringing the streamer
+# back mid show) can open those straight away instead of probing every index again. The cache is only a
+# hint: cameras are checked by opening them, microphones by their name, and anything that doesn't match
+# falls back to the normal probing.
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "people_watching", "devices.json")
+
+
+class DeviceCache:
+    """{"cameras": [index, ...], "microphones": [[index, name], ...]} in a small json file."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.data = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring the device cache %s: %s", path, e)
+
+    @property
+    def cameras(self):
+        return self.data.get("cameras")
+
+    def microphones(self, audio, defaults):
+        """One microphone index per entry of defaults (the streamer's slots): the cached ones if every one of them
+        still has the same name, else None. Slots the cache doesn't cover (a mic didn't open last time) keep
+        their default. A microphone still at its index keeps it, one that moved is found again by its name.
+        Two identical microphones (same name) each get their own index, never both the same one."""
+        cached = self.data.get("microphones")
+        if not cached:
+            return None
+        cached = cached[:len(defaults)]
+        names = {}
+        for i in range(audio.get_device_count()):
+            info = audio.get_device_info_by_index(i)
+            if info["maxInputChannels"] > 0:
+                names[i] = info["name"]
+        indices = []
+        for index, name in cached:
+            if names.get(index) != name or index in indices:
+                moved = [i for i, other in names.items() if other == name and i not in indices]
+                if not moved:
+                    log.info("Cached microphone %s (%s) is gone, using the defaults", index, name)
+                    return None
+                index = moved[0]
+            indices.append(index)
+        return indices + list(defaults[len(indices):])
+
+    def save(self, cameras=None, microphones=None, audio=None):
+        """Stores the camera indices and/or the microphone indices (with their names, looked up in audio)."""
+        if not self.path:
+            return
+        if cameras is not None:
+            self.data["cameras"] = list(cameras)
+        if microphones is not None and audio is not None:
+            self.data["microphones"] = [[i, audio.get_device_info_by_index(i)["name"]] for i in microphones]
+        self.data["saved"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(self.data, f, indent=2)
+        except OSError as e:
+            log.warning("Could not write the device cache %s: %s", self.path, e)
@@ -0,0 +1,215 @@
+# Always-on flight recorder: the last few seconds of stage timings, network events, overlay changes and
+# small copies of the frames we showed, in fixed size ring buffers (the memory is allocated up front and
+# never grows). When latency or drops cross a threshold, or an operator asks, the rings are written to
+# disk so a spike at a venue can be looked at afterwards.
+#
+# A dump is one .npz file (a zip, each array is its own member so readers can pick what they need):
+#   events       structured array (t, kind, name, value, value2), oldest first
+#   names        the strings the name column points to
+#   second_index row of the first event of every second since the dump window started, to seek by time
+#   frames       the downsampled frames (n, height, width, 3) and frame_times their times
+#   meta         json: why it was dumped, when, thresholds, counts
+# python flight_recorder.py DUMP.npz prints a timeline of a dump.
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Event kinds
+STAGE = 0     # name = stage, value = seconds
+NETWORK = 1   # name = what happened (peer_lost, video_gap, decode_error...), value = how many / how much
+OVERLAY = 2   # value = local overlay, value2 = remote overlay
+LATENCY = 3   # value = decode to screen ms of a shown frame, on this device's clock
+MARK = 4      # name = free text from the operator or the streamer
+KIND_NAMES = ["stage", "network", "overlay", "latency", "mark"]
+
+EVENT = np.dtype([("t", "<f8"), ("kind", "u1"), ("name", "<u2"), ("value", "<f4"), ("value2", "<f4")])
+
+
+class FlightRecorder:
+    """Fixed memory rings of events and frames covering about `seconds`, dumped by check() or dump()."""
+
+    def __init__(self, seconds=30.0, events_per_second=500, frame_size=(96, 54), frames_per_second=2.0,
+                 directory="flight_recorder", latency_ms=250.0, drop_rate=0.2, cooldown=60.0, max_dumps=20):
+        self.seconds = seconds
+        self.directory = directory
+        self.latency_ms = latency_ms
+        self.drop_rate = drop_rate
+        self.cooldown = cooldown
+        self.max_dumps = max_dumps
+        self._lock = threading.Lock()
+        self._events = np.zeros(int(seconds * events_per_second), dtype=EVENT)
+        self._written = 0
+        self._names = {}
+        self._name_list = []
+        self.frame_size = frame_size
+        self._frame_interval = 1.0 / frames_per_second
+        self._frames = np.zeros((max(1, int(seconds * frames_per_second)), frame_size[1], frame_size[0], 3), np.uint8)
+        self._frame_times = np.zeros(len(self._frames), dtype="<f8")
+        self._frames_written = 0
+        self._last_frame = 0.0
+        # For check(): latencies since the previous check and the drop counters it saw last
+        self._window_latencies = []
+        self._last_counts = None
+        self._last_dump = -float("inf")
+        self.dumps = 0
+
+    @property
+    def memory_bytes(self):
+        return self._events.nbytes + self._frames.nbytes + self._frame_times.nbytes
+
+    def _name(self, name):
+        code = self._names.get(name)
+        if code is None:
+            code = self._names[name] = len(self._name_list)
+            self._name_list.append(name)
+        return code
+
+    def event(self, kind, name="", value=0.0, value2=0.0):
+        with self._lock:
+            row = self._events[self._written % len(self._events)]
+            row["t"] = time.monotonic()
+            row["kind"] = kind
+            row["name"] = self._name(name)
+            row["value"] = value
+            row["value2"] = value2
+            self._written += 1
+
+    def stage(self, name, seconds):
+        self.event(STAGE, name, seconds)
+
+    def network(self, name, value=1.0):
+        self.event(NETWORK, name, value)
+
+    def overlay(self, local, remote):
+        self.event(OVERLAY, "overlay", float(local), float(remote))
+
+    def mark(self, text):
+        self.event(MARK, text)
+
+    def latency(self, ms):
+        self.event(LATENCY, "frame", ms)
+        with self._lock:
+            self._window_latencies.append(ms)
+
+    def frame(self, frame):
+        """Keeps a small copy of frame, at most frames_per_second of them."""
+        now = time.monotonic()
+        if now - self._last_frame < self._frame_interval:
+            return
+        self._last_frame = now
+        import cv2  # only the roles that show video get here, the others never load OpenCV
+        small = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        with self._lock:
+            i = self._frames_written % len(self._frames)
+            self._frames[i] = small
+            self._frame_times[i] = now
+            self._frames_written += 1
+
+    def check(self, dropped, delivered):
+        """Call about once a second with cumulative counts of dropped and delivered frames.
+        Dumps when the p90 latency or the drop rate since the previous call is over its threshold."""
+        with self._lock:
+            latencies = self._window_latencies
+            self._window_latencies = []
+            last = self._last_counts
+            self._last_counts = (dropped, delivered)
+        reasons = []
+        if latencies:
+            p90 = float(np.percentile(latencies, 90))
+            if p90 > self.latency_ms:
+                reasons.append(f"latency p90 {p90:.0f} ms > {self.latency_ms:.0f} ms")
+        if last is not None:
+            d_dropped, d_delivered = dropped - last[0], delivered - last[1]
+            if d_dropped + d_delivered > 0:
+                rate = d_dropped / (d_dropped + d_delivered)
+                if rate > self.drop_rate:
+                    reasons.append(f"drop rate {100 * rate:.0f}% > {100 * self.drop_rate:.0f}%")
+        if reasons and time.monotonic() - self._last_dump >= self.cooldown:
+            return self.dump(", ".join(reasons))
+        return None
+
+    def dump(self, reason="requested"):
+        """Copies the rings (quick, under the lock) and writes them in a background thread. Returns the path."""
+        now = time.monotonic()
+        with self._lock:
+            self._last_dump = now
+            events = self._ordered(self._events, self._written)
+            frames = self._ordered(self._frames, self._frames_written)
+            frame_times = self._ordered(self._frame_times, self._frames_written)
+            names = list(self._name_list)
+        start = now - self.seconds
+        events = events[events["t"] >= start]
+        keep = frame_times >= start
+        frames, frame_times = frames[keep], frame_times[keep]
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.dumps += 1
+        path = os.path.join(self.directory, time.strftime("flight-%Y%m%d-%H%M%S") + f"-{self.dumps}.npz")
+        meta = dict(reason=reason, wall_time=time.strftime("%Y-%m-%d %H:%M:%S"), monotonic=now, window_s=self.seconds,
+                    latency_threshold_ms=self.latency_ms, drop_rate_threshold=self.drop_rate,
+                    events=len(events), frames=len(frames), kinds=KIND_NAMES)
+        threading.Thread(target=self._write, args=(path, events, names, frames, frame_times, meta, start),
+                         name="flight-recorder", daemon=True).start()
+        return path
+
+    @staticmethod
+    def _ordered(ring, written):
+        n = min(written, len(ring))
+        order = np.arange(written - n, written) % len(ring)
+        return ring[order]
+
+    def _write(self, path, events, names, frames, frame_times, meta, start):
+        seconds = np.arange(int(np.ceil(self.seconds)) + 1)
+        second_index = np.searchsorted(events["t"], start + seconds)
+        np.savez_compressed(path, events=events, names=np.array(names, dtype=str), second_index=second_index,
+                            frames=frames, frame_times=frame_times, meta=np.array(json.dumps(meta)))
+        log.warning("Flight recorder: %s, wrote %s", meta["reason"], path)
+        self._prune()
+
+    def _prune(self):
+        dumps = sorted(name for name in os.listdir(self.directory) if name.startswith("flight-") and name.endswith(".npz"))
+        for name in dumps[:-self.max_dumps]:
+            os.remove(os.path.join(self.directory, name))
+
+
+def load_dump(path):
+    """(meta dict, events, names, frames, frame_times) of a dump."""
+    with np.load(path) as data:
+        return (json.loads(str(data["meta"])), data["events"], [str(n) for n in data["names"]], data["frames"],
+                data["frame_times"])
+
+
+def print_dump(path):
+    meta, events, names, frames, frame_times = load_dump(path)
+    print(f"{path}: {meta['reason']} at {meta['wall_time']}, {meta['events']} events, {meta['frames']} frames")
+    if not len(events):
+        return
+    end = meta["monotonic"]
+    stages = {}
+    for row in events:
+        kind = int(row["kind"])
+        name = names[row["name"]]
+        if kind == STAGE:
+            stages.setdefault(name, []).append(row["value"] * 1000)
+        elif kind in (NETWORK, OVERLAY, MARK):
+            detail = (f"local {bool(row['value'])} remote {bool(row['value2'])}" if kind == OVERLAY
+                      else f"{row['value']:g}" if kind == NETWORK else "")
+            print(f"  {row['t'] - end:8.3f}s  {KIND_NAMES[kind]:<8} {name} {detail}")
+    latencies = events["value"][events["kind"] == LATENCY]
+    if len(latencies):
+        p50, p90, p99 = np.percentile(latencies, (50, 90, 99))
+        print(f"  latency ms: p50 {p50:.1f} p90 {p90:.1f} p99 {p99:.1f} max {latencies.max():.1f}")
+    for name, values in sorted(stages.items()):
+        print(f"  {name:<12} {len(values):6} spans  p50 {np.percentile(values, 50):7.2f} ms  max {max(values):7.2f} ms")
+
+
+if __name__ == "__main__":
+    for dump_path in sys.argv[1:]:
+        print_dump(dump_path)
@@ -0,0 +1,137 @@
+# Gives up video quality before the Pi gives up on us. When the board gets hot (it throttles at 80-85 C)
+# or the cores are saturated, everything slows down together and the overlay stops reacting. This steps
+# down one level at a time in a fixed order, cheapest loss first: eye detection less often, then fewer
+# frames per second, then a smaller picture. Audio is never touched. When the temperature and load have
+# been comfortable for a while it steps back up, again one level at a time.
+import glob
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# What each level allows, level 0 is full quality. scale multiplies the size the video is sent at
+LEVELS = [
+    dict(detection_every=1, max_fps=None, scale=1.0),
+    dict(detection_every=2, max_fps=None, scale=1.0),
+    dict(detection_every=4, max_fps=None, scale=1.0),
+    dict(detection_every=4, max_fps=20.0, scale=1.0),
+    dict(detection_every=8, max_fps=15.0, scale=1.0),
+    dict(detection_every=8, max_fps=15.0, scale=0.75),
+    dict(detection_every=8, max_fps=10.0, scale=0.5),
+]
+
+
+def find_thermal_zone():
+    """The cpu temperature file, /sys/class/thermal/thermal_zone0/temp on a Pi. None if there is none."""
+    zones = sorted(glob.glob("/sys/class/thermal/thermal_zone*"))
+    for zone in zones:
+        try:
+            with open(os.path.join(zone, "type")) as f:
+                if "cpu" in f.read().lower():
+                    return os.path.join(zone, "temp")
+        except OSError:
+            continue
+    return os.path.join(zones[0], "temp") if zones else None
+
+
+class CpuLoad:
+    """Busy fraction of all cores between two calls, from /proc/stat."""
+
+    def __init__(self):
+        self._last = self._read()
+
+    @staticmethod
+    def _read():
+        try:
+            with open("/proc/stat") as f:
+                values = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+        return sum(values), idle
+
+    def read(self):
+        now = self._read()
+        last, self._last = self._last, now
+        if now is None or last is None or now[0] == last[0]:
+            return None
+        return 1.0 - (now[1] - last[1]) / (now[0] - last[0])
+
+
+class QualityGovernor:
+    """Call tick() about once a second, read level / settings wherever the quality is decided."""
+
+    def __init__(self, hot=75.0, cool=None, max_load=0.9, ok_load=0.7, hold=5.0, recover_after=15.0,
+                 thermal_zone=None, on_change=None):
+        self.hot = hot
+        self.cool = cool if cool is not None else hot - 7.0
+        self.max_load = max_load
+        self.ok_load = ok_load
+        self.hold = hold  # seconds between two steps down
+        self.recover_after = recover_after  # seconds of comfort before one step up
+        self.thermal_zone = thermal_zone or find_thermal_zone()
+        self.on_change = on_change
+        self.level = 0
+        self.temperature = None
+        self.load = None
+        self.transitions = 0
+        self._cpu = CpuLoad()
+        self._last_change = -float("inf")
+        self._comfortable_since = None
+
+    @property
+    def settings(self):
+        return LEVELS[self.level]
+
+    def read_temperature(self):
+        if self.thermal_zone is None:
+            return None
+        try:
+            with open(self.thermal_zone) as f:
+                return int(f.read()) / 1000.0
+        except (OSError, ValueError):
+            return None
+
+    def tick(self):
+        """Measures and moves at most one level. Returns True if the level changed."""
+        now = time.monotonic()
+        self.temperature = self.read_temperature()
+        self.load = self._cpu.read()
+        too_hot = self.temperature is not None and self.temperature >= self.hot
+        too_busy = self.load is not None and self.load >= self.max_load
+        comfortable = ((self.temperature is None or self.temperature <= self.cool)
+                       and (self.load is None or self.load <= self.ok_load))
+
+        if too_hot or too_busy:
+            self._comfortable_since = None
+            if self.level < len(LEVELS) - 1 and now - self._last_change >= self.hold:
+                return self._change(self.level + 1, "hot" if too_hot else "busy", now)
+        elif comfortable:
+            if self._comfortable_since is None:
+                self._comfortable_since = now
+            if self.level > 0 and now - max(self._comfortable_since, self._last_change) >= self.recover_after:
+                return self._change(self.level - 1, "recovered", now)
+        else:
+            self._comfortable_since = None  # in between, stay where we are
+        return False
+
+    def _change(self, level, reason, now):
+        previous, self.level = self.level, level
+        self._last_change = now
+        self.transitions += 1
+        s = self.settings
+        temperature = f"{self.temperature:.1f} C" if self.temperature is not None else "no sensor"
+        load = f"{100 * self.load:.0f}%" if self.load is not None else "unknown"
+        log.warning("Quality level %d -> %d (%s, temperature %s, cpu load %s): detection every %d frame(s), %s, %d%% size",
+                    previous, level, reason, temperature, load, s["detection_every"],
+                    f"max {s['max_fps']:g} fps" if s["max_fps"] else "full fps", 100 * s["scale"])
+        if self.on_change is not None:
+            self.on_change(previous, level, reason)
+        return True
+
+    def report(self):
+        temperature = f"{self.temperature:.1f} C" if self.temperature is not None else "no sensor"
+        load = f"{100 * self.load:.0f}%" if self.load is not None else "unknown"
+        return (f"Quality governor: level {self.level}/{len(LEVELS) - 1} {self.settings}, temperature {temperature}, "
+                f"cpu load {load}, {self.transitions} transitions")
@@ -0,0 +1,56 @@
+# Tells the senders whether anybody is listening on the other end, based on the status heartbeat.
+# While the other device is off there's no point capturing, encoding and sending at full rate all day,
+# so the capture loops wait here instead and only the heartbeat keeps probing. The first heartbeat
+# that comes back wakes them up again.
+import threading
+import time
+
+
+class PeerLiveness:
+    """Follows StatusHeartbeat.peer_alive() and wakes up waiting senders when the peer reappears."""
+
+    def __init__(self, heartbeat, on_change=None):
+        self.heartbeat = heartbeat
+        self.on_change = on_change
+        self.alive = False
+        self._lock = threading.Lock()
+        self._woken = threading.Event()
+        self._since = time.monotonic()
+        self.idle_seconds = 0.0  # total time spent without a peer
+        self.transitions = 0
+
+    def notify(self):
+        """Call this for every heartbeat received from the peer."""
+        self._woken.set()
+        self.check()
+
+    def check(self):
+        """Returns whether the peer is alive right now, calls on_change(alive) when that flips."""
+        alive = self.heartbeat.peer_alive()
+        with self._lock:
+            changed = alive != self.alive
+            if changed:
+                now = time.monotonic()
+                if not self.alive:
+                    self.idle_seconds += now - self._since
+                self._since = now
+                self.alive = alive
+                self.transitions += 1
+        if changed and self.on_change is not None:
+            self.on_change(alive)
+        return alive
+
+    def wait(self, timeout):
+        """Blocks until the peer is alive or timeout seconds passed, returns whether it is alive."""
+        if self.check():
+            return True
+        self._woken.clear()
+        self._woken.wait(timeout)
+        return self.check()
+
+    def report(self):
+        idle = self.idle_seconds
+        if not self.alive:
+            idle += time.monotonic() - self._since
+        state = "streaming" if self.alive else "idle, waiting for the other device"
+        return f"Senders: {state}, {idle:.0f} s idle in total, {self.transitions} transitions"
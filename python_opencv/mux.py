@@ -0,0 +1,56 @@
+# Carries every streamer channel (video, audio, status, float arrays) over a single udp socket.
+# Each datagram starts with packets.MUX_HEADER, one receive loop reads them all and hands the payload
+# to the handler registered for its channel. One port to open in the firewall instead of four.
+import packets
+from udp_batch import receive_loop
+
+
+class MuxTransport:
+    """Sends and receives typed datagrams on one socket."""
+
+    def __init__(self, sock, target):
+        self.sock = sock
+        self.target = target
+        self.handlers = {}
+        self._next_seq = {}
+        self.sent = 0
+        self.received = 0
+        self.malformed = 0
+        self.unhandled = 0
+
+    def register(self, channel, handler):
+        """handler(seq, timestamp, payload) is called from the receive loop for every datagram of channel."""
+        self.handlers[channel] = handler
+
+    def send(self, channel, payload, seq=None, timestamp=None, flags=0):
+        # Channels that don't count their own packets get a running number per channel
+        if seq is None:
+            seq = self._next_seq.get(channel, 0)
+            self._next_seq[channel] = packets.next_seq(seq)
+        if timestamp is None:
+            timestamp = packets.capture_timestamp()
+        header = packets.MUX_HEADER.pack(channel, flags, seq, timestamp)
+        # sendmsg glues header and payload together in the kernel, no copy of the payload here
+        try:
+            self.sock.sendmsg([header, payload], [], 0, self.target)
+        except BlockingIOError:
+            return  # socket buffer full (non blocking under asyncio), drop it like the network would
+        self.sent += 1
+
+    def dispatch(self, packet):
+        """Parses one datagram and calls the handler of its channel."""
+        packet = memoryview(packet)
+        if len(packet) < packets.MUX_HEADER.size:
+            self.malformed += 1
+            return
+        channel, flags, seq, timestamp = packets.MUX_HEADER.unpack_from(packet)
+        handler = self.handlers.get(channel)
+        if handler is None:
+            self.unhandled += 1
+            return
+        self.received += 1
+        handler(seq, timestamp, packet[packets.MUX_HEADER.size:])
+
+    def receive_loop(self, buffer_size, batch=False, pool=None, stop_event=None):
+        """Blocking loop that replaces the per channel receive threads, see udp_batch.receive_loop."""
+        receive_loop(self.sock, self.dispatch, buffer_size, batch, pool, stop_event)
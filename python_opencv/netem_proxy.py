@@ -0,0 +1,181 @@
+# UDP proxy that makes a local link behave like venue Wi-Fi, for testing the streamer without the venue.
+# Every --link listens on a port and forwards what arrives there to another address, after applying
+# loss (random or bursty Gilbert-Elliott), delay, jitter, reordering, duplication and a bandwidth cap.
+# Put one link in each direction of each port between two streamer12.py instances on the same machine.
+#
+#   python netem_proxy.py --loss 0.02 --delay 40 --jitter 10 \
+#       --link 6000:127.0.0.1:5000 --link 6001:127.0.0.1:5001,loss=0.1,rate=500
+#
+# Settings given after the comma only apply to that link, the rest come from the command line options.
+import argparse
+import heapq
+import json
+import random
+import selectors
+import socket
+import sys
+import time
+
+IMPAIRMENTS = dict(
+    loss=0.0,        # random loss probability
+    ge_p=0.0,        # Gilbert-Elliott: chance per packet to go from the good to the bad state
+    ge_r=1.0,        # Gilbert-Elliott: chance per packet to go from bad back to good
+    ge_bad_loss=1.0, # loss probability while in the bad state
+    delay=0.0,       # ms added to every packet
+    jitter=0.0,      # ms, standard deviation of extra random delay
+    reorder=0.0,     # probability a packet is held back by reorder_delay so later ones overtake it
+    reorder_delay=20.0,  # ms
+    duplicate=0.0,   # probability a packet is sent twice
+    rate=0.0,        # kbit/s bandwidth cap, 0 means unlimited
+    queue=200.0,     # ms of traffic the bandwidth cap may queue before dropping
+)
+
+
+class Link:
+    """One direction: listen_port -> target, with its own impairment settings and counters."""
+
+    def __init__(self, listen_port, target, settings, rng, bind_ip="127.0.0.1"):
+        self.name = f"{listen_port}->{target[0]}:{target[1]}"
+        self.target = target
+        self.settings = settings
+        self.rng = rng
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind((bind_ip, listen_port))
+        self.sock.setblocking(False)
+        self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.bad_state = False
+        self.link_free_at = 0.0  # when the bandwidth capped link is done sending what's queued
+        self.counts = dict(received=0, forwarded=0, lost=0, queue_drops=0, duplicated=0, reordered=0)
+
+    def impair(self, size, now):
+        """Decides the fate of one packet, returns (list of departure times, action)."""
+        s = self.settings
+        self.counts["received"] += 1
+
+        # Bursty loss: a two state Markov chain, the bad state loses most packets
+        if s["ge_p"] > 0:
+            if self.bad_state:
+                self.bad_state = self.rng.random() >= s["ge_r"]
+            else:
+                self.bad_state = self.rng.random() < s["ge_p"]
+            if self.bad_state and self.rng.random() < s["ge_bad_loss"]:
+                self.counts["lost"] += 1
+                return [], "lost_burst"
+        if self.rng.random() < s["loss"]:
+            self.counts["lost"] += 1
+            return [], "lost"
+
+        # Bandwidth cap: the packet leaves once everything before it went through the link
+        departure = now
+        if s["rate"] > 0:
+            start = max(now, self.link_free_at)
+            if start - now > s["queue"] / 1000:
+                self.counts["queue_drops"] += 1
+                return [], "queue_drop"
+            self.link_free_at = start + size * 8 / (s["rate"] * 1000)
+            departure = self.link_free_at
+
+        departure += s["delay"] / 1000
+        if s["jitter"] > 0:
+            departure += max(0.0, self.rng.gauss(0, s["jitter"] / 1000))
+        action = "forward"
+        if self.rng.random() < s["reorder"]:
+            departure += s["reorder_delay"] / 1000
+            self.counts["reordered"] += 1
+            action = "reorder"
+        departures = [departure]
+        if self.rng.random() < s["duplicate"]:
+            departures.append(departure + self.rng.uniform(0, 0.005))
+            self.counts["duplicated"] += 1
+            action = "duplicate" if action == "forward" else action + "+duplicate"
+        return departures, action
+
+
+def parse_link(spec, defaults):
+    """LISTEN_PORT:HOST:PORT[,key=value...] -> (listen_port, (host, port), settings)."""
+    address, _, overrides = spec.partition(",")
+    listen_port, host, port = address.split(":")
+    settings = dict(defaults)
+    for item in filter(None, overrides.split(",")):
+        key, _, value = item.partition("=")
+        if key not in IMPAIRMENTS:
+            raise ValueError(f"unknown impairment {key!r} in {spec!r}")
+        settings[key] = float(value)
+    return int(listen_port), (host, int(port)), settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP proxy that adds loss, delay, jitter, reordering, duplication "
+                                                 "and a bandwidth cap between two local streamer instances.")
+    parser.add_argument("--link", action="append", required=True, metavar="LISTEN:HOST:PORT[,key=value...]",
+                        help="forward datagrams arriving on LISTEN to HOST:PORT, repeat for every port and direction")
+    parser.add_argument("--bind", default="127.0.0.1", help="address the proxy listens on")
+    for key, default in IMPAIRMENTS.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=float, default=default, dest=key)
+    parser.add_argument("--seed", type=int, default=None, help="random seed, for repeatable runs")
+    parser.add_argument("--log", default=None, help="write one JSON line per packet decision to this file")
+    parser.add_argument("--summary", type=float, default=5.0, help="seconds between summary lines, 0 for none")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    defaults = {key: getattr(args, key) for key in IMPAIRMENTS}
+    links = []
+    for spec in args.link:
+        listen_port, target, settings = parse_link(spec, defaults)
+        links.append(Link(listen_port, target, settings, rng, args.bind))
+
+    log = open(args.log, "w") if args.log else None
+    selector = selectors.DefaultSelector()
+    for link in links:
+        selector.register(link.sock, selectors.EVENT_READ, link)
+        print(f"{link.name}: {json.dumps({k: v for k, v in link.settings.items() if v != IMPAIRMENTS[k]})}")
+
+    pending = []  # heap of (departure time, counter, link, data)
+    counter = 0
+    start = time.monotonic()
+    next_summary = start + args.summary if args.summary > 0 else float("inf")
+    try:
+        while True:
+            now = time.monotonic()
+            timeout = max(0.0, min(pending[0][0] if pending else now + 0.5, next_summary) - now)
+            for key, _ in selector.select(timeout):
+                link = key.data
+                while True:
+                    try:
+                        data = link.sock.recv(65535)
+                    except BlockingIOError:
+                        break
+                    now = time.monotonic()
+                    departures, action = link.impair(len(data), now)
+                    for departure in departures:
+                        heapq.heappush(pending, (departure, counter, link, data))
+                        counter += 1
+                    if log is not None:
+                        log.write(json.dumps(dict(t=round(now - start, 6), link=link.name, action=action, size=len(data),
+                                                  delay_ms=[round((d - now) * 1000, 3) for d in departures])) + "\n")
+
+            now = time.monotonic()
+            while pending and pending[0][0] <= now:
+                _, _, link, data = heapq.heappop(pending)
+                try:
+                    link.out.sendto(data, link.target)
+                    link.counts["forwarded"] += 1
+                except OSError:
+                    pass  # nobody listening on the other side yet
+
+            if now >= next_summary:
+                for link in links:
+                    print(f"[{now - start:7.1f}s] {link.name}: {link.counts}")
+                next_summary += args.summary
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for link in links:
+            print(f"{link.name}: {link.counts}", file=sys.stderr)
+        if log is not None:
+            log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# Small helpers shared by the streamer for the headers we put in front of udp payloads.
+import struct
+import time
+
+# Audio and video datagrams start with a 16 bit sequence number, so the receiver can spot lost packets,
+# and the 32 bit capture time in milliseconds, so it can line audio and video back up
+MEDIA_HEADER = struct.Struct("!HI")
+
+# With --mux every channel shares one socket and this header tells them apart:
+# channel, flags, 16 bit sequence number and 32 bit capture time in milliseconds
+MUX_HEADER = struct.Struct("!BBHI")
+
+CHANNEL_VIDEO = 0
+CHANNEL_AUDIO = 1
+CHANNEL_STATUS = 2
+CHANNEL_TELEMETRY = 3
+
+SEQ_MODULO = 1 << 16
+TIMESTAMP_MODULO = 1 << 32
+
+
+def next_seq(seq):
+    """Returns the sequence number that follows seq, wrapping at 16 bits."""
+    return (seq + 1) % SEQ_MODULO
+
+
+def seq_delta(seq, expected):
+    """Signed distance from expected to seq, taking the 16 bit wrap around into account.
+    0 means seq is the one we expected, >0 means packets were skipped, <0 means seq is late."""
+    delta = (seq - expected) % SEQ_MODULO
+    if delta >= SEQ_MODULO // 2:
+        delta -= SEQ_MODULO
+    return delta
+
+
+def capture_timestamp(offset=0.0):
+    """Monotonic clock in milliseconds as it goes on the wire, offset (seconds) lets callers backdate it."""
+    return int((time.monotonic() + offset) * 1000) % TIMESTAMP_MODULO
+
+
+def timestamp_delta(a, b):
+    """Signed a - b in milliseconds for two wire timestamps, wrap around included."""
+    delta = (a - b) % TIMESTAMP_MODULO
+    if delta >= TIMESTAMP_MODULO // 2:
+        delta -= TIMESTAMP_MODULO
+    return delta
@@ -0,0 +1,152 @@
+# Per stage timing of the streamer (cap.read, detection, resize, encode, send, decode, show...).
+# Every thread writes its spans into its own preallocated ring buffer, so recording takes no lock and
+# allocates nothing, and only the newest `capacity` spans per thread are kept. Turned off, span() hands
+# back one shared do-nothing context manager.
+# write_chrome_trace() output opens in chrome://tracing or ui.perfetto.dev, summary() is a table of
+# per stage percentiles. An observer (name, seconds) gets every span as well, that is how the stage
+# timings end up in the metrics without recording a trace.
+import contextlib
+import json
+import threading
+import time
+
+import numpy as np
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _ThreadSpans:
+    """Ring buffer of one thread: stage id, start and end in ns."""
+
+    def __init__(self, capacity, thread):
+        self.thread_name = thread.name
+        self.thread_id = thread.native_id or thread.ident
+        self.stage = np.zeros(capacity, dtype=np.int32)
+        self.start = np.zeros(capacity, dtype=np.int64)
+        self.end = np.zeros(capacity, dtype=np.int64)
+        self.capacity = capacity
+        self.written = 0
+
+    def add(self, stage, start, end):
+        i = self.written % self.capacity
+        self.stage[i] = stage
+        self.start[i] = start
+        self.end[i] = end
+        self.written += 1
+
+    def spans(self):
+        """(stage, start, end) arrays of what is in the ring, oldest first."""
+        n = min(self.written, self.capacity)
+        order = (np.arange(self.written - n, self.written)) % self.capacity
+        return self.stage[order], self.start[order], self.end[order]
+
+
+class _Span:
+    __slots__ = ("profiler", "stage", "start")
+
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._record(self.stage, self.start, time.perf_counter_ns())
+        return False
+
+
+class Profiler:
+    """Records named spans per thread when record is on, passes them to observer when there is one."""
+
+    def __init__(self, record=False, capacity=65536, observer=None):
+        self.record = record
+        self.observer = observer
+        self.enabled = record or observer is not None
+        self.capacity = capacity
+        self._stages = {}  # name -> id
+        self._names = []
+        self._buffers = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+
+    def span(self, name):
+        """with profiler.span("imencode"): ... times the block."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, self._stage(name))
+
+    def _stage(self, name):
+        stage = self._stages.get(name)
+        if stage is None:
+            with self._lock:
+                stage = self._stages.setdefault(name, len(self._names))
+                if stage == len(self._names):
+                    self._names.append(name)
+        return stage
+
+    def _record(self, stage, start, end):
+        if self.record:
+            self._buffer().add(stage, start, end)
+        if self.observer is not None:
+            self.observer(self._names[stage], (end - start) / 1e9)
+
+    def _buffer(self):
+        buffer = getattr(self._local, "spans", None)
+        if buffer is None:
+            buffer = _ThreadSpans(self.capacity, threading.current_thread())
+            self._local.spans = buffer
+            with self._lock:
+                self._buffers.append(buffer)
+        return buffer
+
+    def durations(self):
+        """stage name -> numpy array of durations in ms, every thread together."""
+        with self._lock:
+            buffers = list(self._buffers)
+            names = list(self._names)
+        per_stage = {}
+        for buffer in buffers:
+            stages, starts, ends = buffer.spans()
+            for stage in np.unique(stages):
+                selected = stages == stage
+                per_stage.setdefault(names[stage], []).append((ends[selected] - starts[selected]) / 1e6)
+        return {name: np.concatenate(parts) for name, parts in per_stage.items()}
+
+    def summary(self):
+        """Per stage percentiles as plain data: {name: {count, mean, p50, p90, p99, max}} in ms."""
+        result = {}
+        for name, values in self.durations().items():
+            p50, p90, p99 = np.percentile(values, (50, 90, 99))
+            result[name] = dict(count=len(values), mean=float(values.mean()), p50=float(p50), p90=float(p90),
+                                p99=float(p99), max=float(values.max()))
+        return result
+
+    def report(self):
+        """summary() as a table, slowest stage (by p99) first."""
+        summary = self.summary()
+        if not summary:
+            return "No spans recorded"
+        lines = [f"{'stage':<16}{'count':>8}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)"]
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]["p99"]):
+            lines.append(f"{name:<16}{s['count']:>8}{s['mean']:>9.2f}{s['p50']:>9.2f}{s['p90']:>9.2f}"
+                         f"{s['p99']:>9.2f}{s['max']:>9.2f}")
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path):
+        """Writes every span in the Chrome trace event format (chrome://tracing, ui.perfetto.dev)."""
+        with self._lock:
+            buffers = list(self._buffers)
+            names = list(self._names)
+        events = []
+        for buffer in buffers:
+            events.append(dict(name="thread_name", ph="M", pid=1, tid=buffer.thread_id,
+                               args=dict(name=buffer.thread_name)))
+            stages, starts, ends = buffer.spans()
+            for stage, start, end in zip(stages.tolist(), starts.tolist(), ends.tolist()):
+                events.append(dict(name=names[stage], ph="X", pid=1, tid=buffer.thread_id,
+                                   ts=(start - self._origin) / 1000, dur=(end - start) / 1000))
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
@@ -0,0 +1,56 @@
+# Forwards the datagrams of one port between two devices that can't reach each other directly (different
+# networks, only the relay machine is reachable from both). One side is fixed, the target; the other side
+# is whoever last sent us something that isn't the target, so a device can come back from a new address.
+# Nothing is looked at or decoded, the payload goes out exactly as it came in.
+import logging
+import socket
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.5  # how often a waiting relay looks at the stop event
+
+
+class Relay:
+    """Datagrams from target go to the other side, everything else goes to (target ip, target port)."""
+
+    def __init__(self, name, sock, target, buffer_size=65536):
+        self.name = name
+        self.sock = sock
+        self.target = target
+        self.buffer_size = buffer_size
+        self.other = None  # address of the other side, learned from what it sends
+        self.forwarded = 0
+        self.dropped = 0  # from the target before the other side was known
+
+    def run(self, stop_event):
+        self.sock.settimeout(POLL_INTERVAL)
+        buffer = bytearray(self.buffer_size)
+        while not stop_event.is_set():
+            try:
+                size, address = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            except ConnectionResetError:
+                continue  # the last sendto bounced (windows reports that here), nothing to do about it
+            except OSError:
+                break  # socket closed on shutdown
+            if address[0] == self.target[0]:
+                destination = self.other
+            else:
+                if address != self.other:
+                    log.info("Relay %s: other side is %s:%d", self.name, *address)
+                    self.other = address
+                destination = self.target
+            if destination is None:
+                self.dropped += 1
+                continue
+            try:
+                self.sock.sendto(memoryview(buffer)[:size], destination)
+                self.forwarded += 1
+            except OSError:
+                self.dropped += 1
+
+    def report(self):
+        other = f"{self.other[0]}:{self.other[1]}" if self.other else "nobody yet"
+        return (f"Relay {self.name}: {self.target[0]}:{self.target[1]} <-> {other}, "
+                f"{self.forwarded} forwarded, {self.dropped} dropped")
@@ -0,0 +1,381 @@
+# Stand-ins for the cameras, microphones, window and speaker, so the streamer runs on a box without
+# any of them (a laptop, a headless linux machine for benchmarks).
+# Video sources act like cv2.VideoCapture (isOpened/read/release) and audio sources like
+# AudioCaptureManager (read/select/open_device/close), the streamer doesn't know the difference.
+# Everything is paced in real time the way the hardware would be: read() blocks until the next frame
+# or chunk is due, the sinks take as long to "play" a chunk as a speaker would.
+#
+# Specs on the command line are kind[:argument], see open_video_source() and friends.
+import glob
+import math
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+
+import packets
+
+cv2 = None  # loaded by the video classes, so the audio only roles never import OpenCV
+
+
+def _load_cv2():
+    global cv2
+    if cv2 is None:
+        import cv2 as module
+        cv2 = module
+
+
+def parse_spec(spec):
+    """'file:clip.mp4' -> ('file', 'clip.mp4'), 'null' -> ('null', '')."""
+    kind, _, argument = spec.partition(":")
+    return kind, argument
+
+
+class Pacer:
+    """Sleeps until the next tick of a fixed interval, skips ahead instead of bursting when late."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = None
+        self._lock = threading.Lock()
+
+    def wait(self, stop_event=None):
+        """Returns True if stop_event got set while waiting."""
+        with self._lock:
+            now = time.monotonic()
+            if self._next is None or now - self._next > self.interval:
+                self._next = now
+            due = self._next
+            self._next += self.interval
+        delay = due - time.monotonic()
+        if delay > 0:
+            if stop_event is not None:
+                return stop_event.wait(delay)
+            time.sleep(delay)
+        return False
+
+
+class FileVideoSource:
+    """Loops a video file, or a sorted image sequence (directory or glob), at a fixed fps."""
+
+    def __init__(self, path, fps=30.0):
+        _load_cv2()
+        self.path = path
+        self.pacer = Pacer(1.0 / fps)
+        self._lock = threading.Lock()
+        self._capture = None
+        self._images = []
+        self._position = 0
+        if os.path.isdir(path):
+            path = os.path.join(path, "*")
+        if any(c in path for c in "*?["):
+            # Decoded once, a sequence is meant to be short (a few seconds of a test scene)
+            frames = (cv2.imread(name) for name in sorted(glob.glob(path)))
+            self._images = [frame for frame in frames if frame is not None]
+        else:
+            self._capture = cv2.VideoCapture(path)
+
+    def isOpened(self):
+        return bool(self._images) or (self._capture is not None and self._capture.isOpened())
+
+    def read(self):
+        self.pacer.wait()
+        with self._lock:
+            if self._images:
+                frame = self._images[self._position]
+                self._position = (self._position + 1) % len(self._images)
+                return True, frame.copy()
+            if self._capture is None:
+                return False, None
+            ret, frame = self._capture.read()
+            if not ret:
+                # End of the file, start over (reopening works for every container, seeking doesn't)
+                self._capture.release()
+                self._capture = cv2.VideoCapture(self.path)
+                ret, frame = self._capture.read()
+            return ret, frame
+
+    def release(self):
+        with self._lock:
+            if self._capture is not None:
+                self._capture.release()
+                self._capture = None
+            self._images = []
+
+
+class SyntheticVideoSource:
+    """Moving test pattern with a cartoon face wandering around it.
+    The face comes and goes (visible for face_duty of every face_period seconds) so the eye detection
+    and the overlay switching get exercised too."""
+
+    def __init__(self, size=(1280, 720), fps=30.0, face_period=10.0, face_duty=0.6):
+        _load_cv2()
+        self.size = size
+        self.pacer = Pacer(1.0 / fps)
+        self.face_period = face_period
+        self.face_duty = face_duty
+        self._start = time.monotonic()
+        width, height = size
+        # Static part of the background, the moving bar goes on top of a copy each frame
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)
+        self._background = np.dstack([np.tile(x, (height, 1)), np.tile(y[:, None], (1, width)),
+                                      np.full((height, width), 96, np.float32)]).astype(np.uint8)
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        self.pacer.wait()
+        t = time.monotonic() - self._start
+        width, height = self.size
+        frame = self._background.copy()
+        bar = int((t * 0.25 % 1.0) * width)
+        frame[:, bar:bar + width // 20] = 255 - frame[:, bar:bar + width // 20]
+        if t % self.face_period < self.face_period * self.face_duty:
+            # Lissajous path, so the face doesn't sit in the same spot
+            cx = int(width * (0.5 + 0.3 * math.sin(t * 0.7)))
+            cy = int(height * (0.5 + 0.25 * math.sin(t * 1.1)))
+            self._draw_face(frame, cx, cy, height // 4)
+        cv2.putText(frame, f"{t:8.2f}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
+        return True, frame
+
+    @staticmethod
+    def _draw_face(frame, cx, cy, radius):
+        cv2.circle(frame, (cx, cy), radius, (150, 190, 230), -1)
+        for side in (-1, 1):
+            eye = (cx + side * radius * 2 // 5, cy - radius // 5)
+            cv2.ellipse(frame, eye, (radius // 5, radius // 8), 0, 0, 360, (255, 255, 255), -1)
+            cv2.circle(frame, eye, radius // 12, (40, 30, 20), -1)
+        cv2.ellipse(frame, (cx, cy + radius // 3), (radius // 3, radius // 8), 0, 0, 180, (60, 60, 160), 3)
+
+    def release(self):
+        pass
+
+
+class PacedAudioSource:
+    """Base for the fake microphones: read() hands out one chunk per chunk duration, like a device would.
+    Subclasses fill in _samples(n) returning n int16 samples per channel."""
+
+    def __init__(self, rate, chunk, channels=1):
+        self.rate = rate
+        self.chunk = chunk
+        self.channels = channels
+        self.pacer = Pacer(chunk / rate)
+
+    def open_device(self, index):
+        return True
+
+    def select(self, index):
+        return True
+
+    def read(self, timeout=1.0):
+        self.pacer.wait()
+        samples = self._samples(self.chunk)
+        if self.channels > 1:
+            samples = np.repeat(samples, self.channels)
+        return samples.astype(np.int16).tobytes(), packets.capture_timestamp(-self.chunk / self.rate)
+
+    def _samples(self, n):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ToneAudioSource(PacedAudioSource):
+    """Sine tone, beeping on and off so lost or late audio is easy to hear."""
+
+    def __init__(self, rate, chunk, channels=1, frequency=440.0, amplitude=0.3, beep=0.5):
+        super().__init__(rate, chunk, channels)
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.beep = beep
+        self._position = 0
+
+    def _samples(self, n):
+        t = (self._position + np.arange(n)) / self.rate
+        self._position += n
+        tone = np.sin(2 * np.pi * self.frequency * t) * self.amplitude * 32767
+        if self.beep:
+            tone *= (t % (2 * self.beep)) < self.beep
+        return tone
+
+
+class WavAudioSource(PacedAudioSource):
+    """Loops a 16 bit wav file, mixed down to mono and resampled to the stream rate if needed."""
+
+    def __init__(self, path, rate, chunk, channels=1):
+        super().__init__(rate, chunk, channels)
+        with wave.open(path, "rb") as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError(f"{path}: only 16 bit wav files are supported")
+            data = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+            samples = data.reshape(-1, wav.getnchannels()).mean(axis=1)
+            if wav.getframerate() != rate:
+                positions = np.arange(0, len(samples), wav.getframerate() / rate)
+                samples = np.interp(positions, np.arange(len(samples)), samples)
+        if len(samples) == 0:
+            raise ValueError(f"{path}: no audio in the file")
+        self._data = samples.astype(np.int16)
+        self._position = 0
+
+    def _samples(self, n):
+        indices = (self._position + np.arange(n)) % len(self._data)
+        self._position = (self._position + n) % len(self._data)
+        return self._data[indices]
+
+
+class WindowVideoSink:
+    """The fullscreen OpenCV window the installation normally shows."""
+
+    def __init__(self, name="Camera Stream"):
+        _load_cv2()
+        self.name = name
+        self.frames = 0
+        cv2.namedWindow(name, cv2.WINDOW_FULLSCREEN)
+        cv2.setWindowProperty(name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+    def show(self, frame):
+        cv2.imshow(self.name, frame)
+        self.frames += 1
+
+    def quit_requested(self):
+        """Keeps the window responsive, True when q was pressed."""
+        return cv2.waitKey(1) & 0xFF == ord('q')
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+
+class NullVideoSink:
+    """Throws frames away, only counts them."""
+
+    def __init__(self):
+        self.frames = 0
+
+    def show(self, frame):
+        self.frames += 1
+
+    def quit_requested(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class FileVideoSink(NullVideoSink):
+    """Writes what would be shown into a video file (MJPG, any player opens it)."""
+
+    def __init__(self, path, fps=30.0):
+        _load_cv2()
+        super().__init__()
+        self.path = path
+        self.fps = fps
+        self._writer = None
+
+    def show(self, frame):
+        # The size is only known once the first frame is there
+        if self._writer is None:
+            height, width = frame.shape[:2]
+            self._writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*"MJPG"), self.fps, (width, height))
+        self._writer.write(frame)
+        self.frames += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+
+class NullAudioSink:
+    """Stands in for a PyAudio output stream: write() takes as long as playing the chunk would."""
+
+    def __init__(self, rate, channels=1):
+        self.rate = rate
+        self.channels = channels
+        self._pacer = None
+        self.chunks = 0
+
+    def write(self, chunk):
+        samples = len(chunk) // (2 * self.channels)
+        if self._pacer is None:
+            self._pacer = Pacer(samples / self.rate)
+        self._pacer.wait()
+        self.chunks += 1
+
+    def get_output_latency(self):
+        return 0.0
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class WavAudioSink(NullAudioSink):
+    """Records what would be played into a 16 bit wav file."""
+
+    def __init__(self, path, rate, channels=1):
+        super().__init__(rate, channels)
+        self._wav = wave.open(path, "wb")
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(rate)
+
+    def write(self, chunk):
+        self._wav.writeframes(chunk)
+        super().write(chunk)
+
+    def close(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+def open_video_source(spec, fps=30.0):
+    """file:PATH (video or image sequence), synthetic, or camera:N. Returns something that reads like a VideoCapture."""
+    kind, argument = parse_spec(spec)
+    if kind == "file":
+        return FileVideoSource(argument, fps)
+    if kind == "synthetic":
+        return SyntheticVideoSource(fps=fps)
+    if kind == "camera":
+        _load_cv2()
+        return cv2.VideoCapture(int(argument or 0))
+    raise ValueError(f"unknown video source {spec!r}, use file:PATH, synthetic or camera:N")
+
+
+def open_audio_source(spec, rate, chunk, channels=1):
+    """tone[:HZ] or wav:PATH. Microphones are opened by the streamer itself (AudioCaptureManager)."""
+    kind, argument = parse_spec(spec)
+    if kind == "tone":
+        return ToneAudioSource(rate, chunk, channels, frequency=float(argument or 440))
+    if kind == "wav":
+        return WavAudioSource(argument, rate, chunk, channels)
+    raise ValueError(f"unknown audio source {spec!r}, use mic, tone[:HZ] or wav:PATH")
+
+
+def open_video_sink(spec, fps=30.0):
+    """window, null or file:PATH."""
+    kind, argument = parse_spec(spec)
+    if kind == "window":
+        return WindowVideoSink()
+    if kind == "null":
+        return NullVideoSink()
+    if kind == "file":
+        return FileVideoSink(argument, fps)
+    raise ValueError(f"unknown video sink {spec!r}, use window, null or file:PATH")
+
+
+def open_audio_sink(spec, rate, channels=1):
+    """null or wav:PATH. The speaker is opened by the streamer itself (PyAudio)."""
+    kind, argument = parse_spec(spec)
+    if kind == "null":
+        return NullAudioSink(rate, channels)
+    if kind == "wav":
+        return WavAudioSink(argument, rate, channels)
+    raise ValueError(f"unknown audio sink {spec!r}, use speaker, null or wav:PATH")
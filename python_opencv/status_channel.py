@@ -0,0 +1,124 @@
+# Periodic status heartbeat between the two installations.
+# Instead of one "0"/"1" datagram when the overlay flips (gone for good if it gets lost) we send the whole
+# state every interval seconds, and a few quick repeats right after it changes. The epoch goes up on every
+# change so an old or reordered heartbeat can't undo a newer one, and the time since the last heartbeat
+# tells us whether the other side is still there.
+import random
+import struct
+import threading
+import time
+
+# version, flags, session, epoch, detection confidence, width, height, jpeg quality, fps
+STATE = struct.Struct("!BBHIfHHBB")
+STATE_VERSION = 1
+FLAG_OVERLAY = 0x01
+
+
+class StatusHeartbeat:
+    """Sends our state periodically and keeps track of what the peer last told us."""
+
+    def __init__(self, send, interval=0.5, repeats=3, repeat_interval=0.05, timeout=2.0):
+        self.send = send
+        self.interval = interval
+        self.repeats = repeats
+        self.repeat_interval = repeat_interval
+        self.timeout = timeout
+        # A new session number each run, so the peer doesn't ignore us after a restart resets the epoch
+        self.session = random.randrange(1 << 16)
+        self.epoch = 0
+        self.state = dict(overlay=False, confidence=0.0, width=0, height=0, quality=0, fps=0)
+        self._lock = threading.Lock()
+        self._next_send = 0.0
+        self._repeats_left = 0
+
+        self.peer = None  # last state the peer sent, same keys as self.state
+        self.peer_session = None
+        self.peer_epoch = None
+        self.peer_last_seen = None
+        self.sent = 0
+        self.received = 0
+        self.stale = 0
+
+    def update(self, **changes):
+        """Updates our state. Overlay and stream parameter changes go out at once and get repeated,
+        confidence and fps just ride along with the next heartbeat."""
+        with self._lock:
+            important = any(key not in ("confidence", "fps") and self.state.get(key) != value
+                            for key, value in changes.items())
+            self.state.update(changes)
+            if not important:
+                return
+            self.epoch = (self.epoch + 1) % (1 << 32)
+            self._repeats_left = self.repeats
+        self._send_now()
+
+    def tick(self):
+        """Call this often (every repeat_interval or so), it sends whatever heartbeat is due."""
+        now = time.monotonic()
+        with self._lock:
+            due = now >= self._next_send
+        if due:
+            self._send_now()
+
+    def run(self, stop_event):
+        """Blocking loop for the threaded streamer."""
+        while not stop_event.is_set():
+            self.tick()
+            stop_event.wait(self.repeat_interval)
+
+    def _send_now(self):
+        with self._lock:
+            state = self.state
+            payload = STATE.pack(STATE_VERSION, FLAG_OVERLAY if state["overlay"] else 0, self.session, self.epoch,
+                                 state["confidence"], state["width"], state["height"],
+                                 min(state["quality"], 255), min(int(state["fps"]), 255))
+            if self._repeats_left > 0:
+                self._repeats_left -= 1
+                self._next_send = time.monotonic() + self.repeat_interval
+            else:
+                self._next_send = time.monotonic() + self.interval
+        self.send(payload)
+        self.sent += 1
+
+    def receive(self, payload):
+        """Takes a heartbeat from the peer, returns True if it is newer than what we had."""
+        if len(payload) < STATE.size:
+            return False
+        version, flags, session, epoch, confidence, width, height, quality, fps = STATE.unpack_from(payload)
+        if version != STATE_VERSION:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self.received += 1
+            # Any heartbeat proves the peer is alive, even one we don't take the state from
+            self.peer_last_seen = now
+            if session == self.peer_session and self.peer_epoch is not None:
+                age = (self.peer_epoch - epoch) % (1 << 32)
+                if 0 < age < (1 << 31):
+                    self.stale += 1
+                    return False
+            self.peer_session = session
+            self.peer_epoch = epoch
+            self.peer = dict(overlay=bool(flags & FLAG_OVERLAY), confidence=confidence, width=width,
+                             height=height, quality=quality, fps=fps)
+        return True
+
+    def peer_age(self):
+        """Seconds since the last heartbeat from the peer, None if we never heard from it."""
+        if self.peer_last_seen is None:
+            return None
+        return time.monotonic() - self.peer_last_seen
+
+    def peer_alive(self):
+        age = self.peer_age()
+        return age is not None and age < self.timeout
+
+    def report(self):
+        age = self.peer_age()
+        if age is None:
+            return f"Peer: never heard from it, sent {self.sent} heartbeats"
+        state = "alive" if self.peer_alive() else "silent"
+        peer = self.peer
+        return (f"Peer: {state}, last heartbeat {age:.2f} s ago, overlay {peer['overlay']}, confidence "
+                f"{peer['confidence']:.2f}, {peer['width']}x{peer['height']} q{peer['quality']} {peer['fps']} fps, "
+                f"epoch {self.peer_epoch}, heartbeats sent {self.sent} received {self.received} stale {self.stale}")
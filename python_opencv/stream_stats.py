@@ -0,0 +1,112 @@
+# Counters for benchmarking the streamer: datagrams and bytes per channel, how old frames are when they
+# reach the screen, and how much cpu each thread used. streamer12.py --stats-file writes snapshot()
+# as json when it exits, bench_streamer.py reads those.
+import collections
+import os
+import threading
+import time
+
+import numpy as np
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    """{'p50': ..., 'p90': ..., 'p99': ...} of values, None for each when there are none."""
+    if len(values) == 0:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": float(v) for q, v in zip(qs, np.percentile(np.asarray(values, dtype=np.float64), qs))}
+
+
+_IMPORTED = time.monotonic()
+
+
+def process_age():
+    """Seconds since this process started (interpreter start up included), from /proc where it's there."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return time.monotonic() - _IMPORTED
+
+
+def thread_cpu():
+    """Cpu seconds (user + system) of every live python thread by name, empty where /proc isn't there."""
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    usage = {}
+    for thread in threading.enumerate():
+        try:
+            with open(f"/proc/self/task/{thread.native_id}/stat") as f:
+                # The command name can contain spaces, the fields we want come after its closing bracket
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError, TypeError):
+            continue
+        usage[thread.name] = (int(fields[11]) + int(fields[12])) / ticks
+    return usage
+
+
+class StreamStats:
+    """Thread safe counters, keeps the newest latency_samples frame latencies."""
+
+    def __init__(self, latency_samples=10000):
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self.counters = collections.Counter()
+        self.channels_sent = collections.defaultdict(lambda: [0, 0])  # channel -> [datagrams, bytes]
+        self.channels_received = collections.defaultdict(lambda: [0, 0])
+        self.latencies_ms = collections.deque(maxlen=latency_samples)
+        self.first_frame_s = {}  # "captured", "shown"... -> seconds after the process started
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def sent(self, channel, size):
+        with self._lock:
+            entry = self.channels_sent[channel]
+            entry[0] += 1
+            entry[1] += size
+
+    def received(self, channel, size):
+        with self._lock:
+            entry = self.channels_received[channel]
+            entry[0] += 1
+            entry[1] += size
+
+    def first(self, name):
+        """Remembers when the first frame got to name, returns True only that first time."""
+        if name in self.first_frame_s:
+            return False
+        with self._lock:
+            if name in self.first_frame_s:
+                return False
+            self.first_frame_s[name] = process_age()
+            return True
+
+    def frame_latency(self, ms):
+        """Capture to screen time of one displayed frame."""
+        self.latencies_ms.append(ms)
+
+    def snapshot(self, channel_names=None):
+        """Everything as plain json-able data, channel_names maps channel numbers to readable names."""
+        channel_names = channel_names or {}
+        with self._lock:
+            elapsed = time.monotonic() - self._start
+            sent = {channel_names.get(c, str(c)): dict(datagrams=d, bytes=b) for c, (d, b) in self.channels_sent.items()}
+            received = {channel_names.get(c, str(c)): dict(datagrams=d, bytes=b)
+                        for c, (d, b) in self.channels_received.items()}
+            counters = dict(self.counters)
+            first_frame = dict(self.first_frame_s)
+        return dict(
+            elapsed_s=elapsed,
+            counters=counters,
+            sent=sent,
+            received=received,
+            bytes_sent=sum(entry["bytes"] for entry in sent.values()),
+            bytes_received=sum(entry["bytes"] for entry in received.values()),
+            frame_latency_ms=percentiles(list(self.latencies_ms)),
+            time_to_first_frame_s=first_frame,
+            process_cpu_s=time.process_time(),
+            thread_cpu_s=thread_cpu(),
+        )
@@ -1,180 +1,699 @@
 import socket
-import cv2
-import pyaudio
 import threading
 import numpy as np
 import sys
+import os
+import argparse
+import asyncio
+import queue
+import time
+import json
+import concurrent.futures
 
-# Load the cascade, its basically a machine learning algorithm thing for eye detection, dont worry too much about it but you DO need that xml file in the same dir as this script.
-face_cascade = cv2.CascadeClassifier('haarcascade_eye.xml')
+import packets
+from mux import MuxTransport
+from async_core import AsyncCore
+from status_channel import StatusHeartbeat
+from liveness import PeerLiveness
+from telemetry import TelemetryRing, TelemetrySender, make_schema
+from udp_batch import receive_loop
+from buffer_pool import BufferPool
+from audio_plc import PacketLossConcealer
+from av_sync import AVSyncScheduler
+import sources
+from stream_stats import StreamStats, process_age
+from profiler import Profiler
+from flight_recorder import FlightRecorder
+from governor import QualityGovernor
+from capture import ManagedCapture
+from control import ControlServer
+from relay import Relay
+from device_cache import DeviceCache, DEFAULT_PATH as DEVICE_CACHE_PATH
+
+# Modules shared with the other scripts of the installation
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import metrics
+import logs
+import scheduling
+from pipeline import Pipeline
+
+# The cascade, its basically a machine learning algorithm thing for eye detection, dont worry too much about it but you DO need that xml file in the same dir as this script.
+# Loaded in parallel with the cameras and audio, see initialize_devices()
+face_cascade = None
 framesWithEyes = 0
 framesWithEyesLimit = 20
 # Constants
 BUFFER_SIZE = 65535
 AUDIO_RATE = 44100
 AUDIO_CHUNK = 1024
-AUDIO_FORMAT = pyaudio.paInt16
+AUDIO_FORMAT = None  # pyaudio.paInt16, set when pyaudio gets imported
 AUDIO_CHANNELS = 1
+LIPSYNC_TOLERANCE = 0.045  # seconds video may be off from the audio before we drop or hold frames
+VIDEO_SIZE = (320, 180)  # resolution we send the camera at, --video-size
+JPEG_QUALITY = 30  # --jpeg-quality
+HEARTBEAT_INTERVAL = 0.5  # seconds between status heartbeats when nothing changes
+RECEIVE_POLL_INTERVAL = 0.5  # how often a threaded receive loop looks at the stop event while nothing arrives
+SHUTDOWN_TIMEOUT = 2.0  # how long shutdown waits for each worker thread before closing the sockets anyway
+PEER_TIMEOUT = 2.0  # seconds without a heartbeat before we consider the other device gone
+RECEIVE_BUFFERS = 32  # preallocated receive buffers shared by the receive loops
+TELEMETRY_FIELDS = [("gx", "f4"), ("gy", "f4"), ("gz", "f4")]  # name and numpy dtype of each telemetry value
+TELEMETRY_MAX_DELAY = 0.05  # seconds a telemetry sample may wait for others to share a datagram with
+IDLE_PROBE_INTERVAL = 0.05  # how often idle senders look at the liveness again under --asyncio
+# What each --role runs: sending the camera, eye detection driving the overlay, showing the peer's video,
+# sending the microphone, playing the peer's audio. relay runs none of them and only forwards datagrams
+ROLES = {
+    "full": {"video-send", "detector", "display", "audio-send", "playback"},
+    "video-send": {"video-send", "detector"},
+    "display": {"display"},
+    "audio": {"audio-send", "playback"},
+    "detector": {"detector"},
+    "relay": set(),
+}
 
 # Default device indices
 video_capture_indices = []  
-audio_input_index = 0    
+audio_input_indices = [0, 1]  # microphone used normally, microphone used when both overlays are on
 current_camera_index = 0  
 
+# Set when the streamer shuts down, every loop checks it instead of relying on daemon threads being killed
+stop_event = threading.Event()
+core = None  # AsyncCore when running with --asyncio
+video_pipeline = None  # capture -> encode -> send without --asyncio
+relays = []  # one Relay per forwarded port with --role relay
+workers = []  # threads started by the threaded streamer, joined on shutdown before the sockets close
+
 # Overlay status for both devices
 overlay_status = False  # Local overlay status
 remote_overlay_status = False  # Remote device's overlay status
 
 # Get target IP and ports from command-line arguments
-if len(sys.argv) < 3:
-    print("Usage: python script.py <target_ip> <video_port>")
-    sys.exit(1)
+parser = argparse.ArgumentParser(description="Streams camera and microphone to the other installation and shows what it sends back.")
+parser.add_argument("target_ip", help="IP address of the other device running this script")
+parser.add_argument("video_port", type=int, help="port for the camera stream (same on both devices)")
+parser.add_argument("--role", choices=list(ROLES), default="full",
+                    help="run only part of the streamer (and load only what that part needs): video-send, display, audio, "
+                         "detector, or relay to forward everything between target_ip and whoever sends to us")
+parser.add_argument("--mux", action="store_true",
+                    help="send audio, status and telemetry over the video port too, one socket instead of four")
+parser.add_argument("--asyncio", action="store_true",
+                    help="run the sockets on an asyncio event loop instead of one receive thread per socket")
+parser.add_argument("--udp-batch", action="store_true",
+                    help="let linux hand us several datagrams per receive call (UDP_GRO), falls back by itself where unsupported, no effect with --asyncio")
+parser.add_argument("--no-idle", action="store_true",
+                    help="keep capturing and sending at full rate even while the other device is silent")
+parser.add_argument("--audio-port", type=int, default=10003, help="port for the audio stream")
+parser.add_argument("--status-port", type=int, default=9999, help="port for exchanging overlay status")
+parser.add_argument("--telemetry-port", type=int, default=10004, help="port for telemetry (gyro data and such)")
+parser.add_argument("--port-offset", type=int, default=0,
+                    help="added to every port this device listens on, so two instances fit on one machine")
+parser.add_argument("--remote-port-offset", type=int, default=0,
+                    help="added to every port we send to, e.g. the other instance's --port-offset or a netem_proxy.py in between")
+parser.add_argument("--bind", default="0.0.0.0", help="local address to listen on (127.0.0.1 for loopback-only runs)")
+parser.add_argument("--video-source", action="append", metavar="SPEC",
+                    help="instead of probing cameras 0 and 1: file:PATH (video, image directory or glob), synthetic or camera:N, "
+                         "give it twice for the second camera")
+parser.add_argument("--audio-source", default="mic", metavar="SPEC", help="mic, tone[:HZ] or wav:PATH")
+parser.add_argument("--video-sink", default="window", metavar="SPEC", help="window, null or file:PATH")
+parser.add_argument("--audio-sink", default="speaker", metavar="SPEC", help="speaker, null or wav:PATH")
+parser.add_argument("--fps", type=float, default=30.0, help="frame rate of file and synthetic video sources")
+parser.add_argument("--capture-fps", type=float, default=30.0,
+                    help="most frames per second read from the camera and sent (0 = as fast as the camera delivers)")
+parser.add_argument("--video-size", default="320x180", help="resolution the camera is sent at, WIDTHxHEIGHT")
+parser.add_argument("--jpeg-quality", type=int, default=30, help="jpeg quality of the sent frames (0-100)")
+parser.add_argument("--detection", choices=["haar", "off"], default="haar",
+                    help="eye detection that drives the overlay, off leaves the overlay to the menu")
+parser.add_argument("--duration", type=float, default=None,
+                    help="run this many seconds without the command prompt, then quit (benchmarks, headless runs)")
+parser.add_argument("--stats-file", default=None, help="write traffic, latency, A/V sync and cpu stats here as json on exit")
+parser.add_argument("--profile", default=None, metavar="TRACE.json",
+                    help="time every stage of the pipeline, writes a chrome://tracing / Perfetto trace here on exit "
+                         "and prints a per stage table")
+parser.add_argument("--recorder-seconds", type=float, default=30.0,
+                    help="how far back the flight recorder remembers, its memory is fixed by this (0 turns it off)")
+parser.add_argument("--recorder-dir", default="flight_recorder", help="where flight recorder dumps go")
+parser.add_argument("--recorder-latency", type=float, default=250.0,
+                    help="dump the flight recorder when decode to screen latency (p90 over a second) goes over this many ms")
+parser.add_argument("--recorder-drop-rate", type=float, default=0.2,
+                    help="dump the flight recorder when more than this fraction of frames is dropped within a second")
+parser.add_argument("--pipeline-config", default=None, metavar="PIPELINE.json",
+                    help="queue sizes, drop policies (block, drop-oldest, latest), executors (thread, process) and workers "
+                         "of the video pipeline stages, e.g. {\"video\": {\"encode\": {\"executor\": \"process\"}}}")
+parser.add_argument("--governor", action="store_true",
+                    help="when the cpu gets hot or saturated, detect eyes less often, then lower the fps, then the size "
+                         "(audio is never touched), and go back up when it has cooled down")
+parser.add_argument("--governor-temp", type=float, default=75.0, help="cpu temperature (C) the governor steps down at")
+parser.add_argument("--governor-load", type=float, default=0.9, help="cpu load (0-1, all cores) the governor steps down at")
+parser.add_argument("--device-cache", default=DEVICE_CACHE_PATH, metavar="PATH",
+                    help="remembers the cameras and microphones that worked, so a restart opens them without probing "
+                         "(empty to turn it off)")
+parser.add_argument("--control-socket", default=None, metavar="PATH",
+                    help="accept json commands (overlay, stream parameters, stats, microphone...) on this unix socket, "
+                         "python control.py PATH help lists them")
+metrics.add_arguments(parser)
+logs.add_arguments(parser)
+scheduling.add_arguments(parser)
+args = parser.parse_args()
+# Everything below logs through a queue, the writing happens on the log thread
+logs.setup_from_args(args)
+# Caps OpenCV's thread pool now, the threads get their cores and priorities once they are all running
+scheduler = scheduling.from_args(args)
+log = logs.get("streamer")
+
+# OpenCV and PyAudio are only loaded by the roles that use them, they are most of the start up time and memory
+ROLE = ROLES[args.role]
+if ROLE & {"video-send", "detector", "display"}:
+    import cv2
+if ("audio-send" in ROLE and args.audio_source == "mic") or ("playback" in ROLE and args.audio_sink == "speaker"):
+    import pyaudio
+    AUDIO_FORMAT = pyaudio.paInt16
+
+TARGET_IP = args.target_ip
+VIDEO_SIZE = tuple(int(n) for n in args.video_size.lower().split("x"))
+JPEG_QUALITY = args.jpeg_quality
+BIND_IP = args.bind
+VIDEO_PORT_FRONT = args.video_port  # Front camera port
+AUDIO_PORT = args.audio_port  # Port for audio stream
+STATUS_PORT = args.status_port   # Port for exchanging overlay status
+TELEMETRY_PORT = args.telemetry_port  # Port for sending/receiving telemetry (gyro data and such)
+# Both devices use the same ports unless an offset moves ours or theirs (two instances on one machine)
+LOCAL_OFFSET = args.port_offset
+REMOTE_OFFSET = args.remote_port_offset
+
+# Binds a socket of ours, on an ephemeral port when the role only sends on it.
+# One streamer per host: the roles of a device share no overlay or liveness state (each has its own heartbeat),
+# they are for splitting a device over separate machines, so a port that's taken ends it with a clear message
+def open_socket(port, listen=True):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((BIND_IP, port if listen else 0))
+    except OSError as e:
+        log.error("Can't listen on port %d (%s), is another streamer running here? Run one streamer (whatever "
+                  "its --role) per host, --port-offset only for tests on one machine", port, e.strerror)
+        sys.exit(1)
+    return sock
+
+# Setup sockets, only the ones the role uses (the relay forwards all of them)
+relaying = args.role == "relay"
+sock_video_front = None
+if args.mux or relaying or ROLE & {"video-send", "display"}:
+    sock_video_front = open_socket(VIDEO_PORT_FRONT + LOCAL_OFFSET, listen=args.mux or relaying or "display" in ROLE)
+
+if args.mux:
+    # Everything goes through the video socket, the header says which channel a datagram belongs to
+    sock_video_front.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * BUFFER_SIZE)
+    sock_video_front.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * BUFFER_SIZE)
+    mux = MuxTransport(sock_video_front, (TARGET_IP, VIDEO_PORT_FRONT + REMOTE_OFFSET))
+    channel_sockets = {}
+else:
+    mux = None
+    channel_sockets = {}
+    if sock_video_front is not None:
+        channel_sockets[packets.CHANNEL_VIDEO] = (sock_video_front, VIDEO_PORT_FRONT + REMOTE_OFFSET)
 
-TARGET_IP = sys.argv[1]
-VIDEO_PORT_FRONT = int(sys.argv[2])  # Front camera port
-AUDIO_PORT = 10003  # Port for audio stream
-STATUS_PORT = 9999   # Port for exchanging overlay status
+    if relaying or ROLE & {"audio-send", "playback"}:
+        sock_audio = open_socket(AUDIO_PORT + LOCAL_OFFSET, listen=relaying or "playback" in ROLE)
+        sock_audio.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUFFER_SIZE)
+        sock_audio.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_SIZE)
+        channel_sockets[packets.CHANNEL_AUDIO] = (sock_audio, AUDIO_PORT + REMOTE_OFFSET)
 
-# Setup sockets
-sock_video_front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock_video_front.bind(("0.0.0.0", VIDEO_PORT_FRONT))
+    sock_status = open_socket(STATUS_PORT + LOCAL_OFFSET)
 
-sock_audio = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock_audio.bind(("0.0.0.0", AUDIO_PORT))
-sock_audio.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUFFER_SIZE)
-sock_audio.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_SIZE)
+    #telemetry sending setup
+    sock_telemetry = open_socket(TELEMETRY_PORT + LOCAL_OFFSET)
 
-sock_status = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock_status.bind(("0.0.0.0", STATUS_PORT))
+    # Socket and remote port of each channel when they are not multiplexed
+    channel_sockets[packets.CHANNEL_STATUS] = (sock_status, STATUS_PORT + REMOTE_OFFSET)
+    channel_sockets[packets.CHANNEL_TELEMETRY] = (sock_telemetry, TELEMETRY_PORT + REMOTE_OFFSET)
 
-#float array sending setup
-FLOAT_ARRAY_PORT = 10004  # Port for sending/receiving float arrays
-sock_float_array = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock_float_array.bind(("0.0.0.0", FLOAT_ARRAY_PORT))
+# Audio and video carry a sequence number and capture time on their own ports, status and telemetry bring their own
+HEADER_CHANNELS = (packets.CHANNEL_VIDEO, packets.CHANNEL_AUDIO)
 
 # Audio setup
-audio = pyaudio.PyAudio()
+audio = None  # PyAudio, its ALSA enumeration takes a while so it runs in parallel with the camera probing
+audio_capture = None  # AudioCaptureManager, created before the threads start
+
+# Receiver side playout, video frames wait here until the audio clock catches up with them
+av_sync = AVSyncScheduler(tolerance=LIPSYNC_TOLERANCE)
+# Received audio chunks wait here for the playback thread, writing to the speaker blocks
+audio_playout = queue.Queue(maxsize=8)
+# Datagrams are received into these instead of a new bytes object each time
+receive_pool = BufferPool(RECEIVE_BUFFERS, BUFFER_SIZE)
+# Fills in lost audio chunks on playback
+audio_concealer = PacketLossConcealer(AUDIO_CHUNK, AUDIO_RATE)
+# Traffic, latency and cpu numbers for --stats-file
+stream_stats = StreamStats()
+# Which cameras and microphones worked last time
+device_cache = DeviceCache(args.device_cache)
+# Always on, keeps the last --recorder-seconds of what happened and dumps them when things go bad
+recorder = None
+if args.recorder_seconds > 0:
+    recorder = FlightRecorder(args.recorder_seconds, directory=args.recorder_dir, latency_ms=args.recorder_latency,
+                              drop_rate=args.recorder_drop_rate)
+
+# Quality level changes go to the other device (the size it receives) and into the flight recorder
+def quality_changed(previous, level, reason):
+    width, height = send_size()
+    heartbeat.update(width=width, height=height)
+    if recorder is not None:
+        recorder.mark(f"quality level {previous} -> {level} ({reason})")
+
+# --governor: trades video quality for headroom when the cpu is hot or busy
+governor = None
+if args.governor:
+    governor = QualityGovernor(hot=args.governor_temp, max_load=args.governor_load, on_change=quality_changed)
+
+# Size frames are sent at, VIDEO_SIZE unless the governor scaled it down
+def send_size():
+    if governor is None or governor.settings["scale"] == 1.0:
+        return VIDEO_SIZE
+    scale = governor.settings["scale"]
+    return (int(VIDEO_SIZE[0] * scale) // 2 * 2, int(VIDEO_SIZE[1] * scale) // 2 * 2)
+# Per stage spans for --profile, the stage timing metrics and the flight recorder, costs next to nothing when all are off
+metrics_enabled = bool(args.metrics_port or args.metrics_socket)
+stage_seconds = metrics.histogram("streamer_stage_seconds", "Time spent in each stage of the video pipeline", ["stage"])
+
+def observe_stage(stage, seconds):
+    if metrics_enabled:
+        stage_seconds.labels(stage).observe(seconds)
+    if recorder is not None:
+        recorder.stage(stage, seconds)
+
+profiler = Profiler(record=args.profile is not None,
+                    observer=observe_stage if metrics_enabled or recorder is not None else None)
+CHANNEL_NAMES = {packets.CHANNEL_VIDEO: "video", packets.CHANNEL_AUDIO: "audio",
+                 packets.CHANNEL_STATUS: "status", packets.CHANNEL_TELEMETRY: "telemetry"}
+
+# Bytes that go on the wire in front of a channel's payload
+def header_size(channel):
+    if mux is not None:
+        return packets.MUX_HEADER.size
+    return packets.MEDIA_HEADER.size if channel in HEADER_CHANNELS else 0
+
+# Sends one datagram of a channel, either on its own socket or over the multiplexed one
+def send_channel(channel, payload, seq=None, timestamp=None):
+    stream_stats.sent(channel, len(payload) + header_size(channel))
+    with profiler.span("sendto"):
+        if mux is not None:
+            mux.send(channel, payload, seq, timestamp)
+            return
+        sock, port = channel_sockets[channel]
+        try:
+            if channel in HEADER_CHANNELS:
+                sock.sendmsg([packets.MEDIA_HEADER.pack(seq, timestamp), payload], [], 0, (TARGET_IP, port))
+            else:
+                sock.sendto(payload, (TARGET_IP, port))
+        except BlockingIOError:
+            pass  # socket buffer full (only happens with --asyncio), drop it like the network would
+
+# Our state goes to the other device periodically, the peer's state comes back the same way
+heartbeat = StatusHeartbeat(lambda payload: send_channel(packets.CHANNEL_STATUS, payload),
+                            interval=HEARTBEAT_INTERVAL, timeout=PEER_TIMEOUT)
+heartbeat.update(width=VIDEO_SIZE[0], height=VIDEO_SIZE[1], quality=JPEG_QUALITY)
+
+# Called when the other device goes silent or comes back
+def peer_changed(alive):
+    global remote_overlay_status
+    if recorder is not None:
+        recorder.network("peer_back" if alive else "peer_lost")
+    if alive:
+        log.info("Other device is back, streaming at full rate")
+    else:
+        log.info("Other device went silent, pausing video and audio until it comes back")
+        # Nobody is there to be in the overlay with us
+        remote_overlay_status = False
+        update_microphone()
+        record_overlay()
+
+liveness = PeerLiveness(heartbeat, on_change=peer_changed)
+
+# Telemetry goes out in batches and what the peer sends lands in a ring buffer any thread can read
+telemetry_schema = make_schema(TELEMETRY_FIELDS)
+telemetry_sender = TelemetrySender(telemetry_schema, lambda payload: send_channel(packets.CHANNEL_TELEMETRY, payload),
+                                   max_delay=TELEMETRY_MAX_DELAY)
+telemetry_ring = TelemetryRing(telemetry_schema)
+
+# Whether the senders should capture and send right now, waits up to timeout for the peer to show up
+def peer_listening(timeout=0):
+    if args.no_idle:
+        return True
+    return liveness.wait(timeout) if timeout else liveness.check()
+
+video_fps = 0.0  # smoothed rate we capture and send frames at
+frames_since_detection = 0
+last_capture_time = None
+
+# Splits a datagram received on a channel's own socket and hands it to the channel handler
+def dispatch_channel_packet(channel, handler, packet):
+    if channel in HEADER_CHANNELS:
+        if len(packet) < packets.MEDIA_HEADER.size:
+            return
+        seq, timestamp = packets.MEDIA_HEADER.unpack_from(packet)
+        payload = memoryview(packet)[packets.MEDIA_HEADER.size:]
+    else:
+        seq, timestamp, payload = 0, 0, memoryview(packet)
+    handler(seq, timestamp, payload)
+
+# Receive loop for one channel on its own socket, used when the channels are not multiplexed
+def receive_channel(channel, handler):
+    sock, _ = channel_sockets[channel]
+    receive_loop(sock, lambda packet: dispatch_channel_packet(channel, handler, packet),
+                 BUFFER_SIZE, args.udp_batch, receive_pool, stop_event)
 
 # Function to initialize all cameras
 def initialize_cameras():
     global video_capture_indices
-    for i in range(2):
-        cap = cv2.VideoCapture(i)
+    # Every camera that opens is managed: if it stops delivering it gets reopened in the background
+    # All of them are opened at the same time, a camera that takes a while doesn't hold up the others
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="open-camera") as pool:
+        if args.video_source:
+            opened = pool.map(lambda spec: sources.open_video_source(spec, args.fps), args.video_source)
+            for spec, cap in zip(args.video_source, opened):
+                if cap.isOpened():
+                    video_capture_indices.append(ManagedCapture(spec, lambda spec=spec: sources.open_video_source(spec, args.fps),
+                                                                stop_event, cap))
+                else:
+                    log.warning("Could not open video source %s", spec)
+            return
+
+        # The cache only decides the order: the cameras that worked last time first, then the default indices
+        # it doesn't have, all probed at once. A camera that was missing on the last boot is found again
+        cached = device_cache.cameras or []
+        indices = list(cached) + [i for i in range(2) if i not in cached]
+        caps = list(pool.map(cv2.VideoCapture, indices))
+    working = []
+    for i, cap in zip(indices, caps):
         if cap.isOpened():
-            video_capture_indices.append(cap)
+            working.append(i)
+            video_capture_indices.append(ManagedCapture(f"camera {i}", lambda i=i: cv2.VideoCapture(i), stop_event, cap))
+    device_cache.save(cameras=working)
 
-# Function to capture and send front camera stream
-#REWORKED this now sends camera stream based on overlay status values
-def get_front_camera_stream():
-    global video_capture_indices, current_camera_index, overlay_status, remote_overlay_status
-    while True:
-            #check for eyes
+# Cameras, the eye cascade and PyAudio all at once (each of them takes a noticeable while on a Pi),
+# then the microphones, which need PyAudio. Only what the --role uses gets opened
+def initialize_devices():
+    global face_cascade, audio, audio_capture, audio_input_indices
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3, thread_name_prefix="init") as pool:
+        cascade = audio_ready = cameras = None
+        if "detector" in ROLE and args.detection != "off":
+            cascade = pool.submit(cv2.CascadeClassifier, 'haarcascade_eye.xml')
+        if "pyaudio" in sys.modules:
+            audio_ready = pool.submit(pyaudio.PyAudio)
+        if ROLE & {"video-send", "detector"}:
+            cameras = pool.submit(initialize_cameras)
+
+        if audio_ready is not None:
+            audio = audio_ready.result()
+        # Every microphone is opened up front so switching is instant
+        if "audio-send" in ROLE and args.audio_source == "mic":
+            from audio_capture import AudioCaptureManager
+            cached = device_cache.microphones(audio, audio_input_indices)
+            if cached:
+                audio_input_indices = cached
+            audio_capture = AudioCaptureManager(audio, audio_input_indices, AUDIO_FORMAT, AUDIO_CHANNELS, AUDIO_RATE, AUDIO_CHUNK,
+                                                on_thread=lambda: scheduler.apply_current("audio-capture"))
+            device_cache.save(microphones=[i for i in audio_input_indices if i in audio_capture.streams], audio=audio)
+        elif "audio-send" in ROLE:
+            audio_capture = sources.open_audio_source(args.audio_source, AUDIO_RATE, AUDIO_CHUNK, AUDIO_CHANNELS)
+        if cascade is not None:
+            face_cascade = cascade.result()
+        if cameras is not None:
+            cameras.result()
+    update_microphone()
+    log.info("Devices ready %.2f s after start (%.2f s opening them), %d camera(s)",
+             process_age(), time.monotonic() - started, len(video_capture_indices))
+
+# Paces the camera reads on the monotonic clock, at --capture-fps or what the governor allows, whichever is lower.
+# A camera that fails doesn't make the capture loop spin either, it still waits for the next tick
+capture_pacer = sources.Pacer(0.0)
+
+def capture_interval():
+    fps = args.capture_fps
+    max_fps = governor.settings["max_fps"] if governor is not None else None
+    if max_fps and (not fps or max_fps < fps):
+        fps = max_fps
+    return 1.0 / fps if fps else 0.0
+
+# Eye detection on every frame unless the governor says otherwise
+def detection_tick():
+    global frames_since_detection
+    frames_since_detection += 1
+    detection_every = governor.settings["detection_every"] if governor is not None else 1
+    if args.detection != "off" and frames_since_detection >= detection_every:
+        frames_since_detection = 0
+        with profiler.span("detection"):
             newEyeDetection()
 
-            if overlay_status and remote_overlay_status:
-                current_camera_index = 1
-            else:
-                current_camera_index = 0
-            
-            cap = video_capture_indices[current_camera_index]
-            ret, frame = cap.read()
-            if not ret:
-                continue
+# --role detector: no video goes out, the detection still runs at the capture rate and drives the overlay
+def detection_loop():
+    while not stop_event.is_set():
+        capture_pacer.interval = capture_interval()
+        if capture_pacer.interval and capture_pacer.wait(stop_event):
+            break
+        if not video_capture_indices:
+            stop_event.wait(0.5)
+            continue
+        detection_tick()
+        if not capture_pacer.interval:
+            stop_event.wait(0.05)
 
-            # Resize the frame to a smaller resolution (e.g., 320x180)
-            frame_resized = cv2.resize(frame, (320, 180))
+# Checks for eyes and captures one frame of the camera that goes with the overlay status
+# Returns (frame, capture timestamp, send size, jpeg quality) or None if the camera gave us nothing.
+# The encode settings travel with the frame: an encoder in a worker process only has the values from when it forked
+def read_video_frame():
+    global video_capture_indices, current_camera_index, overlay_status, remote_overlay_status, video_fps, last_capture_time
+    capture_pacer.interval = capture_interval()
+    if capture_pacer.interval and capture_pacer.wait(stop_event):
+        return None
 
-            # Increase JPEG compression by reducing the quality to 30
-            _, buffer = cv2.imencode('.jpg', frame_resized, [int(cv2.IMWRITE_JPEG_QUALITY), 30])
+    #check for eyes, every frame unless the governor says otherwise
+    if "detector" in ROLE:
+        detection_tick()
 
-            if len(buffer) < BUFFER_SIZE:
-                sock_video_front.sendto(buffer, (TARGET_IP, VIDEO_PORT_FRONT))
+    if overlay_status and remote_overlay_status:
+        current_camera_index = 1
+    else:
+        current_camera_index = 0
+
+    # With a single camera both overlay states use it
+    cap = video_capture_indices[current_camera_index % len(video_capture_indices)]
+    with profiler.span("cap.read"):
+        ret, frame = cap.read()
+    if not ret:
+        if not capture_pacer.interval:
+            stop_event.wait(0.05)  # unpaced and the camera is down, don't ask it again right away
+        return None
+    stream_stats.count("frames_captured")
+    if stream_stats.first("captured"):
+        log.info("First frame captured %.2f s after start", stream_stats.first_frame_s["captured"])
+    timestamp = packets.capture_timestamp()
+    now = time.monotonic()
+    if last_capture_time is not None and now > last_capture_time:
+        video_fps = 0.9 * video_fps + 0.1 / (now - last_capture_time)
+        heartbeat.update(fps=video_fps)
+    last_capture_time = now
+    return frame, timestamp, send_size(), JPEG_QUALITY
+
+# Shrinks and jpeg encodes a captured frame, returns (jpeg buffer, capture timestamp) or None if it doesn't fit a datagram
+def encode_video_frame(captured):
+    frame, timestamp, size, quality = captured
+    # Resize the frame to a smaller resolution (e.g., 320x180)
+    with profiler.span("resize"):
+        frame_resized = cv2.resize(frame, size)
 
-# Function to receive and display the camera streams
+    # Increase JPEG compression by reducing the quality to 30
+    with profiler.span("imencode"):
+        _, buffer = cv2.imencode('.jpg', frame_resized, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+
+    if len(buffer) + packets.MUX_HEADER.size >= BUFFER_SIZE:
+        return None
+    return buffer, timestamp
+
+# Both of the above in one go, the --asyncio capture executor runs this
+def capture_video_frame():
+    captured = read_video_frame()
+    if captured is None:
+        return None
+    return encode_video_frame(captured)
+
+# The outgoing camera stream as a pipeline: capture -> encode -> send, each in its own thread so the next
+# frame is read while the last one is encoded. Only the newest captured frame waits for the encoder,
+# --pipeline-config changes that (and the rest) without touching this
+#REWORKED this now sends camera stream based on overlay status values
+def build_video_pipeline():
+    # Nobody listening, no capture and no jpeg encode, just wait for their heartbeat
+    def capture():
+        if not peer_listening(HEARTBEAT_INTERVAL):
+            return None
+        return read_video_frame()
+
+    seq = 0
+    def send(encoded):
+        nonlocal seq
+        buffer, timestamp = encoded
+        send_channel(packets.CHANNEL_VIDEO, buffer, seq, timestamp)
+        seq = packets.next_seq(seq)
+
+    video = Pipeline("video", stop_event)
+    video.source("capture", capture)
+    video.transform("encode", encode_video_frame, queue=1, policy="latest")
+    video.sink("send", send, queue=2, policy="drop-oldest")
+    if args.pipeline_config:
+        video.configure_from_file(args.pipeline_config)
+    return video
+
+expected_video_seq = None  # sequence number of the next video frame from the peer
+
+# Decodes a datagram of the remote camera stream, frames are handed to the A/V scheduler
+def handle_video_packet(seq, timestamp, payload):
+    global expected_video_seq
+    if expected_video_seq is not None:
+        gap = packets.seq_delta(seq, expected_video_seq)
+        if gap > 0:
+            stream_stats.count("video_frames_lost", gap)
+            if recorder is not None:
+                recorder.network("video_gap", gap)
+    expected_video_seq = packets.next_seq(seq)
+    with profiler.span("imdecode"):
+        frame_front = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    # Ensure valid frames
+    if frame_front is None:
+        stream_stats.count("decode_errors")
+        if recorder is not None:
+            recorder.network("decode_error")
+        return
+    stream_stats.count("frames_decoded")
+    av_sync.push_frame(timestamp, frame_front)
+
+# Function to display the camera streams, in step with the audio we are playing
 def receive_camera_stream():
     global overlay_status, remote_overlay_status
-    while True:
-        # Receive data from remote device camera
-        packet_front, _ = sock_video_front.recvfrom(BUFFER_SIZE) #
-        frame_front = cv2.imdecode(np.frombuffer(packet_front, dtype=np.uint8), cv2.IMREAD_COLOR)
+    sink = sources.open_video_sink(args.video_sink, args.fps)
+    while not stop_event.is_set():
+        frame_front, is_new = av_sync.next_frame()
 
-        # Ensure valid frames
-        if frame_front is None:
+        # Nothing due yet, keep the window responsive and what is on screen stays there
+        if frame_front is None or not is_new:
+            if sink.quit_requested():
+                break
             continue
+        stream_stats.count("frames_shown")
+        if stream_stats.first("shown"):
+            log.info("First frame shown %.2f s after start", stream_stats.first_frame_s["shown"])
+        # Capture to screen, both clocks are the same monotonic clock when the peers share a machine
+        latency = packets.timestamp_delta(packets.capture_timestamp(), av_sync.current_timestamp())
+        stream_stats.frame_latency(latency)
+        if recorder is not None:
+            # The capture timestamp is the other device's clock (its uptime when it's another Pi), so the
+            # recorder's trigger uses ours: how long the frame waited between being decoded and shown
+            recorder.latency(av_sync.current_wait_ms())
+            recorder.frame(frame_front)
 
         # Resize frames (to match the reduced resolution for both front and back)
-        resized_front = cv2.resize(frame_front, (320, 180))
+        resized_front = cv2.resize(frame_front, VIDEO_SIZE)
 
-        cv2.namedWindow("Camera Stream", cv2.WINDOW_FULLSCREEN)
-        cv2.setWindowProperty("Camera Stream", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-
-        if overlay_status and remote_overlay_status:
+        # --role display has no camera of its own to blend in, the remote picture is all there is
+        if overlay_status and remote_overlay_status and video_capture_indices:
             local_camera = video_capture_indices[(0) % len(video_capture_indices)]
             ret_front, frame_local = local_camera.read()
             if frame_local is None:
                 continue
-            resized_local = cv2.resize(frame_local, (320, 180))
+            resized_local = cv2.resize(frame_local, VIDEO_SIZE)
             thisOverlay = cv2.addWeighted(resized_front, 0.7, resized_local, 0.3, 0)
             thisOverlayRescaled = cv2.resize(thisOverlay, (1024, 600))
-            cv2.imshow("Camera Stream", thisOverlayRescaled)
+            with profiler.span("show"):
+                sink.show(thisOverlayRescaled)
         else:
             resized_front_rescaled = cv2.resize(resized_front, (1024, 600))
-            cv2.imshow("Camera Stream", resized_front_rescaled)
+            with profiler.span("show"):
+                sink.show(resized_front_rescaled)
         
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if sink.quit_requested():
             break
 
-    cv2.destroyAllWindows()
+    sink.close()
 
 # Function to capture audio and send it over UDP
 def get_audio_stream():
     """Captures audio from the selected microphone and sends it over UDP."""
-    audioIndex = 0
-    if overlay_status and remote_overlay_status:
-        audioIndex = 1
-    stream = audio.open(format=AUDIO_FORMAT,
-                        channels=AUDIO_CHANNELS,
-                        rate=AUDIO_RATE,
-                        input=True,
-                        frames_per_buffer=AUDIO_CHUNK,
-                        input_device_index=audioIndex)
-
-    while True:
-        data = stream.read(AUDIO_CHUNK, exception_on_overflow=False)
-        sock_audio.sendto(data, (TARGET_IP, AUDIO_PORT))
-
-# Function to receive audio stream and play it
-def receive_audio_stream():
-    """Receives audio stream and plays it using PyAudio."""
-    stream = audio.open(format=AUDIO_FORMAT,
-                        channels=AUDIO_CHANNELS,
-                        rate=AUDIO_RATE,
-                        output=True)
-
-    while True:
+    seq = 0
+    while not stop_event.is_set():
+        if not peer_listening(HEARTBEAT_INTERVAL):
+            continue
+        # The capture manager already follows the overlay state, see update_microphone()
+        data, timestamp = audio_capture.read()
+        send_channel(packets.CHANNEL_AUDIO, data, seq, timestamp)
+        seq = packets.next_seq(seq)
+
+# Queues a received audio chunk for playback, the oldest one goes if the speaker falls behind
+def handle_audio_packet(seq, timestamp, payload):
+    # The payload points into a pooled receive buffer, keep it out of the pool until it's played
+    receive_pool.retain(payload)
+    if audio_playout.full():
         try:
-            packet, _ = sock_video_front.recvfrom(BUFFER_SIZE)
-            stream.write(packet)
+            _, _, dropped = audio_playout.get_nowait()
+            receive_pool.release(dropped)
+            stream_stats.count("audio_playout_drops")
+        except queue.Empty:
+            pass
+    audio_playout.put_nowait((seq, timestamp, payload))
 
-        except ConnectionResetError as e:
-            print(f"Connection was reset: {e}")
-    # Handle reconnection logic or clean up resources
+# Function to play the received audio stream
+def play_audio_stream():
+    """Plays the received audio stream using PyAudio, concealing lost packets."""
+    if args.audio_sink == "speaker":
+        stream = audio.open(format=AUDIO_FORMAT,
+                            channels=AUDIO_CHANNELS,
+                            rate=AUDIO_RATE,
+                            output=True)
+    else:
+        stream = sources.open_audio_sink(args.audio_sink, AUDIO_RATE, AUDIO_CHANNELS)
+
+    while not stop_event.is_set():
+        try:
+            seq, timestamp, payload = audio_playout.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        # Gaps in the sequence numbers get filled in before the chunk we just got
+        lost = audio_concealer.lost
+        chunks = audio_concealer.process(seq, payload)
+        receive_pool.release(payload)
+        if recorder is not None and audio_concealer.lost > lost:
+            recorder.network("audio_gap", audio_concealer.lost - lost)
+        if not chunks:
+            continue  # late or malformed, nothing played so its timestamp mustn't move the A/V clock
+        for chunk in chunks:
+            stream.write(chunk)
+        stream_stats.count("audio_chunks_played", len(chunks))
+        # The video display follows this clock
+        av_sync.audio_played(timestamp, AUDIO_CHUNK / AUDIO_RATE, stream.get_output_latency())
+    stream.stop_stream()
+    stream.close()
 
-        #packet, _ = sock_audio.recvfrom(BUFFER_SIZE) #
-        
 # Function to list available audio devices (microphones)
 def list_audio_devices():
     """Lists all available audio input devices (microphones)."""
     available_devices = []
+    if audio is None:
+        return available_devices  # no PyAudio in this role or with this --audio-source
     for i in range(audio.get_device_count()):
         info = audio.get_device_info_by_index(i)
         if info['maxInputChannels'] > 0:
             available_devices.append(i)
     return available_devices
 
+# Microphone slot that goes with the current overlay state (same rule as the camera)
+def current_microphone_slot():
+    return 1 if overlay_status and remote_overlay_status else 0
+
+# Point the outgoing audio at the microphone for the current overlay state, no stream reopen needed
+def update_microphone():
+    if audio_capture is not None:
+        audio_capture.select(audio_input_indices[current_microphone_slot()])
+
 # Command to switch microphone
+# The chosen device replaces the microphone of the current overlay state
 def switch_microphone():
-    global audio_input_index
     print("Listing available audio devices (microphones):")
     devices = list_audio_devices()
     if devices:
@@ -182,75 +701,93 @@ def switch_microphone():
             print(f"{i}. Microphone Index {device}")
         selected_index = int(input("Enter the index of the microphone to switch to: "))
         if 0 <= selected_index < len(devices):
-            audio_input_index = devices[selected_index]
-            print(f"Switched to Microphone Index {audio_input_index}")
+            device = devices[selected_index]
+            if select_microphone(device):
+                print(f"Switched to Microphone Index {device}")
         else:
             print("Invalid microphone index.")
     else:
         print("No microphones detected.")
 
+# Makes device the microphone of the current overlay state, False if it can't be opened
+def select_microphone(device):
+    # Opening is only slow the first time, after that the device stays open
+    if not audio_capture.open_device(device):
+        return False
+    audio_input_indices[current_microphone_slot()] = device
+    update_microphone()
+    device_cache.save(microphones=audio_input_indices, audio=audio)
+    return True
+
 # Function to send the current overlay status to the other device
+# The heartbeat sends it right away, repeats it a few times and keeps sending it periodically
 def send_overlay_status():
     global overlay_status
-    status_message = str(int(overlay_status)).encode()
-    sock_status.sendto(status_message, (TARGET_IP, STATUS_PORT))
+    heartbeat.update(overlay=overlay_status)
 
 # Function to receive the overlay status from the other device
-def receive_overlay_status():
+def handle_overlay_status(seq, timestamp, payload):
     global remote_overlay_status
-    while True:
-        packet, _ = sock_status.recvfrom(1024)
-        remote_overlay_status = bool(int(packet.decode()))
+    fresh = heartbeat.receive(payload)
+    liveness.notify()
+    if not fresh:
+        return
+    if heartbeat.peer["overlay"] != remote_overlay_status:
+        remote_overlay_status = heartbeat.peer["overlay"]
+        update_microphone()
+        record_overlay()
+
+# Overlay transitions go in the flight recorder
+def record_overlay():
+    if recorder is not None:
+        recorder.overlay(overlay_status, remote_overlay_status)
 
 # Function to toggle overlay status
 def toggle_overlay():
     global overlay_status
     overlay_status = not overlay_status
-    print(f"Overlay status: {overlay_status}")
+    log.info("Overlay status: %s", overlay_status)
     send_overlay_status()
+    update_microphone()
+    record_overlay()
 
 def set_overlay(bool):
     global overlay_status
     if bool != overlay_status:
         overlay_status = bool
-        print(f"Overlay status: {overlay_status}")
+        log.info("Overlay status: %s", overlay_status)
         send_overlay_status()
+        update_microphone()
+        record_overlay()
 
 def send_float_array(float_array): #USE THIS TO SEND GYRO DATA AS A FLOAT ARRAY
-    """Sends an array of floats to the remote device."""
-    # Convert the list of floats to a numpy array
-    float_array = [102.27, 38719.232, 8123.782]
-    array_np = np.array(float_array, dtype=np.float32)
-    
-    # Convert the numpy array to bytes
-    byte_data = array_np.tobytes()
-    
-    # Send the byte data via UDP
-    sock_float_array.sendto(byte_data, (TARGET_IP, FLOAT_ARRAY_PORT))
-   # print(f"Sent float array: {float_array}")
-
-def receive_float_array():
-    """Receives an array of floats from the remote device."""
-    while True:
-        try:
-            byte_data, _ = sock_float_array.recvfrom(1024)  # Adjust buffer size as needed
-            # Convert bytes back to a numpy array
-            float_array = np.frombuffer(byte_data, dtype=np.float32)
-            print(f"Received float array: {float_array}")
-        except Exception as e:
-            print(f"Error receiving float array: {e}")
+    """Queues one telemetry sample for the remote device, values in the order of TELEMETRY_FIELDS."""
+    # Samples are batched and sent a few at a time, see TelemetrySender
+    telemetry_sender.record(**{name: value for (name, _), value in zip(TELEMETRY_FIELDS, float_array)})
+
+def handle_telemetry(seq, timestamp, payload):
+    """Receives a batch of telemetry samples from the remote device."""
+    # They go into the ring buffer, read them from there with telemetry_ring.read() / latest()
+    telemetry_ring.receive(payload)
 
 def newEyeDetection():
-    global video_capture_indices, framesWithEyes, framesWithEyesLimit
+    global video_capture_indices, framesWithEyes, framesWithEyesLimit, face_cascade
     cam = video_capture_indices[(1) % len(video_capture_indices)]
     #print("running newEyeDetection")
     #cam = eyeCheckCam
-    _, frame = cam.read()
+    ret, frame = cam.read()
+    if not ret:
+        return  # camera down or being reopened, no verdict this frame
+    if face_cascade is None:
+        # --detection was off at start and got turned on over the control socket
+        face_cascade = cv2.CascadeClassifier('haarcascade_eye.xml')
     resized = cv2.resize(frame, (1280, 720)) #might want to rescale to 1920 x 1080 for our 1080p cameras
     grayscale = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)
     blur = cv2.GaussianBlur(grayscale, (5, 5), 0)
     eyes = face_cascade.detectMultiScale(blur, 1.2, 6)
     eyeCount = len(eyes)
+    # How sure we are someone is looking, drops off while no eyes are found
+    heartbeat.update(confidence=1.0 if eyeCount >= 1 else max(0.0, 1.0 - (framesWithEyes + 1) / framesWithEyesLimit))
     if eyeCount >= 1:
         set_overlay(True)
         framesWithEyes = 0
@@ -260,42 +797,19 @@ def newEyeDetection():
         if framesWithEyes >= framesWithEyesLimit:
             set_overlay(False)
 
-# Initialize cameras and start threads
-initialize_cameras()
-video_send_thread_front = threading.Thread(target=get_front_camera_stream, daemon=True)
-video_receive_thread = threading.Thread(target=receive_camera_stream, daemon=True)
-status_receive_thread = threading.Thread(target=receive_overlay_status, daemon=True)
-
-video_send_thread_front.start()
-video_receive_thread.start()
-status_receive_thread.start()
-
-# Start audio threads
-audio_send_thread = threading.Thread(target=get_audio_stream, daemon=True)
-audio_receive_thread = threading.Thread(target=receive_audio_stream, daemon=True)
-audio_send_thread.start()
-audio_receive_thread.start()
-
-#float threads
-float_array_receive_thread = threading.Thread(target=receive_float_array, daemon=True)
-float_array_receive_thread.start()
-
-
-
-# Command loop
-while True:
-    print("\nCommands:")
-    print("1: Toggle Overlay")
-    print("2: Quit")
-    print("3: list default microphone (switching mics should not do anything)")
-    print("4: send float array")
-    command = input("Enter a command: ")
-    
+# Asks every loop to wind down, from any thread
+def request_shutdown():
+    stop_event.set()
+    if core is not None:
+        core.stop()
+
+# Runs one command from the menu, returns False when the user wants to quit
+def run_command(command):
     match command:
         case "1":
             toggle_overlay()
         case "2":
-            break
+            return False
         case "3":
             switch_microphone()
         case "4":
@@ -304,12 +818,433 @@ while True:
            # float_array = [float(val) for val in float_array_input.split(",")]
             float_array = [123.3, 123.3, 123.3]
             send_float_array(float_array)
+        case "5":
+            print(av_sync.report())
+            print(heartbeat.report())
+            print(liveness.report())
+            print(receive_pool.report())
+            print(scheduler.report())
+            if governor is not None:
+                print(governor.report())
+            if video_pipeline is not None:
+                print(video_pipeline.report())
+            for relay in relays:
+                print(relay.report())
+            if profiler.record:
+                print(profiler.report())
+        case "6":
+            latest = telemetry_ring.latest()
+            print(f"Telemetry: {telemetry_ring.written} samples in {telemetry_ring.batches} batches, "
+                  f"{telemetry_ring.lost_batches} batches lost, latest {latest}")
+        case "7":
+            if recorder is not None:
+                recorder.mark("operator")
+                print(f"Dumping the flight recorder to {recorder.dump('operator request')}")
+            else:
+                print("Flight recorder is off (--recorder-seconds 0)")
         case _:
             print("Invalid command")
+    return True
+
+# Everything --stats-file records, the traffic counters plus what the other components keep track of
+def collect_stats():
+    stats = stream_stats.snapshot(CHANNEL_NAMES)
+    stats["config"] = dict(role=args.role, video_size=list(VIDEO_SIZE), jpeg_quality=JPEG_QUALITY, detection=args.detection,
+                           mux=args.mux, asyncio=args.asyncio, udp_batch=args.udp_batch)
+    stats["av_sync"] = dict(shown=av_sync.shown, dropped=av_sync.dropped, repeated=av_sync.repeated, unsynced=av_sync.unsynced,
+                            skew_ms=av_sync.skew_ms, max_skew_ms=av_sync.max_skew_ms)
+    stats["audio"] = dict(received=audio_concealer.received, lost=audio_concealer.lost,
+                          concealed=audio_concealer.concealed, late=audio_concealer.late, malformed=audio_concealer.malformed)
+    stats["video_fps"] = video_fps
+    stats["receive_pool"] = receive_pool.stats()
+    stats["scheduling"] = dict(cv_threads=args.cv_threads, threads=scheduler.applied)
+    if relays:
+        stats["relay"] = {relay.name: dict(forwarded=relay.forwarded, dropped=relay.dropped) for relay in relays}
+    if governor is not None:
+        stats["governor"] = dict(level=governor.level, transitions=governor.transitions, temperature=governor.temperature)
+    stats["telemetry"] = dict(samples=telemetry_ring.written, batches=telemetry_ring.batches,
+                              lost_batches=telemetry_ring.lost_batches)
+    if profiler.record:
+        stats["stages_ms"] = profiler.summary()
+    return stats
+
+def write_stats(path):
+    stats = collect_stats()
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2)
+    log.info("Stats written to %s", path)
+
+# Stands in for the command loop with --duration: just streams for that long
+def timed_run():
+    stop_event.wait(args.duration)
+    # Taken before shutting down, the thread cpu times are gone once the threads are
+    if args.stats_file:
+        write_stats(args.stats_file)
+    request_shutdown()
+
+# Once a second: lets the flight recorder decide whether the last second was bad enough to dump
+def recorder_tick():
+    dropped = (av_sync.dropped + stream_stats.counters["decode_errors"] + stream_stats.counters["video_frames_lost"])
+    recorder.check(dropped, stream_stats.counters["frames_shown"])
+
+def recorder_loop():
+    while not stop_event.wait(1.0):
+        recorder_tick()
+
+def governor_loop():
+    while not stop_event.wait(1.0):
+        governor.tick()
+
+# The menu, on its own thread: input() can't be interrupted, so a quit from the control socket
+# (or a timeout) would otherwise wait for someone to press enter
+def prompt_loop():
+    while not stop_event.is_set():
+        print("\nCommands:")
+        print("1: Toggle Overlay")
+        print("2: Quit")
+        print("3: switch microphone")
+        print("4: send telemetry sample")
+        print("5: show A/V sync and peer stats")
+        print("6: show received telemetry")
+        print("7: dump the flight recorder")
+        try:
+            command = input("Enter a command: ")
+        except EOFError:
+            # No terminal (service, nohup), the control socket can still drive it so keep streaming
+            if control is None:
+                request_shutdown()
+            return
+        if stop_event.is_set():
+            return  # stopped while we were waiting for the answer, it's not for us anymore
+        if not run_command(command):
+            request_shutdown()
+            return
+
+# Command loop: runs until the menu, the control socket or ctrl-c stops the streamer
+def command_loop():
+    threading.Thread(target=prompt_loop, name="prompt", daemon=True).start()
+    try:
+        stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    if args.stats_file:
+        write_stats(args.stats_file)
+    request_shutdown()
+
+# Wraps a channel handler so the work happens in a bounded executor instead of on the event loop
+def in_executor(executor, handler):
+    def submit(seq, timestamp, payload):
+        executor.submit_nowait(handler, seq, timestamp, payload)
+    return submit
+
+# --asyncio: sockets live on the event loop, capture and decode go to executors, display/playback/prompt
+# keep their own thread because OpenCV windows, PyAudio output and input() want one
+async def setup_async_streamer(core):
+    # The executor threads only exist once they get work, so they place themselves (--cpu-plan) when they start
+    place = lambda: scheduler.apply_current(threading.current_thread().name)
+    capture_pool = core.executor("capture", workers=1, max_pending=1, initializer=place)
+    microphone_pool = core.executor("microphone", workers=1, max_pending=1, initializer=place)
+    decode_pool = core.executor("decode", workers=1, max_pending=2, initializer=place)
+
+    handlers = dict(channel_handlers)
+    # Decoding a jpeg is too slow for the loop, if the decoder is busy the frame is dropped (newest wins)
+    if packets.CHANNEL_VIDEO in handlers:
+        handlers[packets.CHANNEL_VIDEO] = counted(packets.CHANNEL_VIDEO, in_executor(decode_pool, handle_video_packet))
+
+    if mux is not None:
+        for channel, handler in handlers.items():
+            mux.register(channel, handler)
+        await core.open_channel(sock_video_front, mux.dispatch)
+    else:
+        for channel, handler in handlers.items():
+            sock, _ = channel_sockets[channel]
+            await core.open_channel(sock, lambda packet, c=channel, h=handler: dispatch_channel_packet(c, h, packet))
+
+    async def send_video():
+        seq = 0
+        while not stop_event.is_set():
+            if not peer_listening():
+                await asyncio.sleep(IDLE_PROBE_INTERVAL)
+                continue
+            captured = await capture_pool.run(capture_video_frame)
+            if captured is None:
+                continue
+            buffer, timestamp = captured
+            send_channel(packets.CHANNEL_VIDEO, buffer, seq, timestamp)
+            seq = packets.next_seq(seq)
+
+    async def send_audio():
+        seq = 0
+        while not stop_event.is_set():
+            if not peer_listening():
+                await asyncio.sleep(IDLE_PROBE_INTERVAL)
+                continue
+            data, timestamp = await microphone_pool.run(audio_capture.read)
+            send_channel(packets.CHANNEL_AUDIO, data, seq, timestamp)
+            seq = packets.next_seq(seq)
+
+    if "video-send" in ROLE:
+        core.spawn(send_video())
+    elif "detector" in ROLE:
+        core.run_blocking("detector", detection_loop)
+    if "audio-send" in ROLE:
+        core.spawn(send_audio())
+    core.every(heartbeat.repeat_interval, heartbeat.tick)
+    core.every(TELEMETRY_MAX_DELAY / 2, telemetry_sender.flush_due)
+    if recorder is not None:
+        core.every(1.0, recorder_tick)
+    if governor is not None:
+        core.every(1.0, governor.tick)
+    if "display" in ROLE:
+        core.run_blocking("display", receive_camera_stream)
+    if "playback" in ROLE:
+        core.run_blocking("playback", play_audio_stream)
+    core.run_blocking("commands", timed_run if args.duration else command_loop)
+    scheduler.apply()
+
+# Counts what arrives on a channel, then hands it to the handler
+def counted(channel, handler):
+    overhead = header_size(channel)
+    def count_and_handle(seq, timestamp, payload):
+        stream_stats.received(channel, len(payload) + overhead)
+        handler(seq, timestamp, payload)
+    return count_and_handle
 
-# Clean up resources
-sock_video_front.close()
-sock_audio.close()
-sock_status.close()
-audio.terminate()
-cv2.destroyAllWindows()
+# What to do with the datagrams of each channel
+channel_handlers = {
+    packets.CHANNEL_VIDEO: counted(packets.CHANNEL_VIDEO, handle_video_packet),
+    packets.CHANNEL_AUDIO: counted(packets.CHANNEL_AUDIO, handle_audio_packet),
+    packets.CHANNEL_STATUS: counted(packets.CHANNEL_STATUS, handle_overlay_status),
+    packets.CHANNEL_TELEMETRY: counted(packets.CHANNEL_TELEMETRY, handle_telemetry),
+}
+# Media this role doesn't show or play isn't received at all
+if "display" not in ROLE:
+    del channel_handlers[packets.CHANNEL_VIDEO]
+if "playback" not in ROLE:
+    del channel_handlers[packets.CHANNEL_AUDIO]
+
+# What --metrics-port / --metrics-socket show, mostly read from the counters the components already keep
+def register_metrics():
+    frames = metrics.counter("streamer_frames_total", "Video frames through each stage", ["stage"])
+    fps = metrics.gauge("streamer_fps", "Frames per second through each stage since the last scrape", ["stage"])
+    frame_counts = dict(captured=lambda: stream_stats.counters["frames_captured"],
+                        sent=lambda: stream_stats.channels_sent.get(packets.CHANNEL_VIDEO, (0, 0))[0],
+                        decoded=lambda: stream_stats.counters["frames_decoded"],
+                        shown=lambda: stream_stats.counters["frames_shown"])
+    for stage, count in frame_counts.items():
+        frames.labels(stage).set_function(count)
+        fps.labels(stage).set_function(metrics.rate_of(count))
+
+    drops = metrics.counter("streamer_drops_total", "Things thrown away, by reason", ["reason"])
+    drops.labels("av_sync").set_function(lambda: av_sync.dropped)
+    drops.labels("decode_error").set_function(lambda: stream_stats.counters["decode_errors"])
+    drops.labels("audio_lost").set_function(lambda: audio_concealer.lost)
+    drops.labels("audio_late").set_function(lambda: audio_concealer.late)
+    drops.labels("audio_malformed").set_function(lambda: audio_concealer.malformed)
+    drops.labels("audio_playout_full").set_function(lambda: stream_stats.counters["audio_playout_drops"])
+    drops.labels("telemetry_batches_lost").set_function(lambda: telemetry_ring.lost_batches)
+
+    depth = metrics.gauge("streamer_queue_depth", "Items waiting in each queue", ["queue"])
+    depth.labels("audio_playout").set_function(audio_playout.qsize)
+    depth.labels("av_sync_frames").set_function(av_sync.queued)
+    depth.labels("receive_buffers_in_use").set_function(lambda: receive_pool.stats()["in_use"])
+
+    datagrams = metrics.counter("streamer_datagrams_total", "Datagrams by channel and direction", ["channel", "direction"])
+    wire_bytes = metrics.counter("streamer_bytes_total", "Bytes on the wire by channel and direction", ["channel", "direction"])
+    for channel, name in CHANNEL_NAMES.items():
+        for direction, table in (("sent", stream_stats.channels_sent), ("received", stream_stats.channels_received)):
+            # get() rather than [], a scrape mustn't add entries to the dict the stream threads are filling
+            datagrams.labels(name, direction).set_function(lambda t=table, c=channel: t.get(c, (0, 0))[0])
+            wire_bytes.labels(name, direction).set_function(lambda t=table, c=channel: t.get(c, (0, 0))[1])
+
+    metrics.gauge("streamer_capture_fps", "Smoothed capture rate").set_function(lambda: video_fps)
+    metrics.gauge("streamer_av_skew_ms", "Smoothed A/V skew of shown frames, positive is video ahead").set_function(
+        lambda: av_sync.skew_ms)
+    metrics.gauge("streamer_peer_alive", "1 while the other device's heartbeat comes in").set_function(
+        lambda: 1 if heartbeat.peer_alive() else 0)
+    overlay = metrics.gauge("streamer_overlay", "1 while the overlay is on", ["side"])
+    overlay.labels("local").set_function(lambda: overlay_status)
+    overlay.labels("remote").set_function(lambda: remote_overlay_status)
+    first_frame = metrics.gauge("streamer_time_to_first_frame_seconds",
+                                "Seconds from the process starting to its first frame captured / shown", ["frame"])
+    for name in ("captured", "shown"):
+        first_frame.labels(name).set_function(lambda name=name: stream_stats.first_frame_s.get(name, float("nan")))
+    if governor is not None:
+        metrics.gauge("streamer_quality_level", "Governor level, 0 is full quality").set_function(lambda: governor.level)
+        metrics.gauge("streamer_cpu_temperature_celsius", "Cpu temperature the governor last read").set_function(
+            lambda: governor.temperature)
+
+# What --control-socket answers, each takes the fields of the json request as keyword arguments
+def stream_params():
+    return dict(video_size=list(VIDEO_SIZE), jpeg_quality=JPEG_QUALITY, capture_fps=args.capture_fps, detection=args.detection)
+
+def set_stream_params(video_size=None, jpeg_quality=None, capture_fps=None, detection=None):
+    global VIDEO_SIZE, JPEG_QUALITY
+    if video_size is not None:
+        width, height = (int(n) for n in (video_size.lower().split("x") if isinstance(video_size, str) else video_size))
+        VIDEO_SIZE = (width, height)
+        width, height = send_size()
+        heartbeat.update(width=width, height=height)
+    if jpeg_quality is not None:
+        JPEG_QUALITY = max(0, min(100, int(jpeg_quality)))
+        heartbeat.update(quality=JPEG_QUALITY)
+    if capture_fps is not None:
+        args.capture_fps = float(capture_fps)
+    if detection is not None:
+        if detection not in ("haar", "off"):
+            raise ValueError("detection is haar or off")
+        args.detection = detection
+    return stream_params()
+
+def control_set_microphone(device):
+    if audio_capture is None or not hasattr(audio_capture, "open_device"):
+        raise ValueError("no microphones with --audio-source other than mic")
+    if not select_microphone(int(device)):
+        raise ValueError(f"microphone {device} can't be opened")
+    return dict(slot=current_microphone_slot(), device=int(device))
+
+def control_toggle_overlay():
+    toggle_overlay()
+    return dict(overlay=overlay_status)
+
+def control_set_overlay(on):
+    set_overlay(bool(on))
+    return dict(overlay=overlay_status)
+
+def control_dump_recorder(reason="control request"):
+    if recorder is None:
+        raise ValueError("flight recorder is off (--recorder-seconds 0)")
+    return recorder.dump(reason)
+
+control_commands = dict(
+    toggle_overlay=control_toggle_overlay,
+    set_overlay=control_set_overlay,
+    get_overlay=lambda: dict(local=overlay_status, remote=remote_overlay_status, peer_alive=heartbeat.peer_alive()),
+    get_params=stream_params,
+    set_params=set_stream_params,
+    stats=collect_stats,
+    list_microphones=lambda: dict(devices=list_audio_devices() if args.audio_source == "mic" else [],
+                                  selected=audio_input_indices),
+    set_microphone=control_set_microphone,
+    send_telemetry=lambda values: send_float_array([float(v) for v in values]),
+    dump_recorder=control_dump_recorder,
+    quit=request_shutdown,
+)
+control = None
+if args.control_socket:
+    control = ControlServer(args.control_socket, control_commands).start()
+    log.info("Taking commands on %s", args.control_socket)
+
+if metrics_enabled:
+    register_metrics()
+    metrics.serve_from_args(args)
+
+# Initialize cameras and microphones
+initialize_devices()
+
+# Threads of the threaded streamer, daemons only so a stuck one can't keep the process alive forever
+def start_worker(target, name, *args):
+    thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+    thread.start()
+    workers.append(thread)
+
+# Every loop has seen the stop event by the time this returns (or SHUTDOWN_TIMEOUT ran out on it),
+# nothing touches a socket, a camera or PyAudio after that
+def stop_workers():
+    if video_pipeline is not None:
+        video_pipeline.stop(SHUTDOWN_TIMEOUT)
+    for thread in workers:
+        thread.join(SHUTDOWN_TIMEOUT)
+        if thread.is_alive():
+            log.warning("Thread %s did not stop within %.0f s", thread.name, SHUTDOWN_TIMEOUT)
+
+if relaying:
+    # No streaming of our own, every port's datagrams go between target_ip and the other side
+    if mux is not None:
+        relays.append(Relay("mux", sock_video_front, (TARGET_IP, VIDEO_PORT_FRONT + REMOTE_OFFSET), BUFFER_SIZE))
+    else:
+        relays = [Relay(CHANNEL_NAMES[channel], sock, (TARGET_IP, port), BUFFER_SIZE)
+                  for channel, (sock, port) in channel_sockets.items()]
+    for relay in relays:
+        start_worker(relay.run, f"relay-{relay.name}", stop_event)
+    log.info("Relaying %s between %s and whoever sends to us", ", ".join(relay.name for relay in relays), TARGET_IP)
+    scheduler.apply()
+    if args.duration:
+        timed_run()
+    else:
+        command_loop()
+elif args.asyncio:
+    core = AsyncCore(stop_event)
+    core.run(setup_async_streamer)
+else:
+    # Start threads, the ones the role needs
+    if "video-send" in ROLE:
+        video_pipeline = build_video_pipeline()
+        video_pipeline.start()
+    elif "detector" in ROLE:
+        start_worker(detection_loop, "detector")
+    if "display" in ROLE:
+        start_worker(receive_camera_stream, "display")
+
+    # Start audio threads
+    if "audio-send" in ROLE:
+        start_worker(get_audio_stream, "audio-send")
+    if "playback" in ROLE:
+        start_worker(play_audio_stream, "playback")
+
+    # Status heartbeat
+    start_worker(heartbeat.run, "heartbeat", stop_event)
+
+    # Telemetry batches
+    start_worker(telemetry_sender.run, "telemetry", stop_event)
+
+    # Flight recorder thresholds
+    if recorder is not None:
+        start_worker(recorder_loop, "flight-recorder-check")
+
+    # Quality governor
+    if governor is not None:
+        start_worker(governor_loop, "governor")
+
+    # Receive threads, one loop for everything when multiplexed, otherwise one per socket.
+    # Blocking with a timeout so they notice the shutdown even when nothing arrives
+    for sock, _ in channel_sockets.values():
+        sock.settimeout(RECEIVE_POLL_INTERVAL)
+    if mux is not None:
+        sock_video_front.settimeout(RECEIVE_POLL_INTERVAL)
+        for channel, handler in channel_handlers.items():
+            mux.register(channel, handler)
+        start_worker(mux.receive_loop, "receive", BUFFER_SIZE, args.udp_batch, receive_pool, stop_event)
+    else:
+        for channel, handler in channel_handlers.items():
+            start_worker(receive_channel, f"receive-{CHANNEL_NAMES[channel]}", channel, handler)
+
+    # Cores and priorities from --cpu-plan
+    scheduler.apply()
+
+    if args.duration:
+        timed_run()
+    else:
+        command_loop()
+
+# Clean up resources, the threads first so none of them is still using what gets closed
+stop_event.set()
+stop_workers()
+if control is not None:
+    control.close()
+if sock_video_front is not None:
+    sock_video_front.close()
+for sock, _ in channel_sockets.values():
+    sock.close()
+for cap in video_capture_indices:
+    cap.release()
+if audio_capture is not None:
+    audio_capture.close()
+if audio is not None:
+    audio.terminate()
+if args.video_sink == "window" and "display" in ROLE:
+    cv2.destroyAllWindows()
+if profiler.record:
+    print(profiler.report())
+    profiler.write_chrome_trace(args.profile)
+    log.info("Trace written to %s, open it in chrome://tracing or ui.perfetto.dev", args.profile)
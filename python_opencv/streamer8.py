@@ -4,6 +4,13 @@ import pyaudio
 import threading
 import numpy as np
 import sys
+import os
+
+# Queued logging shared with the other scripts, the level comes from LOG_LEVEL (e.g. LOG_LEVEL=debug)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import logs
+logs.setup()
+log = logs.get("streamer")
 
 # Constants
 BUFFER_SIZE = 65535
@@ -224,7 +231,7 @@ def receive_overlay_status():
 def toggle_overlay():
     global overlay_status
     overlay_status = not overlay_status
-    print(f"Overlay status: {overlay_status}")
+    log.info("Overlay status: %s", overlay_status)
     send_overlay_status()
 
 def send_float_array(float_array): #USE THIS TO SEND GYRO DATA AS A FLOAT ARRAY
@@ -237,7 +244,7 @@ def send_float_array(float_array): #USE THIS TO SEND GYRO DATA AS A FLOAT ARRAY
     
     # Send the byte data via UDP
     sock_float_array.sendto(byte_data, (TARGET_IP, FLOAT_ARRAY_PORT))
-    print(f"Sent float array: {float_array}")
+    log.debug("Sent float array: %s", float_array)
 
 def receive_float_array():
     """Receives an array of floats from the remote device."""
@@ -246,9 +253,9 @@ def receive_float_array():
             byte_data, _ = sock_float_array.recvfrom(1024)  # Adjust buffer size as needed
             # Convert bytes back to a numpy array
             float_array = np.frombuffer(byte_data, dtype=np.float32)
-            print(f"Received float array: {float_array}")
+            log.debug("Received float array: %s", float_array)
         except Exception as e:
-            print(f"Error receiving float array: {e}")
+            log.warning("Error receiving float array: %s", e)
 
 
 # Initialize cameras and start threads
@@ -0,0 +1,163 @@
+# Telemetry channel for numeric samples (gyro readings and the like).
+# Samples have named fields with their own dtypes and a capture timestamp. The sender collects them
+# into a batch and sends one datagram per batch (when it's full or the oldest sample has waited long
+# enough), the receiver drops them into a preallocated numpy ring buffer other threads can read from.
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import packets
+
+# seq, number of samples, schema fingerprint, timestamp of the first sample (ms)
+BATCH_HEADER = struct.Struct("!HHII")
+
+
+def make_schema(fields):
+    """fields is a list of (name, dtype), returns the structured dtype used on the wire and in the ring."""
+    # Little endian on the wire whatever the machine is, plus the per sample capture time
+    return np.dtype([("timestamp", "<u4")] + [(name, np.dtype(dtype).newbyteorder("<")) for name, dtype in fields])
+
+
+def schema_fingerprint(schema):
+    """Both ends must agree on the fields, this goes in every batch so a mismatch is noticed."""
+    return zlib.crc32(str(schema.descr).encode())
+
+
+class TelemetrySender:
+    """Coalesces samples into batched datagrams."""
+
+    def __init__(self, schema, send, max_batch=32, max_delay=0.05):
+        self.schema = schema
+        self.fingerprint = schema_fingerprint(schema)
+        self.send = send
+        self.max_delay = max_delay
+        self._batch = np.zeros(max_batch, dtype=schema)
+        self._count = 0
+        self._oldest = None
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.samples_sent = 0
+        self.batches_sent = 0
+
+    def record(self, **values):
+        """Adds one sample, fields that aren't given stay 0."""
+        with self._cond:
+            sample = self._batch[self._count]
+            sample["timestamp"] = packets.capture_timestamp()
+            for name, value in values.items():
+                sample[name] = value
+            self._count += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            if self._count == len(self._batch):
+                self._flush_locked()
+
+    def flush(self):
+        """Sends whatever is batched right now."""
+        with self._cond:
+            self._flush_locked()
+
+    def flush_due(self):
+        """Sends the batch if its oldest sample has waited max_delay, for timer driven callers."""
+        with self._cond:
+            if self._oldest is not None and time.monotonic() - self._oldest >= self.max_delay:
+                self._flush_locked()
+
+    def run(self, stop_event):
+        """Blocking loop for the threaded streamer, sends batches once they are old enough."""
+        while not stop_event.is_set():
+            with self._cond:
+                if self._oldest is None:
+                    self._cond.wait(0.5)
+                    continue
+                remaining = self.max_delay - (time.monotonic() - self._oldest)
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if self._count == 0:
+            return
+        batch = self._batch[:self._count]
+        header = BATCH_HEADER.pack(self._seq, self._count, self.fingerprint, int(batch[0]["timestamp"]))
+        self.send(header + batch.tobytes())
+        self._seq = packets.next_seq(self._seq)
+        self.samples_sent += self._count
+        self.batches_sent += 1
+        self._count = 0
+        self._oldest = None
+
+
+class TelemetryRing:
+    """Preallocated ring buffer of received samples.
+    read() hands out views into the buffer itself, nothing is copied, so a reader should be done with
+    them before capacity more samples come in."""
+
+    def __init__(self, schema, capacity=4096):
+        self.schema = schema
+        self.fingerprint = schema_fingerprint(schema)
+        self.buffer = np.zeros(capacity, dtype=schema)
+        self.capacity = capacity
+        self.written = 0  # total samples ever written, the write position is written % capacity
+        self._lock = threading.Lock()
+        self._expected_seq = None
+        self.batches = 0
+        self.lost_batches = 0
+        self.rejected = 0
+
+    def receive(self, payload):
+        """Takes one batch datagram from the sender."""
+        if len(payload) < BATCH_HEADER.size:
+            self.rejected += 1
+            return
+        seq, count, fingerprint, _ = BATCH_HEADER.unpack_from(payload)
+        if fingerprint != self.fingerprint or len(payload) != BATCH_HEADER.size + count * self.schema.itemsize:
+            self.rejected += 1
+            return
+        if self._expected_seq is not None:
+            gap = packets.seq_delta(seq, self._expected_seq)
+            if gap > 0:
+                self.lost_batches += gap
+        self._expected_seq = packets.next_seq(seq)
+        self.batches += 1
+        self.push(np.frombuffer(payload, dtype=self.schema, count=count, offset=BATCH_HEADER.size))
+
+    def push(self, samples):
+        with self._lock:
+            samples = samples[-self.capacity:]
+            start = self.written % self.capacity
+            first = min(len(samples), self.capacity - start)
+            self.buffer[start:start + first] = samples[:first]
+            self.buffer[:len(samples) - first] = samples[first:]
+            self.written += len(samples)
+
+    def read(self, n):
+        """Returns the newest n samples (oldest first) as a list of at most two views into the ring."""
+        with self._lock:
+            n = min(n, self.written, self.capacity)
+            end = self.written % self.capacity
+        start = end - n
+        if start >= 0:
+            return [self.buffer[start:end]]
+        if end == 0:
+            return [self.buffer[start:]]
+        return [self.buffer[start:], self.buffer[:end]]
+
+    def latest(self):
+        """The newest sample as a view, None before anything arrived."""
+        with self._lock:
+            if self.written == 0:
+                return None
+            return self.buffer[(self.written - 1) % self.capacity]
+
+    def field(self, name, n):
+        """Newest n values of one field, this one is a copy when the samples wrap around the ring."""
+        views = self.read(n)
+        if len(views) == 1:
+            return views[0][name]
+        return np.concatenate([view[name] for view in views])
@@ -0,0 +1,161 @@
+# Linux fast path for sending and receiving many udp datagrams with fewer syscalls.
+# Send: UDP_SEGMENT (GSO) hands the kernel one big buffer plus a segment size, it cuts it into datagrams.
+# Receive: UDP_GRO lets the kernel hand us several datagrams of the same flow glued together in one
+# recvmsg, with the segment size in a control message so we can cut them apart again.
+# Anywhere this isn't available (mac, windows, old kernels) everything falls back to one datagram per
+# syscall automatically, so callers don't need to care.
+import logging
+import socket
+import struct
+import sys
+
+from backoff import Backoff
+
+log = logging.getLogger(__name__)
+
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+# The kernel refuses more segments than this in one GSO send
+MAX_SEGMENTS = 64
+MAX_GSO_BYTES = 65000
+
+
+class BatchSender:
+    """Sends lists of datagrams, in as few sendmsg calls as GSO allows."""
+
+    def __init__(self, sock, enabled=True):
+        self.sock = sock
+        self.gso = enabled and sys.platform.startswith("linux") and hasattr(sock, "sendmsg")
+        self.syscalls = 0
+        self.datagrams = 0
+
+    def send(self, datagrams, address):
+        """Sends every datagram in order to address."""
+        i = 0
+        while i < len(datagrams):
+            if self.gso:
+                run = self._gso_run(datagrams, i)
+                if run > 1:
+                    try:
+                        self._send_gso(datagrams[i:i + run], address)
+                        i += run
+                        continue
+                    except OSError:
+                        # EIO/EINVAL means no GSO here (or the nic can't do checksums), stop trying
+                        self.gso = False
+            self.sock.sendto(datagrams[i], address)
+            self.syscalls += 1
+            self.datagrams += 1
+            i += 1
+
+    def _gso_run(self, datagrams, start):
+        # GSO needs equal sized segments, only the last one may be shorter
+        size = len(datagrams[start])
+        total = 0
+        run = 0
+        for datagram in datagrams[start:start + MAX_SEGMENTS]:
+            if len(datagram) > size or total + len(datagram) > MAX_GSO_BYTES:
+                break
+            total += len(datagram)
+            run += 1
+            if len(datagram) < size:
+                break
+        return run
+
+    def _send_gso(self, segments, address):
+        size = len(segments[0])
+        self.sock.sendmsg(segments, [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))], 0, address)
+        self.syscalls += 1
+        self.datagrams += len(segments)
+
+
+class BatchReceiver:
+    """Receives datagrams, several per recvmsg when the kernel coalesced them with GRO.
+    With a BufferPool the data lands in pooled buffers (no allocation per datagram), call done()
+    with what receive() returned once the datagrams have been handled."""
+
+    def __init__(self, sock, buffer_size=65535, enabled=True, pool=None):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.pool = pool
+        self.gro = False
+        if enabled and sys.platform.startswith("linux") and hasattr(sock, "recvmsg"):
+            try:
+                sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+                self.gro = True
+            except OSError:
+                pass
+        self._ancillary_size = socket.CMSG_SPACE(4) if self.gro else 0
+        self.syscalls = 0
+        self.datagrams = 0
+
+    def receive(self):
+        """Blocks for the next batch, returns (list of datagrams as memoryviews, sender address)."""
+        buffer = self.pool.acquire() if self.pool is not None else None
+        try:
+            if not self.gro:
+                if buffer is None:
+                    data, address = self.sock.recvfrom(self.buffer_size)
+                    view = memoryview(data)
+                else:
+                    length, address = self.sock.recvfrom_into(buffer, self.buffer_size)
+                    view = memoryview(buffer)[:length]
+                self.syscalls += 1
+                self.datagrams += 1
+                return [view], address
+
+            if buffer is None:
+                data, ancillary, _, address = self.sock.recvmsg(self.buffer_size, self._ancillary_size)
+                view = memoryview(data)
+            else:
+                length, ancillary, _, address = self.sock.recvmsg_into([buffer], self._ancillary_size)
+                view = memoryview(buffer)[:length]
+        except BaseException:
+            if buffer is not None:
+                self.pool.release(buffer)
+            raise
+        self.syscalls += 1
+        segment = 0
+        for level, kind, value in ancillary:
+            if level == SOL_UDP and kind == UDP_GRO:
+                segment = struct.unpack("=i", value[:4])[0]
+        if segment <= 0 or segment >= len(view):
+            self.datagrams += 1
+            return [view], address
+        datagrams = [view[offset:offset + segment] for offset in range(0, len(view), segment)]
+        self.datagrams += len(datagrams)
+        return datagrams, address
+
+    def done(self, datagrams):
+        """Gives the buffer behind a receive() result back to the pool (they all share one)."""
+        if self.pool is not None and datagrams:
+            self.pool.release(datagrams[0])
+
+
+def receive_loop(sock, dispatch, buffer_size, batch=False, pool=None, stop_event=None):
+    """Blocking receive loop, dispatch(packet) for every datagram until stop_event is set or the socket closes.
+    The one every receive thread runs, per channel socket or multiplexed. batch lets the kernel coalesce datagrams
+    (UDP_GRO) where it can, pool is a BufferPool to receive into. Give the socket a timeout so the loop gets
+    to look at stop_event while nothing arrives."""
+    receiver = BatchReceiver(sock, buffer_size, enabled=batch, pool=pool)
+    errors = Backoff(0.001, 0.5)  # a socket that keeps erroring mustn't turn this into a busy loop
+    while stop_event is None or not stop_event.is_set():
+        try:
+            datagrams, _ = receiver.receive()
+        except TimeoutError:
+            continue
+        except ConnectionResetError as e:
+            log.warning("Connection was reset: %s", e)
+            errors.wait(stop_event)
+            continue
+        except OSError:
+            break  # socket closed on shutdown
+        errors.reset()
+        for packet in datagrams:
+            try:
+                dispatch(packet)
+            except Exception as e:
+                # A bad packet on one channel must not take the others down with it
+                log.warning("Error handling channel packet: %s", e)
+        receiver.done(datagrams)
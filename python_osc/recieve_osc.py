@@ -1,27 +1,49 @@
 from pythonosc import dispatcher, osc_server
 import serial
 import time
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import metrics
+import logs
+
+parser = argparse.ArgumentParser(description="Receives gyro readings over OSC and passes them on to the Arduino over serial.")
+metrics.add_arguments(parser)
+logs.add_arguments(parser)
+args = parser.parse_args()
+logs.setup_from_args(args)
+log = logs.get("osc")
+
+# What --metrics-port / --metrics-socket show
+osc_messages = metrics.counter("osc_messages_total", "OSC messages received", ["address"])
+serial_write_seconds = metrics.histogram("serial_write_seconds", "How long writing one reading to the Arduino took")
+serial_lines = metrics.counter("serial_lines_received_total", "Lines the Arduino sent back")
+metrics.gauge("osc_messages_per_second", "Gyro messages per second since the last scrape").set_function(
+    metrics.rate_of(lambda: osc_messages.labels("/gyro").get()))
 
 # Set up serial communication with the Arduino
 arduino_serial = serial.Serial('/dev/ttyACM0', 9600)  # Replace '/dev/ttyUSB0' with your Arduino's port
 time.sleep(2)  # Give some time for the connection to initialize
 
 def gyro_handler(address, *args):
+    osc_messages.labels(address).inc()
     # Format the gyroscope data as comma-separated values
-    print(f"{args[0]},{args[1]},{args[2]}")
     gyro_data = f"{args[0]},{args[1]},{args[2]}"
 
-    # Print the values to the console
-    print(gyro_data)
+    # Only the first reading of every second is written, then "gyro ... x<count> in last 1s"
+    log.info("gyro %s,%s,%s", *args[:3])
     
     if arduino_serial.in_waiting > 0:
         # Read the incoming data from the serial port
         data = arduino_serial.readline().decode().strip()
-        # Print the data to the console
-        print(f"Received data: {data}")
+        serial_lines.inc()
+        log.info("Received data: %s", data)
 
     # Send the formatted data over serial to the Arduino
-    arduino_serial.write((gyro_data + "\n").encode())
+    with serial_write_seconds.time():
+        arduino_serial.write((gyro_data + "\n").encode())
 
 dispatcher = dispatcher.Dispatcher()
 dispatcher.map("/gyro", gyro_handler)
@@ -29,12 +51,13 @@ dispatcher.map("/gyro", gyro_handler)
 ip = "100.122.183.98"  # Replace with the IP of your Raspberry Pi or localhost
 port = 8000  # Use the same port as specified in the sender
 
+metrics.serve_from_args(args)
 server = osc_server.ThreadingOSCUDPServer((ip, port), dispatcher)
-print(f"Listening for OSC messages on {ip}:{port}")
+log.info("Listening for OSC messages on %s:%s", ip, port)
 
 try:
     server.serve_forever()
 except KeyboardInterrupt:
-    print("Shutting down server")
+    log.info("Shutting down server")
 finally:
     arduino_serial.close()
@@ -6,8 +6,29 @@ import pygame
 from pygame.locals import *
 import serial
 import time
+import argparse
+import os
+import sys
 from pythonosc import udp_client
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import metrics
+import logs
+
+parser = argparse.ArgumentParser(description="Reads the IMU over serial, draws it and sends the readings over OSC.")
+metrics.add_arguments(parser)
+logs.add_arguments(parser)
+args = parser.parse_args()
+logs.setup_from_args(args)
+log = logs.get("osc")
+
+# What --metrics-port / --metrics-socket show
+frames_metric = metrics.counter("imu_frames_total", "Frames drawn")
+metrics.gauge("imu_fps", "Frames per second since the last scrape").set_function(metrics.rate_of(frames_metric.get))
+serial_read_seconds = metrics.histogram("serial_read_seconds", "Asking the IMU for a reading until the line came back")
+bad_lines = metrics.counter("serial_bad_lines_total", "Lines from the IMU that weren't three values")
+osc_sent = metrics.counter("osc_messages_sent_total", "Gyro readings sent over OSC")
+
 #ser = serial.Serial('/dev/tty.usbserial', 38400, timeout=1)
 ser = serial.Serial('/dev/ttyACM0', 9600, timeout=1)
 
@@ -113,10 +134,13 @@ def read_data():
     line_done = 0
 
     # request data by sending a dot
-    ser.write(b".") #* encode string to bytes
-    #while not line_done:
-    line = ser.readline() 
+    with serial_read_seconds.time():
+        ser.write(b".") #* encode string to bytes
+        #while not line_done:
+        line = ser.readline() 
     angles = line.split(b",")
+    if len(angles) != 3:
+        bad_lines.inc()
     if len(angles) == 3:    
         ax = float(angles[0])
         ay = float(angles[1])
@@ -127,13 +151,15 @@ def read_data():
         gx = int(round(float(angles[0])))
         gy = int(round(float(angles[1])))
         gz = int(round(float(angles[2])))
-        # print(f"Sent gyroscope data: gx={gx}, gy={gy}, gz={gz}")
+        log.debug("Sent gyroscope data: gx=%s, gy=%s, gz=%s", gx, gy, gz)
         client.send_message("/gyro", [gx, gy, gz])
+        osc_sent.inc()
 
 def main():
     global yaw_mode
 
     video_flags = OPENGL|DOUBLEBUF
+    metrics.serve_from_args(args)
     
     pygame.init()
     screen = pygame.display.set_mode((640,480), video_flags)
@@ -155,6 +181,7 @@ def main():
       
         pygame.display.flip()
         frames = frames+1
+        frames_metric.inc()
 
     print ("fps:  %d" % ((frames*1000)/(pygame.time.get_ticks()-ticks)))
     ser.close()
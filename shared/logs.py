@@ -0,0 +1,175 @@
+# Logging for the installation scripts that stays out of the hot loops.
+# A print() to a serial console blocks until the characters are out, at 115200 baud that is a long time
+# for a loop that runs per OSC message or per frame. Here the calling thread only puts the record on a
+# queue (formatting included happens later), one background thread formats and writes, and a message that
+# repeats is only written the first time in every window, followed by one "x1000 in last 1s" line.
+#
+#   import logs
+#   log = logs.get("osc")
+#   log.debug("gyro %s,%s,%s", x, y, z)      # % style arguments, formatted off the calling thread
+#   logs.setup_from_args(args)               # after logs.add_arguments(parser) and parse_args()
+#
+# The modules in python_opencv just use logging.getLogger(__name__), this is where their output goes too.
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+DEFAULT_LEVEL = os.environ.get("LOG_LEVEL", "info")
+
+
+def get(name):
+    return logging.getLogger(name)
+
+
+class RepeatFilter(logging.Filter):
+    """Lets the first record of every (logger, message template) through per window and counts the rest.
+    A background timer writes "<message> x<count> in last <window>s" for whatever was held back."""
+
+    def __init__(self, window=1.0):
+        super().__init__()
+        self.window = window
+        self._seen = {}  # (logger name, msg) -> [window start, suppressed, last record]
+        self._lock = threading.Lock()
+        self.output = None  # where the summaries go, the queue handler
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                # A message that never stops rolls its window here before the timer gets to it,
+                # what the old window held back is summarised first
+                self._seen[key] = [now, 0, None]
+                if entry is not None and entry[1]:
+                    self._summarise(entry[1], entry[2])
+                return True
+            entry[1] += 1
+            entry[2] = record
+            return False
+
+    def flush(self, everything=False):
+        """Writes the summary of every window that ended with held back records (of every window with everything)."""
+        now = time.monotonic()
+        summaries = []
+        with self._lock:
+            for key, entry in list(self._seen.items()):
+                if now - entry[0] < self.window and not everything:
+                    continue
+                if entry[1]:
+                    summaries.append((entry[1], entry[2]))
+                del self._seen[key]
+        for count, record in summaries:
+            self._summarise(count, record)
+
+    def _summarise(self, count, record):
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = f"{record.msg} x{count} in last {self.window:g}s"
+        if self.output is not None:
+            self.output.handle_unfiltered(summary)
+
+    def run(self, stop_event):
+        while not stop_event.wait(self.window):
+            self.flush()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks: when the writer falls behind the queue fills up and new records are counted, not queued."""
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Unlike the stock QueueHandler the message isn't formatted here but in the writer thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def handle_unfiltered(self, record):
+        self.emit(record)
+
+
+def parse_levels(spec):
+    """'info' or 'warning,osc=debug,streamer=info' -> (default level, {logger: level})."""
+    default = logging.INFO
+    levels = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, level = part.rpartition("=")
+        value = logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            raise ValueError(f"unknown log level {level!r}")
+        if name:
+            levels[name] = value
+        else:
+            default = value
+    return default, levels
+
+
+_listener = None
+_repeats = None
+_stop = threading.Event()
+
+
+def setup(level=DEFAULT_LEVEL, file=None, window=1.0, queue_size=10000):
+    """Routes every logger through the queue to stderr (and file). Safe to call once per process."""
+    global _listener, _repeats
+    if _listener is not None:
+        return
+    default, levels = parse_levels(level)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if file:
+        handlers.append(logging.FileHandler(file))
+    formatter = logging.Formatter(FORMAT, "%H:%M:%S")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(records)
+    repeats = RepeatFilter(window)
+    repeats.output = queue_handler
+    _repeats = repeats
+    queue_handler.addFilter(repeats)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(default)
+    for name, value in levels.items():
+        logging.getLogger(name).setLevel(value)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    threading.Thread(target=repeats.run, args=(_stop,), name="log-repeats", daemon=True).start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Writes what's still queued, call it (or let atexit) before the process ends."""
+    global _listener
+    if _listener is None:
+        return
+    _stop.set()
+    _repeats.flush(everything=True)  # the last, unfinished window
+    _listener.stop()
+    _listener = None
+
+
+def add_arguments(parser):
+    parser.add_argument("--log-level", default=DEFAULT_LEVEL,
+                        help="debug, info, warning or error, per logger as well: warning,osc=debug (default info, "
+                             "or the LOG_LEVEL environment variable)")
+    parser.add_argument("--log-file", default=None, help="also write the log to this file")
+
+
+def setup_from_args(args):
+    setup(args.log_level, args.log_file)
@@ -0,0 +1,322 @@
+# Counters, gauges and histograms the installation scripts share, readable over http in the Prometheus
+# text format so the installations can be watched from a browser, curl or Prometheus itself:
+#   curl localhost:9100/metrics
+#   curl --unix-socket /tmp/streamer.sock http://x/metrics
+# The scripts live in different folders, they find this one with
+#   sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+import bisect
+import http.server
+import math
+import os
+import socketserver
+import threading
+import time
+
+# Seconds, made for per frame work (detection, encode, serial writes) rather than web requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    """Shared by the three kinds: a name, help text, label names and one child per label combination."""
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values, **named):
+        """The child for one combination of label values, created the first time it is asked for."""
+        if named:
+            values = tuple(named[name] for name in self.label_names)
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} has labels {self.label_names}, got {values}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _only_child(self):
+        if self.label_names:
+            raise ValueError(f"{self.name} has labels {self.label_names}, use labels() first")
+        return self._children[()]
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _Value:
+    """Child of a counter or gauge, either a stored number or a function read at scrape time."""
+
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1.0):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function):
+        """The value becomes whatever function() returns when somebody scrapes, for numbers kept elsewhere."""
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception:
+                return math.nan
+        with self._lock:
+            return self._value
+
+    def render(self, name, label_names, values):
+        return [f"{name}{_format_labels(label_names, values)} {_format_value(self.get())}"]
+
+
+class Counter(_Metric):
+    """Only goes up. inc(), or set_function() for a total something else already counts."""
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self._only_child().inc(amount)
+
+    def set_function(self, function):
+        self._only_child().set_function(function)
+
+    def get(self):
+        return self._only_child().get()
+
+
+class Gauge(_Metric):
+    """Goes up and down: queue depths, fps, whether the peer is there."""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self._only_child().inc(amount)
+
+    def dec(self, amount=1.0):
+        self._only_child().dec(amount)
+
+    def set(self, value):
+        self._only_child().set(value)
+
+    def set_function(self, function):
+        self._only_child().set_function(function)
+
+    def get(self):
+        return self._only_child().get()
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self):
+        """with histogram.time(): ... observes how long the block took, in seconds."""
+        return _Timer(self)
+
+    def render(self, name, label_names, values):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            le = (("le", _format_value(bound) if bound == math.inf else repr(bound)),)
+            lines.append(f"{name}_bucket{_format_labels(label_names, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(label_names, values)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(label_names, values)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric):
+    """Distribution of durations (or sizes), in fixed buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._only_child().observe(value)
+
+    def time(self):
+        return self._only_child().time()
+
+
+class Registry:
+    """Every metric of a process, by name. Asking for a name twice gives back the same metric."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def rate_of(total):
+    """Function for set_function(): per second rate of total() since the previous scrape (fps from a frame count)."""
+    last = [time.monotonic(), total()]
+
+    def rate():
+        now, value = time.monotonic(), total()
+        elapsed = now - last[0]
+        result = (value - last[1]) / elapsed if elapsed > 0 else 0.0
+        last[:] = [now, value]
+        return result
+    return rate
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def _handler(registry):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # a scrape every few seconds is not news
+
+        def address_string(self):
+            # Unix socket clients have no (host, port)
+            return str(self.client_address[0]) if self.client_address else "unix"
+
+    return MetricsHandler
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(port=None, unix_path=None, host="127.0.0.1", registry=REGISTRY):
+    """Starts answering /metrics on host:port and/or a unix socket in daemon threads, returns the servers."""
+    servers = []
+    if port:
+        servers.append(http.server.ThreadingHTTPServer((host, port), _handler(registry)))
+    if unix_path:
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)  # left over from a run that didn't clean up
+        servers.append(_UnixHTTPServer(unix_path, _handler(registry)))
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return servers
+
+
+def add_arguments(parser):
+    """The --metrics-port / --metrics-socket options every script takes."""
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on this local http port (curl localhost:PORT/metrics)")
+    parser.add_argument("--metrics-socket", default=None,
+                        help="serve Prometheus metrics on this unix socket instead of (or as well as) a port")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="address the metrics port listens on")
+
+
+def serve_from_args(args):
+    return serve(args.metrics_port, args.metrics_socket, args.metrics_host)
@@ -0,0 +1,266 @@
+# Runs a chain of stages (source -> transforms -> sink) each in its own thread(s) or in worker processes,
+# connected by bounded queues. What an edge does when the next stage can't keep up is a per edge policy:
+#   block        the producer waits (nothing is lost, the whole chain slows down to the slowest stage)
+#   drop-oldest  the oldest queued item goes to make room (a short backlog, always moving)
+#   latest       only the newest item is kept, for frames where old ones are worthless
+# Every stage counts its items and time in the shared metrics, report() prints the same as a table.
+#
+#   video = Pipeline("video", stop_event)
+#   video.source("capture", read_frame)                      # returns an item, or None for nothing this time
+#   video.transform("encode", encode, queue=1, policy="latest")
+#   video.sink("send", send, queue=2, policy="drop-oldest")
+#   video.start()
+#
+# Sizes, policies, executors and worker counts can be changed from a json file without touching the code:
+#   {"encode": {"executor": "process", "workers": 2}, "send": {"queue": 4, "policy": "block"}}
+# A process stage's function has to be picklable (a top level function, checked when it's configured) and so does every
+# item it gets. The worker processes keep the globals from when they forked, settings that change go in the items.
+import collections
+import concurrent.futures
+import json
+import logging
+import pickle
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+POLICIES = ("block", "drop-oldest", "latest")
+EXECUTORS = ("thread", "process", "main")
+POLL_INTERVAL = 0.1  # how often a waiting stage looks at the stop event
+
+stage_items = metrics.counter("pipeline_items_total", "Items each stage has finished", ["pipeline", "stage"])
+stage_seconds = metrics.histogram("pipeline_stage_seconds", "Time a stage spent on one item", ["pipeline", "stage"])
+edge_dropped = metrics.counter("pipeline_dropped_total", "Items thrown away at the queue in front of a stage",
+                               ["pipeline", "stage"])
+edge_depth = metrics.gauge("pipeline_queue_depth", "Items waiting in the queue in front of a stage", ["pipeline", "stage"])
+
+
+class Edge:
+    """Bounded queue between two stages with one of the POLICIES for when it is full."""
+
+    def __init__(self, maxsize=1, policy="latest"):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy {policy!r}, known ones: {', '.join(POLICIES)}")
+        self.maxsize = 1 if policy == "latest" else max(1, maxsize)
+        self.policy = policy
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.put_count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, stop_event):
+        """Queues item, returns False if the pipeline stopped while a blocking put was waiting."""
+        with self._lock:
+            if self.policy == "block":
+                while len(self._items) >= self.maxsize:
+                    if stop_event.is_set():
+                        return False
+                    self._not_full.wait(POLL_INTERVAL)
+            elif len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self.put_count += 1
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout=POLL_INTERVAL):
+        """Oldest item, or None if nothing arrived within timeout."""
+        with self._lock:
+            if not self._items and not self._not_empty.wait(timeout):
+                return None
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+
+class Stage:
+    """One step: a source makes items, a transform turns one item into another (None filters it out), a sink eats them."""
+
+    def __init__(self, pipeline, name, kind, function, executor="thread", workers=1):
+        self.pipeline = pipeline
+        self.name = name
+        self.kind = kind
+        self.function = function
+        self.executor = executor
+        self.workers = workers
+        self.input = None   # Edge in front of it, sources have none
+        self.outputs = []   # Edges to the stages after it
+        self.items = stage_items.labels(pipeline.name, name)
+        self.seconds = stage_seconds.labels(pipeline.name, name)
+        self.busy = 0.0
+        self.errors = 0
+        self._pool = None
+        self._threads = []
+        self.configure(executor)
+
+    def configure(self, executor=None, workers=None):
+        if executor is not None:
+            if executor not in EXECUTORS:
+                raise ValueError(f"unknown executor {executor!r}, known ones: {', '.join(EXECUTORS)}")
+            if executor == "process":
+                # Would fail on every item otherwise. Only top level functions pickle (closures and lambdas don't)
+                # and a worker only sees the globals as they were when it forked, pass what changes in the item
+                try:
+                    pickle.dumps(self.function)
+                except (pickle.PicklingError, AttributeError, TypeError) as e:
+                    raise ValueError(f"stage {self.pipeline.name}/{self.name} can't run in a process, "
+                                     f"its function can't be pickled ({e})") from None
+            self.executor = executor
+        if workers is not None:
+            self.workers = max(1, int(workers))
+
+    def _call(self, *args):
+        if self._pool is not None:
+            return self._pool.submit(self.function, *args).result()
+        return self.function(*args)
+
+    def _step(self, stop_event):
+        """Gets, works on and passes on one item. Returns False when there was nothing to do."""
+        if self.input is not None:
+            item = self.input.get()
+            if item is None:
+                return False
+            args = (item,)
+        else:
+            args = ()
+        start = time.perf_counter()
+        try:
+            result = self._call(*args)
+        except Exception as e:
+            self.errors += 1
+            log.warning("Stage %s/%s failed: %s", self.pipeline.name, self.name, e)
+            return True
+        took = time.perf_counter() - start
+        self.busy += took
+        if self.kind == "source" and result is None:
+            return True  # nothing this time, the source did its own waiting
+        self.seconds.observe(took)
+        self.items.inc()
+        if self.kind != "sink" and result is not None:
+            for edge in self.outputs:
+                edge.put(result, stop_event)
+        return True
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            self._step(stop_event)
+
+    def start(self, stop_event):
+        if self.executor == "process":
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        if self.executor == "main":
+            return  # the caller runs it with Pipeline.run()
+        for i in range(self.workers):
+            name = f"{self.pipeline.name}-{self.name}" + (f"-{i}" if self.workers > 1 else "")
+            thread = threading.Thread(target=self.run, args=(stop_event,), name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class Pipeline:
+    """Stages in the order they were added, each one fed by the stage added before it unless told otherwise."""
+
+    def __init__(self, name, stop_event=None):
+        self.name = name
+        self.stop_event = stop_event or threading.Event()
+        self.stages = {}
+        self._last = None
+        self._started = None
+
+    def _add(self, name, kind, function, after, queue, policy, executor, workers):
+        if name in self.stages:
+            raise ValueError(f"pipeline {self.name} already has a stage called {name}")
+        stage = Stage(self, name, kind, function, executor, workers)
+        if kind != "source":
+            previous = self.stages[after] if after else self._last
+            if previous is None or previous.kind == "sink":
+                raise ValueError(f"stage {name} has nothing to take items from")
+            stage.input = Edge(queue, policy)
+            previous.outputs.append(stage.input)
+            edge_dropped.labels(self.name, name).set_function(lambda e=stage.input: e.dropped)
+            edge_depth.labels(self.name, name).set_function(lambda e=stage.input: len(e))
+        self.stages[name] = stage
+        self._last = stage
+        return stage
+
+    def source(self, name, function, executor="thread"):
+        """function() -> item, or None when there is nothing (it should wait a bit itself then)."""
+        return self._add(name, "source", function, None, 0, "block", executor, 1)
+
+    def transform(self, name, function, after=None, queue=1, policy="latest", executor="thread", workers=1):
+        """function(item) -> item for the next stage, or None to drop it."""
+        return self._add(name, "transform", function, after, queue, policy, executor, workers)
+
+    def sink(self, name, function, after=None, queue=1, policy="latest", executor="thread", workers=1):
+        """function(item), the end of the line."""
+        return self._add(name, "sink", function, after, queue, policy, executor, workers)
+
+    def configure(self, overrides):
+        """Applies {stage: {queue, policy, executor, workers}}, before start()."""
+        for name, settings in overrides.items():
+            stage = self.stages.get(name)
+            if stage is None:
+                raise ValueError(f"pipeline {self.name} has no stage {name}, it has {', '.join(self.stages)}")
+            stage.configure(settings.get("executor"), settings.get("workers"))
+            if stage.input is not None and ("queue" in settings or "policy" in settings):
+                edge = Edge(settings.get("queue", stage.input.maxsize), settings.get("policy", stage.input.policy))
+                for other in self.stages.values():
+                    other.outputs = [edge if e is stage.input else e for e in other.outputs]
+                stage.input = edge
+                edge_dropped.labels(self.name, name).set_function(lambda e=edge: e.dropped)
+                edge_depth.labels(self.name, name).set_function(lambda e=edge: len(e))
+
+    def configure_from_file(self, path):
+        """Same as configure() with a json file holding {pipeline name: {stage: {...}}}, other pipelines are ignored."""
+        with open(path) as f:
+            self.configure(json.load(f).get(self.name, {}))
+
+    def start(self):
+        self._started = time.monotonic()
+        for stage in self.stages.values():
+            stage.start(self.stop_event)
+
+    def run(self):
+        """Runs the stages with executor "main" on the calling thread until the pipeline stops (OpenCV windows)."""
+        main = [stage for stage in self.stages.values() if stage.executor == "main"]
+        while not self.stop_event.is_set():
+            for stage in main:
+                stage._step(self.stop_event)
+
+    def stop(self, timeout=1.0):
+        self.stop_event.set()
+        for stage in self.stages.values():
+            stage.join(timeout)
+
+    def report(self):
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        lines = [f"Pipeline {self.name}:"]
+        for stage in self.stages.values():
+            count = int(stage.items.get())
+            share = 100 * stage.busy / elapsed / stage.workers if elapsed else 0.0
+            line = (f"  {stage.name:<12} {stage.executor:<7} x{stage.workers} {count:7} items  "
+                    f"{1000 * stage.busy / count if count else 0:6.2f} ms each  busy {share:5.1f}%")
+            if stage.input is not None:
+                line += f"  queue {len(stage.input)}/{stage.input.maxsize} {stage.input.policy}, dropped {stage.input.dropped}"
+            if stage.errors:
+                line += f"  errors {stage.errors}"
+            lines.append(line)
+        return "\n".join(lines)
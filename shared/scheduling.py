@@ -0,0 +1,175 @@
+# Where threads run and how urgently: pins threads to cores, raises the priority of the audio threads
+# and caps OpenCV's own thread pool, so detection on every core can't starve PyAudio into glitching.
+# Linux only (sched_setaffinity on thread ids, /proc for the cpu use), elsewhere it does nothing and says so.
+#
+# A plan is a list of NAME=CPUS[:PRIORITY] separated by commas, NAME being a thread name or a pattern:
+#   "playback=0:fifo20,audio-*=0:fifo10,receive*=1,display=1,video-capture=2,video-encode=3"
+# CPUS is 0, 2-3 or 0+2, PRIORITY is fifo<1-99> or rr<1-99> (real time, needs root or CAP_SYS_NICE,
+# falls back to the best nice it's allowed) or nice<-20..19>. The first matching entry wins.
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Four cores: audio alone on 0, networking and the window on 1, camera and detection on 2, encoding (and decoding
+# under --asyncio) on 3
+PRESETS = {
+    "pi4": "playback=0:fifo20,audio-*=0:fifo10,receive*=1,display=1,heartbeat=1,telemetry=1,"
+           "video-capture=2,detector=2,video-encode=3,video-send=1,relay-*=1,"
+           "microphone_*=0:fifo10,capture_*=2,decode_*=3",  # the last three are the --asyncio executors
+}
+SUPPORTED = hasattr(os, "sched_setaffinity")
+
+
+def parse_cpus(text):
+    cpus = set()
+    for part in text.split("+"):
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def parse_plan(spec):
+    """"name=cpus:priority,..." (or a PRESETS name) -> [(pattern, cpus or None, priority or None)]."""
+    spec = PRESETS.get(spec, spec)
+    plan = []
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        pattern, _, setting = entry.partition("=")
+        cpus, _, priority = setting.partition(":")
+        if priority and not priority.startswith(("fifo", "rr", "nice")):
+            raise ValueError(f"unknown priority {priority!r} in {entry!r}, use fifo<N>, rr<N> or nice<N>")
+        plan.append((pattern, parse_cpus(cpus) if cpus else None, priority or None))
+    return plan
+
+
+def thread_cpu_seconds(tid):
+    """User + system cpu seconds of one thread of this process, None if it's gone (or there's no /proc)."""
+    try:
+        with open(f"/proc/self/task/{tid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Scheduler:
+    """Applies a plan to the threads it's given (or finds by name) and keeps track of what it got."""
+
+    def __init__(self, plan="", cv_threads=None):
+        self.plan = parse_plan(plan) if plan else []
+        self.cv_threads = cv_threads
+        self.applied = {}    # thread name -> description of what it got
+        self._threads = {}   # thread name -> thread id
+        self._cpu = {}       # thread name -> (cpu seconds, monotonic) when report() last looked
+        self._lock = threading.Lock()
+
+    def configure_opencv(self):
+        """cv2.setNumThreads for this process, call it before the first OpenCV work."""
+        if self.cv_threads is None:
+            return
+        import cv2
+        cv2.setNumThreads(self.cv_threads)
+        log.info("OpenCV uses %d thread(s)", cv2.getNumThreads())
+
+    def _entry(self, name):
+        for pattern, cpus, priority in self.plan:
+            if fnmatch.fnmatchcase(name, pattern):
+                return cpus, priority
+        return None
+
+    def apply(self, threads=None):
+        """Applies the plan to the given threads, every running python thread by default."""
+        got = []
+        for thread in threads if threads is not None else threading.enumerate():
+            if thread.native_id is not None and self._apply(thread.name, thread.native_id):
+                got.append(f"{thread.name}: {self.applied[thread.name]}")
+        if got:
+            log.info("Threads placed, %s", "; ".join(got))
+
+    def apply_current(self, name):
+        """For threads python didn't start (the PyAudio callback): applies the plan entry for name to the calling thread."""
+        if self._apply(name, threading.get_native_id()):
+            log.info("Thread %s placed: %s", name, self.applied[name])
+
+    def _apply(self, name, tid):
+        with self._lock:
+            self._threads[name] = tid
+            self._cpu.setdefault(name, (thread_cpu_seconds(tid), time.monotonic()))
+        entry = self._entry(name)
+        if entry is None or not SUPPORTED:
+            return False
+        cpus, priority = entry
+        got = []
+        if cpus:
+            try:
+                os.sched_setaffinity(tid, cpus)
+                got.append("cpus " + ",".join(str(c) for c in sorted(os.sched_getaffinity(tid))))
+            except OSError as e:
+                got.append(f"cpus {','.join(str(c) for c in sorted(cpus))} refused ({e.strerror})")
+        if priority:
+            got.append(self._set_priority(tid, priority))
+        with self._lock:
+            self.applied[name] = ", ".join(got)
+        return True
+
+    @staticmethod
+    def _set_priority(tid, priority):
+        if priority.startswith("nice"):
+            return Scheduler._set_nice(tid, int(priority[4:]))
+        policy, level = (os.SCHED_FIFO, int(priority[4:])) if priority.startswith("fifo") else (os.SCHED_RR, int(priority[2:]))
+        try:
+            os.sched_setscheduler(tid, policy, os.sched_param(level))
+            return priority
+        except (OSError, AttributeError):
+            # No real time allowed, the highest priority we can still get is the best nice we're allowed
+            return Scheduler._set_nice(tid, -10, fallback_from=priority)
+
+    @staticmethod
+    def _set_nice(tid, nice, fallback_from=None):
+        # Going below 0 may not be allowed, then the lowest value that is
+        for value in range(nice, 1) if nice < 0 else [nice]:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, value)
+                break
+            except OSError:
+                continue
+        got = f"nice {os.getpriority(os.PRIO_PROCESS, tid)}"
+        return f"{got} ({fallback_from} not allowed)" if fallback_from else got
+
+    def cpu_share(self):
+        """{thread name: percent of one core} since the previous call (or since the thread was applied)."""
+        now = time.monotonic()
+        shares = {}
+        with self._lock:
+            for name, tid in self._threads.items():
+                seconds = thread_cpu_seconds(tid)
+                before, since = self._cpu.get(name, (None, now))
+                if seconds is not None and before is not None and now > since:
+                    shares[name] = 100 * (seconds - before) / (now - since)
+                self._cpu[name] = (seconds, now)
+        return shares
+
+    def report(self):
+        if not SUPPORTED:
+            return "Scheduling: not supported on this system"
+        lines = [f"Scheduling: OpenCV threads {self.cv_threads if self.cv_threads is not None else 'default'}"]
+        for name, share in sorted(self.cpu_share().items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<20} {share:5.1f}% cpu  {self.applied.get(name, '')}")
+        return "\n".join(lines)
+
+
+def add_arguments(parser):
+    parser.add_argument("--cpu-plan", default="",
+                        help="pin threads to cores and set their priority: NAME=CPUS[:fifoN|rrN|niceN],... "
+                             f"or a preset ({', '.join(PRESETS)})")
+    parser.add_argument("--cv-threads", type=int, default=None,
+                        help="threads OpenCV may use for detection, resize and encode (default: OpenCV decides, all cores)")
+
+
+def from_args(args):
+    scheduler = Scheduler(args.cpu_plan, args.cv_threads)
+    scheduler.configure_opencv()
+    return scheduler